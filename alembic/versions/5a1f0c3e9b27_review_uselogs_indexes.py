@@ -0,0 +1,69 @@
+"""Review UseLogs indexes
+
+Revision ID: 5a1f0c3e9b27
+Revises: 414d69d7ee76
+Create Date: 2026-10-19 10:12:41.118203
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5a1f0c3e9b27'
+down_revision = '414d69d7ee76'
+
+from alembic import op
+
+
+def upgrade():
+    # Only date, url, city, country and (year, month, url) are used by the
+    # stats views, the exports and the GeoIP enrichment
+    op.create_index(u'ix_UseLogs_year_month_url', 'UseLogs', ['year', 'month', 'url'], unique=False)
+    op.drop_index(u'ix_UseLogs_datetime', table_name='UseLogs')
+    op.drop_index(u'ix_UseLogs_day_of_week', table_name='UseLogs')
+    op.drop_index(u'ix_UseLogs_hour_of_day', table_name='UseLogs')
+    op.drop_index(u'ix_UseLogs_year', table_name='UseLogs')
+    op.drop_index(u'ix_UseLogs_month', table_name='UseLogs')
+    op.drop_index(u'ix_UseLogs_local_timezone', table_name='UseLogs')
+    op.drop_index(u'ix_UseLogs_local_datetime', table_name='UseLogs')
+    op.drop_index(u'ix_UseLogs_local_date', table_name='UseLogs')
+    op.drop_index(u'ix_UseLogs_local_day_of_week', table_name='UseLogs')
+    op.drop_index(u'ix_UseLogs_local_hour_of_day', table_name='UseLogs')
+    op.drop_index(u'ix_UseLogs_local_year', table_name='UseLogs')
+    op.drop_index(u'ix_UseLogs_local_month', table_name='UseLogs')
+    op.drop_index(u'ix_UseLogs_ip_address', table_name='UseLogs')
+    op.drop_index(u'ix_UseLogs_web_browser', table_name='UseLogs')
+    op.drop_index(u'ix_UseLogs_browser_platform', table_name='UseLogs')
+    op.drop_index(u'ix_UseLogs_browser_name', table_name='UseLogs')
+    op.drop_index(u'ix_UseLogs_browser_version', table_name='UseLogs')
+    op.drop_index(u'ix_UseLogs_browser_language', table_name='UseLogs')
+    op.drop_index(u'ix_UseLogs_first_language', table_name='UseLogs')
+    op.drop_index(u'ix_UseLogs_second_language', table_name='UseLogs')
+    op.drop_index(u'ix_UseLogs_third_language', table_name='UseLogs')
+    op.drop_index(u'ix_UseLogs_all_languages', table_name='UseLogs')
+    op.drop_index(u'ix_UseLogs_hostname', table_name='UseLogs')
+
+
+def downgrade():
+    op.create_index(u'ix_UseLogs_hostname', 'UseLogs', ['hostname'], unique=False)
+    op.create_index(u'ix_UseLogs_all_languages', 'UseLogs', ['all_languages'], unique=False)
+    op.create_index(u'ix_UseLogs_third_language', 'UseLogs', ['third_language'], unique=False)
+    op.create_index(u'ix_UseLogs_second_language', 'UseLogs', ['second_language'], unique=False)
+    op.create_index(u'ix_UseLogs_first_language', 'UseLogs', ['first_language'], unique=False)
+    op.create_index(u'ix_UseLogs_browser_language', 'UseLogs', ['browser_language'], unique=False)
+    op.create_index(u'ix_UseLogs_browser_version', 'UseLogs', ['browser_version'], unique=False)
+    op.create_index(u'ix_UseLogs_browser_name', 'UseLogs', ['browser_name'], unique=False)
+    op.create_index(u'ix_UseLogs_browser_platform', 'UseLogs', ['browser_platform'], unique=False)
+    op.create_index(u'ix_UseLogs_web_browser', 'UseLogs', ['web_browser'], unique=False)
+    op.create_index(u'ix_UseLogs_ip_address', 'UseLogs', ['ip_address'], unique=False)
+    op.create_index(u'ix_UseLogs_local_month', 'UseLogs', ['local_month'], unique=False)
+    op.create_index(u'ix_UseLogs_local_year', 'UseLogs', ['local_year'], unique=False)
+    op.create_index(u'ix_UseLogs_local_hour_of_day', 'UseLogs', ['local_hour_of_day'], unique=False)
+    op.create_index(u'ix_UseLogs_local_day_of_week', 'UseLogs', ['local_day_of_week'], unique=False)
+    op.create_index(u'ix_UseLogs_local_date', 'UseLogs', ['local_date'], unique=False)
+    op.create_index(u'ix_UseLogs_local_datetime', 'UseLogs', ['local_datetime'], unique=False)
+    op.create_index(u'ix_UseLogs_local_timezone', 'UseLogs', ['local_timezone'], unique=False)
+    op.create_index(u'ix_UseLogs_month', 'UseLogs', ['month'], unique=False)
+    op.create_index(u'ix_UseLogs_year', 'UseLogs', ['year'], unique=False)
+    op.create_index(u'ix_UseLogs_hour_of_day', 'UseLogs', ['hour_of_day'], unique=False)
+    op.create_index(u'ix_UseLogs_day_of_week', 'UseLogs', ['day_of_week'], unique=False)
+    op.create_index(u'ix_UseLogs_datetime', 'UseLogs', ['datetime'], unique=False)
+    op.drop_index(u'ix_UseLogs_year_month_url', table_name='UseLogs')
@@ -0,0 +1,57 @@
+# -*-*- encoding: utf-8 -*-*-
+#
+# gateway4labs is free software: you can redistribute it and/or modify
+# it under the terms of the BSD 2-Clause License
+# gateway4labs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+
+"""
+Archive old UseLogs to compressed files, one per month, and remove them
+from the database:
+
+    python archive_stats.py --retention-months 24
+    python archive_stats.py --month 2017-06 --keep
+    python archive_stats.py --restore uselogs_archive/uselogs-2017-06.json.gz
+"""
+
+from optparse import OptionParser
+
+from labmanager import app
+from labmanager.archive import apply_retention, archive_month, restore_archive, expired_months, get_retention_months, get_archive_directory
+
+parser = OptionParser(usage = "Archive old UseLogs")
+parser.add_option('--retention-months', dest = 'retention_months', type = 'int', default = None, help = "Months kept in the database (default: USELOGS_RETENTION_MONTHS)")
+parser.add_option('--month', dest = 'month', default = None, help = "Archive only this month (YYYY-MM)")
+parser.add_option('--directory', dest = 'directory', default = None, help = "Archive directory (default: USELOGS_ARCHIVE_DIRECTORY)")
+parser.add_option('--keep', dest = 'keep', default = False, action = 'store_true', help = "Do not remove the archived rows")
+parser.add_option('--restore', dest = 'restore', default = None, help = "Load back the UseLogs of this archive")
+parser.add_option('--list', dest = 'list', default = False, action = 'store_true', help = "Only list the months that would be archived")
+args, _ = parser.parse_args()
+
+with app.app_context():
+    directory = args.directory or get_archive_directory()
+
+    if args.restore:
+        rows = restore_archive(args.restore)
+        print "Restored %s UseLogs from %s" % (rows, args.restore)
+    elif args.month:
+        year, month = [ int(part) for part in args.month.split('-') ]
+        filename, rows = archive_month(year, month, directory, delete = not args.keep)
+        print "Archived %s UseLogs in %s" % (rows, filename)
+    else:
+        retention_months = args.retention_months
+        if retention_months is None:
+            retention_months = get_retention_months()
+        if retention_months is None:
+            parser.error("Provide --retention-months or configure USELOGS_RETENTION_MONTHS")
+
+        if args.list:
+            for year, month in expired_months(retention_months):
+                print "%04d-%02d" % (year, month)
+        elif args.keep:
+            for year, month in expired_months(retention_months):
+                filename, rows = archive_month(year, month, directory, delete = False)
+                print "Archived %s UseLogs of %04d-%02d in %s" % (rows, year, month, filename)
+        else:
+            apply_retention(retention_months, directory)
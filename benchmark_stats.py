@@ -0,0 +1,115 @@
+# -*-*- encoding: utf-8 -*-*-
+#
+# gateway4labs is free software: you can redistribute it and/or modify
+# it under the terms of the BSD 2-Clause License
+# gateway4labs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+
+"""
+Benchmark of the stats.monthly aggregation on a synthetic UseLogs table.
+
+It creates a temporary SQLite database (or uses --database), fills UseLogs
+with --rows synthetic visits spread over --months months and --urls urls,
+and then measures the GROUP BY query and the previous (re-sorting) and
+current (top-K heap) aggregations over its results:
+
+    python benchmark_stats.py --rows 2000000 --urls 20000 --months 48
+"""
+
+import os
+import sys
+import time
+import random
+import datetime
+import tempfile
+from optparse import OptionParser
+
+parser = OptionParser(usage = "Benchmark the stats aggregation on a synthetic UseLogs table")
+parser.add_option('--rows', dest = 'rows', type = 'int', default = 2000000, help = "Number of UseLogs rows")
+parser.add_option('--urls', dest = 'urls', type = 'int', default = 20000, help = "Number of different urls")
+parser.add_option('--months', dest = 'months', type = 'int', default = 48, help = "Number of months covered")
+parser.add_option('--top', dest = 'top', type = 'int', default = 10, help = "Top K urls per month")
+parser.add_option('--database', dest = 'database', default = None, help = "SQLAlchemy URI (default: temporary SQLite file)")
+parser.add_option('--skip-old', dest = 'skip_old', default = False, action = 'store_true', help = "Do not measure the previous (quadratic) aggregation")
+args, _ = parser.parse_args()
+
+from labmanager import app
+from labmanager.db import db
+from labmanager.models import UseLog
+from labmanager.views.stats import session_proxy, top_urls_per_period
+
+from sqlalchemy import func
+
+temporary_file = None
+if args.database is None:
+    temporary_file = tempfile.mktemp(suffix = '.db')
+    args.database = 'sqlite:///%s' % temporary_file
+
+app.config['SQLALCHEMY_DATABASE_URI'] = args.database
+
+def measure(label, func, *func_args):
+    before = time.time()
+    result = func(*func_args)
+    print "%-40s %8.2f seconds" % (label, time.time() - before)
+    sys.stdout.flush()
+    return result
+
+def fill(rows, urls, months):
+    random.seed(0)
+    start = datetime.datetime(2015, 1, 1)
+    url_list = [ u'http://gateway.golabz.eu/os/pub/lab%s/w_default.xml' % n for n in xrange(urls) ]
+    table = UseLog.__table__
+    CHUNK = 20000
+    inserted = 0
+    while inserted < rows:
+        chunk = []
+        for _ in xrange(min(CHUNK, rows - inserted)):
+            dtime = start + datetime.timedelta(days = random.randint(0, months * 30), seconds = random.randint(0, 86399))
+            # Zipf-like: a few urls get most of the visits
+            url = url_list[min(int(random.paretovariate(1.2)) - 1, urls - 1)]
+            chunk.append(dict(datetime = dtime, date = dtime.date(), day_of_week = dtime.weekday(), hour_of_day = dtime.hour,
+                              year = dtime.year, month = dtime.month, local_timezone = 0, local_datetime = dtime,
+                              local_date = dtime.date(), local_day_of_week = dtime.weekday(), local_hour_of_day = dtime.hour,
+                              local_year = dtime.year, local_month = dtime.month,
+                              url = url, web_browser = u'Mozilla/5.0', city = u'Bilbao', country = u'ES'))
+        db.session.execute(table.insert(), chunk)
+        db.session.commit()
+        inserted += len(chunk)
+
+def old_aggregation(rows, lab_per_url):
+    temporal_month_url = {}
+    for count, year, month, url in rows:
+        if (year, month) not in temporal_month_url:
+            temporal_month_url[year, month] = []
+
+        temporal_month_url[year, month].append({
+            'count': count,
+            'url': url,
+            'data': lab_per_url.get(url, {})
+        })
+        temporal_month_url[year, month].sort(lambda x, y: cmp(x['count'], y['count']), reverse=True)
+    return temporal_month_url
+
+def main():
+    with app.app_context():
+        db.create_all()
+        if db.session.query(func.count(UseLog.id)).scalar() == 0:
+            measure("Filling %s rows" % args.rows, fill, args.rows, args.urls, args.months)
+
+        query = session_proxy(db.session.query(func.count("id"), UseLog.year, UseLog.month, UseLog.url).filter(~UseLog.web_browser.like('%bot%'))).group_by(UseLog.year, UseLog.month, UseLog.url)
+        rows = measure("GROUP BY (year, month, url)", query.all)
+        print "%s (month, url) groups" % len(rows)
+
+        new_results = measure("top_urls_per_period (heap, K=%s)" % args.top, top_urls_per_period, rows, args.top, {})
+        if not args.skip_old:
+            old_results = measure("Previous aggregation (sort per row)", old_aggregation, rows, {})
+            for period, urls in new_results.iteritems():
+                assert [ url['count'] for url in urls ] == [ url['count'] for url in old_results[period][:args.top] ], period
+            print "Results match"
+
+try:
+    main()
+finally:
+    if temporary_file is not None and os.path.exists(temporary_file):
+        os.remove(temporary_file)
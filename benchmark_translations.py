@@ -0,0 +1,110 @@
+# -*-*- encoding: utf-8 -*-*-
+#
+# gateway4labs is free software: you can redistribute it and/or modify
+# it under the terms of the BSD 2-Clause License
+# gateway4labs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+
+"""
+Micro-benchmark of the serialization of translation bundles
+(opensocial._translations_to_xml) compared to the previous ElementTree
+implementation, on synthetic bundles:
+
+    python benchmark_translations.py --messages 10000 --languages 50
+"""
+
+import sys
+import time
+import random
+from optparse import OptionParser
+import xml.etree.ElementTree as ET
+
+parser = OptionParser(usage = "Benchmark the serialization of translation bundles")
+parser.add_option('--messages', dest = 'messages', type = 'int', default = 10000, help = "Messages per language")
+parser.add_option('--languages', dest = 'languages', type = 'int', default = 5, help = "Number of languages serialized")
+parser.add_option('--repetitions', dest = 'repetitions', type = 'int', default = 3, help = "Times each language is serialized")
+args, _ = parser.parse_args()
+
+from labmanager.views.opensocial import _translations_to_xml
+
+def _indent(elem, level=0):
+    i = "\n" + level*"  "
+    if len(elem):
+        if not elem.text or not elem.text.strip():
+            elem.text = i + "  "
+        if not elem.tail or not elem.tail.strip():
+            elem.tail = i
+        for elem in elem:
+            _indent(elem, level+1)
+        if not elem.tail or not elem.tail.strip():
+            elem.tail = i
+    else:
+        if level and (not elem.tail or not elem.tail.strip()):
+            elem.tail = i
+
+def old_translations_to_xml(translations_response, language):
+    xml_bundle = ET.Element("messagebundle")
+    xml_bundle.attrib['automatic'] = "false"
+
+    translations = translations_response.get('translations', {})
+    mails = translations_response.get('mails', [])
+    language = translations.get(language, {})
+    if mails:
+        xml_bundle.attrib['mails'] = ','.join(mails)
+
+    for key, pack in sorted(language.items(), lambda (k1, v1), (k2, v2): cmp(k1, k2)):
+        if 'value' not in pack:
+            continue
+
+        value = pack.get('value', '')
+        namespace = pack.get('namespace')
+        category = pack.get('category')
+
+        xml_msg = ET.SubElement(xml_bundle, 'msg')
+        xml_msg.attrib['name'] = key
+
+        if namespace:
+            xml_msg.attrib['namespace'] = namespace
+
+        if category:
+            xml_msg.attrib['category'] = category
+        
+        if not isinstance(value, unicode):
+            value = value.decode('utf-8')
+        xml_msg.text = value
+    _indent(xml_bundle)
+    return ET.tostring(xml_bundle, encoding = 'UTF-8')
+
+def build_bundle(messages, languages):
+    random.seed(0)
+    translations = {}
+    for lang_number in xrange(languages):
+        language = translations['lang%s' % lang_number] = {}
+        for number in xrange(messages):
+            language['message_%05d' % number] = {
+                'value' : u'Message <%s> & "description" número %s' % (number, random.randint(0, 1000)),
+                'namespace' : 'http://example.com/#translations',
+            }
+    return { 'translations' : translations, 'mails' : [ 'admin@example.com' ] }
+
+def measure(label, func):
+    before = time.time()
+    for _ in xrange(args.repetitions):
+        for lang_number in xrange(args.languages):
+            func('lang%s' % lang_number)
+    elapsed = time.time() - before
+    print "%-40s %8.2f ms per bundle" % (label, 1000 * elapsed / (args.repetitions * args.languages))
+    sys.stdout.flush()
+
+bundle = build_bundle(args.messages, args.languages)
+print "%s languages of %s messages" % (args.languages, args.messages)
+
+for lang_number in xrange(args.languages):
+    language = 'lang%s' % lang_number
+    assert old_translations_to_xml(bundle, language) == _translations_to_xml(bundle, language), language
+print "Outputs match"
+
+measure("ElementTree (previous)", lambda language: old_translations_to_xml(bundle, language))
+measure("Streaming serializer", lambda language: _translations_to_xml(bundle, language))
+measure("Streaming serializer (memoized)", lambda language: _translations_to_xml(bundle, language, version = 'benchmark'))
@@ -0,0 +1,40 @@
+# -*-*- encoding: utf-8 -*-*-
+#
+# gateway4labs is free software: you can redistribute it and/or modify
+# it under the terms of the BSD 2-Clause License
+# gateway4labs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+
+"""
+Export the UseLogs as CSV or newline-delimited JSON, reading them in date
+ranges so memory does not grow with the size of the table:
+
+    python export_stats.py --format json --start 2018-01-01 --end 2018-12-31 --country ES -o uselogs.json
+"""
+
+import sys
+from optparse import OptionParser
+
+from labmanager import app
+from labmanager.views.stats import iter_use_logs, serialize_use_logs, parse_date, EXPORT_FORMATS
+
+parser = OptionParser(usage = "Export the UseLogs")
+parser.add_option('-f', '--format', dest = 'format', default = 'csv', choices = sorted(EXPORT_FORMATS), help = "Output format: csv or json (one JSON object per line)")
+parser.add_option('--start', dest = 'start', default = None, help = "First date (YYYY-MM-DD)")
+parser.add_option('--end', dest = 'end', default = None, help = "Last date (YYYY-MM-DD, included)")
+parser.add_option('--url', dest = 'url', default = None, help = "Only this url")
+parser.add_option('--country', dest = 'country', default = None, help = "Only this country code")
+parser.add_option('--chunk-days', dest = 'chunk_days', type = 'int', default = 7, help = "Days retrieved per query")
+parser.add_option('-o', '--output', dest = 'output', default = None, help = "Output file (default: stdout)")
+args, _ = parser.parse_args()
+
+output = open(args.output, 'wb') if args.output else sys.stdout
+try:
+    with app.app_context():
+        rows = iter_use_logs(parse_date(args.start), parse_date(args.end), url = args.url, country = args.country, chunk_days = args.chunk_days)
+        for line in serialize_use_logs(rows, args.format):
+            output.write(line)
+finally:
+    if output is not sys.stdout:
+        output.close()
@@ -87,6 +87,9 @@ def register_blueprints():
 load_views()
 load_rlms_modules()
 register_blueprints()
+
+from .certificates import install_ca_bundle
+install_ca_bundle()
 # print app.url_map
 
 # Maintained for compatibility (it might be deployed in certain .wsgi files in other servers)
@@ -0,0 +1,176 @@
+# -*-*- encoding: utf-8 -*-*-
+#
+# gateway4labs is free software: you can redistribute it and/or modify
+# it under the terms of the BSD 2-Clause License
+# gateway4labs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+
+"""
+  Retention of the UseLogs table, organized in monthly partitions. When
+  USELOGS_RETENTION_MONTHS is configured, every month older than that is
+  written to a compressed file in USELOGS_ARCHIVE_DIRECTORY (e.g.,
+  uselogs-2017-06.json.gz, one JSON object per row with every column of
+  the table) and then removed from the database, so the table (and the
+  cost of updating its indexes on every insert) stays bounded. An archive
+  can be loaded back with restore_archive.
+
+  It is run daily by the TaskRunner, or manually with archive_stats.py.
+"""
+
+import os
+import gzip
+import json
+import datetime
+
+from sqlalchemy import func, sql, DateTime, Date
+
+from labmanager.db import db
+from labmanager.models import UseLog
+from labmanager.application import app
+
+DEFAULT_ARCHIVE_DIRECTORY = 'uselogs_archive'
+DELETE_CHUNK_SIZE = 1000
+ARCHIVE_EXTENSION = '.json.gz'
+
+def get_retention_months():
+    """Number of months kept in the database, or None if the UseLogs are kept forever (default)."""
+    return app.config.get('USELOGS_RETENTION_MONTHS')
+
+def get_archive_directory():
+    return app.config.get('USELOGS_ARCHIVE_DIRECTORY', DEFAULT_ARCHIVE_DIRECTORY)
+
+def month_range(year, month):
+    """Returns (first day of the month, first day of the next month)."""
+    first = datetime.date(year, month, 1)
+    if month == 12:
+        return first, datetime.date(year + 1, 1, 1)
+    return first, datetime.date(year, month + 1, 1)
+
+def retention_limit(retention_months, today = None):
+    """First day of the oldest month that must be kept."""
+    if today is None:
+        today = datetime.date.today()
+    months = today.year * 12 + today.month - 1 - retention_months
+    return datetime.date(months / 12, months % 12 + 1, 1)
+
+def expired_months(retention_months, today = None):
+    """Sorted list of (year, month) with UseLogs older than the retention limit."""
+    limit = retention_limit(retention_months, today)
+    rows = db.session.query(UseLog.year, UseLog.month).filter(UseLog.date < limit).group_by(UseLog.year, UseLog.month).all()
+    return sorted([ (year, month) for year, month in rows ])
+
+def archive_filename(directory, year, month):
+    """Path of a new archive for that month (a suffix is added if the month was already archived)."""
+    base = os.path.join(directory, 'uselogs-%04d-%02d' % (year, month))
+    filename = base + ARCHIVE_EXTENSION
+    counter = 1
+    while os.path.exists(filename):
+        filename = '%s.%s%s' % (base, counter, ARCHIVE_EXTENSION)
+        counter += 1
+    return filename
+
+def _archive_value(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return value
+
+def _restore_value(column, value):
+    if value is None:
+        return None
+    if isinstance(column.type, DateTime):
+        if '.' in value:
+            return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f')
+        return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+    if isinstance(column.type, Date):
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    return value
+
+def _iter_month_rows(first, next_month, chunk_size):
+    """Yield every column of the UseLogs of the month, chunk_size rows per query."""
+    table = UseLog.__table__
+    last_id = 0
+    while True:
+        query = sql.select(table.c).where(sql.and_(table.c.date >= first, table.c.date < next_month, table.c.id > last_id)).order_by(table.c.id).limit(chunk_size)
+        rows = db.session.execute(query).fetchall()
+        if not rows:
+            break
+        for row in rows:
+            yield row
+        last_id = rows[-1][table.c.id]
+
+def archive_month(year, month, directory = None, delete = True, chunk_size = DELETE_CHUNK_SIZE):
+    """
+    Write the UseLogs of that month to a compressed file and (if delete)
+    remove them from the database in chunks of chunk_size rows. Returns
+    (filename, number of rows) or (None, 0) if there was nothing to archive.
+    """
+    first, next_month = month_range(year, month)
+    if db.session.query(func.count(UseLog.id)).filter(UseLog.date >= first, UseLog.date < next_month).scalar() == 0:
+        return None, 0
+
+    directory = directory or get_archive_directory()
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    filename = archive_filename(directory, year, month)
+    temporary_filename = filename + '.tmp'
+    counter = 0
+    columns = UseLog.__table__.c
+
+    # The file is renamed only once complete, so a failure never leaves a
+    # partial archive while the rows are still in the database
+    archive = gzip.open(temporary_filename, 'wb')
+    try:
+        for row in _iter_month_rows(first, next_month, chunk_size):
+            archive.write(json.dumps(dict( (column.name, _archive_value(row[column])) for column in columns )) + '\n')
+            counter += 1
+    finally:
+        archive.close()
+    os.rename(temporary_filename, filename)
+
+    if delete:
+        table = UseLog.__table__
+        while True:
+            ids = [ log_id for log_id, in db.session.query(UseLog.id).filter(UseLog.date >= first, UseLog.date < next_month).limit(chunk_size) ]
+            if not ids:
+                break
+            db.session.execute(table.delete().where(table.c.id.in_(ids)))
+            db.session.commit()
+
+    return filename, counter
+
+def restore_archive(filename, chunk_size = DELETE_CHUNK_SIZE):
+    """Insert back the UseLogs of an archive (with their original ids). Returns the number of rows."""
+    table = UseLog.__table__
+    counter = 0
+    batch = []
+    for line in gzip.open(filename, 'rb'):
+        if not line.strip():
+            continue
+        values = json.loads(line)
+        batch.append(dict( (column.name, _restore_value(column, values.get(column.name))) for column in table.c ))
+        if len(batch) >= chunk_size:
+            db.session.execute(table.insert(), batch)
+            counter += len(batch)
+            batch = []
+    if batch:
+        db.session.execute(table.insert(), batch)
+        counter += len(batch)
+    db.session.commit()
+    return counter
+
+def apply_retention(retention_months = None, directory = None, today = None):
+    """Archive and remove every month older than the retention policy. Returns [(filename, rows)]."""
+    if retention_months is None:
+        retention_months = get_retention_months()
+    if retention_months is None:
+        return []
+
+    results = []
+    for year, month in expired_months(retention_months, today):
+        filename, rows = archive_month(year, month, directory)
+        if filename:
+            print "Archived %s UseLogs of %04d-%02d in %s" % (rows, year, month, filename)
+            results.append((filename, rows))
+    return results
@@ -0,0 +1,67 @@
+# -*-*- encoding: utf-8 -*-*-
+#
+# gateway4labs is free software: you can redistribute it and/or modify
+# it under the terms of the BSD 2-Clause License
+# gateway4labs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+
+"""
+  Some comodo certificates are wrong: servers using them do not send the
+  intermediate certificate, so python requests can not verify them. At
+  startup, a private CA bundle (the default one plus the comodo intermediate
+  certificate) is written once and used by every outbound HTTP request
+  (REQUESTS_CA_BUNDLE), so no request has to read or fix the bundle.
+"""
+
+import os
+import sys
+import tempfile
+import traceback
+
+import certifi
+
+from labmanager.application import app
+
+COMODO_CA = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'utils', 'comodo_domain_server_ca.crt'))
+
+CA_BUNDLE_PATH = app.config.get('CA_BUNDLE_PATH') or os.path.join(tempfile.gettempdir(), 'labmanager-ca-bundle.pem')
+
+def build_ca_bundle(path, base_bundle = None, extra_certificates = (COMODO_CA,)):
+    """Write in path the base bundle (certifi's by default) plus the extra certificates not present in it."""
+    with open(base_bundle or certifi.where(), 'rb') as infile:
+        contents = infile.read()
+
+    for extra_certificate in extra_certificates:
+        with open(extra_certificate, 'rb') as infile:
+            certificate = infile.read()
+        if certificate not in contents:
+            if not contents.endswith('\n'):
+                contents += '\n'
+            contents += certificate
+
+    # Other processes may be using it: replace it atomically
+    fd, temporary_path = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(path)), suffix = '.pem')
+    try:
+        with os.fdopen(fd, 'wb') as outfile:
+            outfile.write(contents)
+        os.chmod(temporary_path, 0644)
+        os.rename(temporary_path, path)
+    except:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+    return path
+
+def install_ca_bundle():
+    """Build the private bundle and make it the one used by requests. Called once, at startup."""
+    try:
+        # If the administrator already chose a bundle, that one is extended
+        path = build_ca_bundle(CA_BUNDLE_PATH, base_bundle = os.environ.get('REQUESTS_CA_BUNDLE'))
+    except Exception:
+        traceback.print_exc()
+        print >> sys.stderr, "Warning: the CA bundle could not be written in %s. Using the default one." % CA_BUNDLE_PATH
+        return None
+
+    os.environ['REQUESTS_CA_BUNDLE'] = path
+    return path
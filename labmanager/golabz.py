@@ -0,0 +1,248 @@
+# -*-*- encoding: utf-8 -*-*-
+#
+# gateway4labs is free software: you can redistribute it and/or modify
+# it under the terms of the BSD 2-Clause License
+# gateway4labs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+
+"""
+  In-process caches of the external Go-Lab catalogs (the golabz.eu list of
+  labs and the App Composer status report). Views used to download them on
+  every page load; now they ask a CatalogCache, which keeps the last result
+  for a while and refreshes it in a background thread once it gets stale.
+
+  The source of each cache is a plain callable returning the decoded JSON,
+  so it can be replaced (e.g., by a local fixture in the tests):
+
+      golabz_labs.set_source(lambda : json.load(open('labs.json')))
+
+  The Go-Lab booking slots are kept the same way, as a BookingIndex, so
+  checking whether a lab is booked is a local lookup.
+"""
+
+import json
+import time
+import bisect
+import datetime
+import threading
+import traceback
+
+import requests
+
+from labmanager.application import app
+
+GOLABZ_LABS_URL = 'https://www.golabz.eu/rest/labs/retrieve.json'
+COMPOSER_STATUS_URL = 'https://composer.golabz.eu/translator/stats/status.json'
+BOOKING_URL = 'http://www.golabz.eu/rest/lab-booking/retrieve.json'
+
+DEFAULT_TIMEOUT = (10, 30)
+
+def http_json_source(url, timeout = DEFAULT_TIMEOUT, headers = None):
+    """Source that downloads and decodes a remote JSON document."""
+    def source():
+        r = requests.get(url, timeout = timeout, headers = headers)
+        r.raise_for_status()
+        return r.json()
+    return source
+
+def file_json_source(filename):
+    """Source that reads a local JSON document (useful for fixtures)."""
+    def source():
+        with open(filename) as f:
+            return json.load(f)
+    return source
+
+class CatalogCache(object):
+    """
+    Keeps the result of source() (optionally transformed by builder()) for
+    ttl seconds. Once it expires, the stale value is still returned while a
+    single background thread refreshes it. Only the very first call (when
+    there is nothing to return at all) waits for the source.
+    """
+
+    def __init__(self, name, source, ttl = 3600, builder = None):
+        self.name = name
+        self.ttl = ttl
+        self._source = source
+        self._builder = builder
+        self._value = None
+        self._timestamp = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def set_source(self, source):
+        with self._lock:
+            self._source = source
+            self._value = None
+            self._timestamp = None
+
+    def invalidate(self):
+        with self._lock:
+            self._value = None
+            self._timestamp = None
+
+    def is_stale(self):
+        return self._timestamp is None or time.time() - self._timestamp > self.ttl
+
+    def refresh(self):
+        """Synchronously reload the catalog. Returns the new value, or None on error."""
+        source = self._source
+        try:
+            contents = source()
+            if self._builder is not None:
+                contents = self._builder(contents)
+        except Exception:
+            traceback.print_exc()
+            return None
+        else:
+            with self._lock:
+                if self._source is source:
+                    self._value = contents
+                    self._timestamp = time.time()
+            return contents
+        finally:
+            self._refreshing = False
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        t = threading.Thread(target = self.refresh, name = 'CatalogRefresh-%s' % self.name)
+        t.setDaemon(True)
+        t.start()
+
+    def get(self):
+        """Returns the cached catalog, or None if it has never been retrieved successfully."""
+        value = self._value
+        if value is None:
+            return self.refresh()
+
+        if self.is_stale():
+            self._refresh_in_background()
+
+        return value
+
+def build_labs_index(labs):
+    """Index the golabz list of labs by the URL of each of their apps."""
+    lab_per_url = {
+        # url: lab_data
+    }
+    for lab in labs:
+        for lab_app in lab.get('lab_apps', []):
+            lab_per_url[lab_app['app_url']] = lab
+
+    return {
+        'labs': labs,
+        'lab_per_url': lab_per_url,
+    }
+
+BOOKING_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+class BookingIndex(object):
+    """
+    Go-Lab booking slots, per app URL. The slots of each app URL are sorted
+    by start time, along with the latest end time seen so far, so the slots
+    taking place at a given time are found with a binary search and a short
+    backwards scan (an augmented interval list). App URLs are sorted too,
+    so all those starting with a given prefix are a contiguous range.
+    """
+
+    def __init__(self, booking_slots):
+        slots_per_url = {
+            # app_url: [ (start_time, end_time, slot_number, ils_url) ]
+        }
+        for slot_number, booking_slot in enumerate(booking_slots):
+            try:
+                start_time = datetime.datetime.strptime(booking_slot.get('start_time', '2000-01-01T00:00:00'), BOOKING_TIME_FORMAT)
+                end_time = datetime.datetime.strptime(booking_slot.get('end_time', '2000-01-01T00:00:00'), BOOKING_TIME_FORMAT)
+            except ValueError:
+                traceback.print_exc()
+                continue
+
+            for lab_app in booking_slot.get('lab_apps', []):
+                lab_url = lab_app.get('app_url', '')
+                slots_per_url.setdefault(lab_url, []).append((start_time, end_time, slot_number, booking_slot.get('ils_url')))
+
+        self._urls = sorted(slots_per_url)
+        self._slots = {
+            # app_url: (start_times, max_end_times, slots)
+        }
+        for lab_url, slots in slots_per_url.iteritems():
+            slots.sort()
+            max_end_times = []
+            max_end_time = None
+            for start_time, end_time, _, _ in slots:
+                if max_end_time is None or end_time > max_end_time:
+                    max_end_time = end_time
+                max_end_times.append(max_end_time)
+            self._slots[lab_url] = ([ slot[0] for slot in slots ], max_end_times, slots)
+
+    def urls_with_prefix(self, prefix):
+        position = bisect.bisect_left(self._urls, prefix)
+        while position < len(self._urls) and self._urls[position].startswith(prefix):
+            yield self._urls[position]
+            position += 1
+
+    def current_slots(self, url_prefix, now = None):
+        """Returns [ (end_time, ils_url) ] of the slots of the apps starting by url_prefix which take place now."""
+        if now is None:
+            now = datetime.datetime.utcnow()
+
+        found = {
+            # slot_number: (end_time, ils_url)
+        }
+        for lab_url in self.urls_with_prefix(url_prefix):
+            start_times, max_end_times, slots = self._slots[lab_url]
+            position = bisect.bisect_left(start_times, now) - 1
+            # No slot before this one ends after now
+            while position >= 0 and max_end_times[position] > now:
+                start_time, end_time, slot_number, ils_url = slots[position]
+                if end_time > now:
+                    found[slot_number] = (end_time, ils_url)
+                position -= 1
+
+        return [ found[slot_number] for slot_number in sorted(found) ]
+
+EMPTY_FAILURE_DATA = {
+    'failing': [],
+    'flash': [],
+    'ssl': [],
+}
+
+CATALOG_TTL = app.config.get('GOLABZ_CATALOG_TTL', 3600)
+
+golabz_labs = CatalogCache('golabz-labs', http_json_source(GOLABZ_LABS_URL), ttl = CATALOG_TTL, builder = build_labs_index)
+composer_status = CatalogCache('composer-status', http_json_source(COMPOSER_STATUS_URL), ttl = CATALOG_TTL)
+
+# Bookings change more often: a booking made less than BOOKING_INDEX_TTL
+# seconds ago may not be enforced yet.
+BOOKING_INDEX_TTL = app.config.get('GOLAB_BOOKING_INDEX_TTL', 60)
+
+golab_bookings = CatalogCache('golab-bookings', http_json_source(BOOKING_URL, headers = {
+                                    'Cache-Control': 'no-cache',
+                                    'Pragma': 'no-cache',
+                                }), ttl = BOOKING_INDEX_TTL, builder = BookingIndex)
+
+def get_lab_per_url():
+    """Returns { app_url : golabz lab } (empty if golabz is not available)."""
+    catalog = golabz_labs.get()
+    if catalog is None:
+        return {}
+    return catalog['lab_per_url']
+
+def get_failure_data():
+    return composer_status.get() or EMPTY_FAILURE_DATA
+
+def get_current_bookings(url_prefix):
+    """
+    Returns [ (end_time, ils_url) ] of the Go-Lab booking slots (in UTC)
+    taking place now for the apps starting by url_prefix, or None if the
+    booking service is not available.
+    """
+    index = golab_bookings.get()
+    if index is None:
+        return None
+    return index.current_slots(url_prefix)
@@ -5,7 +5,8 @@ import hashlib
 import datetime
 import uuid
 from sqlalchemy import sql, ForeignKey
-from sqlalchemy.orm import relation, backref, relationship
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import relation, backref, relationship, joinedload_all
 from flask import url_for
 from flask.ext.login import UserMixin
 
@@ -458,6 +459,14 @@ class PermissionToLt(db.Model, SBBase):
     def __unicode__(self):
         return gettext(u"%(identifier)s: lab %(labname)s to %(lmsname)s", identifier=self.local_identifier, labname=self.laboratory.name, lmsname=self.lt.name)
 
+    @classmethod
+    def find_for_reservation(klass, lt, local_identifier):
+        """The permission with its courses, laboratory and RLMS, in a single query."""
+        return (db.session.query(klass)
+                    .options(joinedload_all('course_permissions.course'), joinedload_all('laboratory.rlms'))
+                    .filter_by(lt = lt, local_identifier = local_identifier)
+                    .first())
+
 ########################################################
 # 
 #     PermissionToLtUser
@@ -485,6 +494,14 @@ class PermissionToLtUser(db.Model, SBBase):
         self.key               = key
         self.secret            = secret
 
+    @classmethod
+    def find_for_reservation(klass, key):
+        """The permission with its LT, laboratory and RLMS, in a single query."""
+        return (db.session.query(klass)
+                    .options(joinedload_all('permission_to_lt.laboratory.rlms'), joinedload_all('permission_to_lt.lt'))
+                    .filter_by(key = key)
+                    .first())
+
 ########################################################
 # 
 #     Permission To Course
@@ -571,10 +588,10 @@ class EmbedApplication(db.Model):
             creation = datetime.datetime.utcnow()
         if last_update is None:
             last_update = datetime.datetime.utcnow()
+        # Unique by the constraint (see add_with_unique_identifier)
+        self.generated_identifier = identifier is None
         if identifier is None:
             identifier = unicode(uuid.uuid4())
-            while EmbedApplication.query.filter_by(identifier=identifier).first() is not None:
-                identifier = unicode(uuid.uuid4())
         self.url = url
         self.name = name
         self.owner = owner
@@ -739,10 +756,10 @@ class ManualApplication(db.Model):
     owner = relation("GoLabOAuthUser", backref="manual_apps")
 
     def __init__(self, name, owner, identifier):
+        # Unique by the constraint (see add_with_unique_identifier)
+        self.generated_identifier = identifier is None
         if identifier is None:
             identifier = unicode(uuid.uuid4())
-            while EmbedApplication.query.filter_by(identifier=identifier).first() is not None:
-                identifier = unicode(uuid.uuid4())
 
         self.identifier = identifier
         self.name = name
@@ -750,6 +767,33 @@ class ManualApplication(db.Model):
         self.creation = datetime.datetime.utcnow()
         self.last_update = datetime.datetime.utcnow()
 
+def add_with_unique_identifier(obj, attempts = 3):
+    """
+    Add and commit obj (an EmbedApplication or ManualApplication). The
+    identifier is not checked in advance: if it was generated by the
+    constructor and it is already taken, it is retried with a new random
+    identifier. Any other IntegrityError (including an identifier provided
+    by the caller which is already taken) is raised.
+
+    On failure the session is rolled back, so any other pending change of
+    the caller is discarded too.
+    """
+    klass = type(obj)
+    for attempt in xrange(attempts):
+        db.session.add(obj)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            if not getattr(obj, 'generated_identifier', False) or attempt + 1 == attempts:
+                raise
+            if db.session.query(klass.id).filter(klass.identifier == obj.identifier).first() is None:
+                # Something else failed
+                raise
+            obj.identifier = unicode(uuid.uuid4())
+        else:
+            return obj
+
 class AllowedHost(db.Model):
     __tablename__ = 'AllowedHosts'
     __table_args__ = (TABLE_KWARGS)
@@ -787,38 +831,40 @@ class HttpsUnsupportedUrl(db.Model):
 
 class UseLog(db.Model):
     __tablename__ = 'UseLogs'
-    __table_args__ = (TABLE_KWARGS)
+    # Only the indexes used by the stats views, the exports and the GeoIP
+    # enrichment: every other index would be updated on each insert.
+    __table_args__ = (db.Index('ix_UseLogs_year_month_url', 'year', 'month', 'url'), TABLE_KWARGS)
 
     id = db.Column(db.Integer, primary_key=True)
-    datetime = db.Column(db.DateTime, index = True, nullable = False)
+    datetime = db.Column(db.DateTime, nullable = False)
     date = db.Column(db.Date, index = True, nullable = False)
-    day_of_week = db.Column(db.Integer, index=True, nullable=False)  # 0..6 (datetime.weekday())
-    hour_of_day = db.Column(db.Integer, index=True, nullable=False) # 0..23
-    year = db.Column(db.Integer, index=True, nullable=False) # 2017
-    month = db.Column(db.Integer, index=True, nullable=False) # 1..12
-
-    local_timezone = db.Column(db.Integer, index=True, nullable=False)
-    local_datetime = db.Column(db.DateTime, index=True, nullable=False)
-    local_date = db.Column(db.Date, index = True, nullable = False)
-    local_day_of_week = db.Column(db.Integer, index=True, nullable=False)  # 0..6 (datetime.weekday())
-    local_hour_of_day = db.Column(db.Integer, index=True, nullable=False) # 0..23
-    local_year = db.Column(db.Integer, index=True, nullable=False) # 2017
-    local_month = db.Column(db.Integer, index=True, nullable=False) # 1..12
+    day_of_week = db.Column(db.Integer, nullable=False)  # 0..6 (datetime.weekday())
+    hour_of_day = db.Column(db.Integer, nullable=False) # 0..23
+    year = db.Column(db.Integer, nullable=False) # 2017
+    month = db.Column(db.Integer, nullable=False) # 1..12
+
+    local_timezone = db.Column(db.Integer, nullable=False)
+    local_datetime = db.Column(db.DateTime, nullable=False)
+    local_date = db.Column(db.Date, nullable = False)
+    local_day_of_week = db.Column(db.Integer, nullable=False)  # 0..6 (datetime.weekday())
+    local_hour_of_day = db.Column(db.Integer, nullable=False) # 0..23
+    local_year = db.Column(db.Integer, nullable=False) # 2017
+    local_month = db.Column(db.Integer, nullable=False) # 1..12
 
     url = db.Column(db.Unicode(255), index = True)
-    ip_address = db.Column(db.Unicode(100), index = True)
-    web_browser = db.Column(db.Unicode(255), index = True)
-    browser_platform = db.Column(db.Unicode(100), index=True)
-    browser_name = db.Column(db.Unicode(100), index=True)
-    browser_version = db.Column(db.Unicode(100), index=True)
-    browser_language = db.Column(db.Unicode(100), index=True)
-    first_language = db.Column(db.Unicode(10), index=True)
-    second_language = db.Column(db.Unicode(10), index=True)
-    third_language = db.Column(db.Unicode(10), index=True)
-    all_languages = db.Column(db.Unicode(100), index=True)
+    ip_address = db.Column(db.Unicode(100))
+    web_browser = db.Column(db.Unicode(255))
+    browser_platform = db.Column(db.Unicode(100))
+    browser_name = db.Column(db.Unicode(100))
+    browser_version = db.Column(db.Unicode(100))
+    browser_language = db.Column(db.Unicode(100))
+    first_language = db.Column(db.Unicode(10))
+    second_language = db.Column(db.Unicode(10))
+    third_language = db.Column(db.Unicode(10))
+    all_languages = db.Column(db.Unicode(100))
     city = db.Column(db.Unicode(255), index = True)
     country = db.Column(db.Unicode(255), index = True)
-    hostname = db.Column(db.Unicode(255), index = True)
+    hostname = db.Column(db.Unicode(255))
     
     def __init__(self, url, ip_address, web_browser, user_agent, timezone_minutes, lang_header, dtime = None):
         if dtime is None:
@@ -891,5 +937,37 @@ class LocationCache(db.Model):
         self.country = country
         self.most_specific_subdivision = most_specific_subdivision
 
+class RepositoryMetadata(db.Model):
+    """
+    Metadata of the repository provided by a public laboratory or a public
+    RLMS (source), in both JSON and XML structures (serialized as JSON).
+    modified only changes when the contents change; deleted_ids are the ids
+    of the resources that this source stopped providing, and when
+    ([ [id, 'YYYY-MM-DDTHH:MM:SS'] ]). The URLs of the resources are
+    relative to the host.
+    """
+    __tablename__ = 'RepositoryMetadata'
+    __table_args__ = (db.UniqueConstraint('source'), TABLE_KWARGS)
+
+    id = db.Column(db.Integer, primary_key=True)
+    source = db.Column(db.Unicode(100), nullable=False)
+    fingerprint = db.Column(db.Unicode(40))
+    content_hash = db.Column(db.Unicode(40))
+    resource_ids = db.Column(db.UnicodeText, nullable=False, default=u'[]')
+    deleted_ids = db.Column(db.UnicodeText, nullable=False, default=u'[]')
+    json_resources = db.Column(db.UnicodeText(64 * 1024 * 1024), nullable=False, default=u'[]')
+    xml_resources = db.Column(db.UnicodeText(64 * 1024 * 1024), nullable=False, default=u'[]')
+    built = db.Column(db.DateTime, nullable=False)
+    modified = db.Column(db.DateTime, index=True, nullable=False)
+
+    def __init__(self, source, built, modified):
+        self.source = source
+        self.built = built
+        self.modified = modified
+        self.resource_ids = u'[]'
+        self.deleted_ids = u'[]'
+        self.json_resources = u'[]'
+        self.xml_resources = u'[]'
+
 
 from labmanager.rlms import get_manager_class
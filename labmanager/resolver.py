@@ -0,0 +1,72 @@
+# -*-*- encoding: utf-8 -*-*-
+#
+# gateway4labs is free software: you can redistribute it and/or modify
+# it under the terms of the BSD 2-Clause License
+# gateway4labs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+
+"""
+  Resolution of the identifiers used in the widget and reservation URLs:
+  a lab name is either the public identifier of a laboratory, or the local
+  identifier of a permission of an institution (LearningTool).
+
+  resolve_lab() answers both with a single joined query.
+"""
+
+from sqlalchemy import sql
+
+from labmanager.db import db
+from labmanager.models import Laboratory, RLMS, LearningTool, PermissionToLt
+
+class ResolvedLab(object):
+    """
+    institution:        LearningTool named institution_id (if provided).
+    public_laboratory:  publicly available laboratory with that public identifier.
+    permission:         permission of the institution with that local identifier
+                        (an accessible one if there is any).
+    laboratory, rlms:   public_laboratory if any, or the one of the permission.
+    """
+    def __init__(self, institution = None, public_laboratory = None, permission = None):
+        self.institution = institution
+        self.public_laboratory = public_laboratory
+        self.permission = permission
+        self.laboratory = public_laboratory or (permission.laboratory if permission is not None else None)
+        self.rlms = self.laboratory.rlms if self.laboratory is not None else None
+
+def _query(lab_name, institution_id):
+    """
+    Laboratories (with their RLMS) which are either public with that
+    identifier or linked to a permission of the institution with that local
+    identifier; along with the institution and the permission.
+    """
+    if institution_id is None:
+        query = db.session.query(Laboratory, RLMS).join(RLMS, Laboratory.rlms_id == RLMS.id)
+        query = query.filter(Laboratory.public_identifier == lab_name, Laboratory.publicly_available == True)
+        return [ (laboratory, rlms, None, None) for laboratory, rlms in query.all() ]
+
+    query = db.session.query(Laboratory, RLMS, LearningTool, PermissionToLt).join(RLMS, Laboratory.rlms_id == RLMS.id)
+    query = query.outerjoin(LearningTool, LearningTool.name == institution_id)
+    query = query.outerjoin(PermissionToLt, sql.and_(PermissionToLt.laboratory_id == Laboratory.id,
+                                                     PermissionToLt.lt_id == LearningTool.id,
+                                                     PermissionToLt.local_identifier == lab_name))
+    query = query.filter(sql.or_(sql.and_(Laboratory.public_identifier == lab_name, Laboratory.publicly_available == True), PermissionToLt.id != None))
+    return query.order_by(PermissionToLt.accessible.desc(), PermissionToLt.id).all()
+
+def resolve_lab(lab_name, institution_id = None):
+    """Return the ResolvedLab for a public identifier, or for the local identifier of an institution."""
+    institution = public_laboratory = permission = None
+    for laboratory, rlms, lt, lt_permission in _query(lab_name, institution_id):
+        if lt is not None and institution is None:
+            institution = lt
+        if public_laboratory is None and laboratory.publicly_available and laboratory.public_identifier == lab_name:
+            public_laboratory = laboratory
+        if lt_permission is not None and permission is None:
+            # Ordered: accessible permissions first
+            permission = lt_permission
+
+    if institution is None and institution_id is not None and public_laboratory is None and permission is None:
+        # Nothing found for this institution, but it may still exist
+        institution = db.session.query(LearningTool).filter_by(name = institution_id).first()
+
+    return ResolvedLab(institution, public_laboratory, permission)
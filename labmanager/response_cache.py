@@ -0,0 +1,131 @@
+# -*-*- encoding: utf-8 -*-*-
+#
+# gateway4labs is free software: you can redistribute it and/or modify
+# it under the terms of the BSD 2-Clause License
+# gateway4labs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+
+"""
+  In-process cache of rendered responses (widget XML, translation bundles),
+  served with a strong ETag and Cache-Control headers so Shindig / Graasp
+  can revalidate them with a 304 instead of downloading them again.
+
+  Entries are keyed by the URL of the request (the responses include
+  absolute URLs, so the scheme and host are part of the key) plus the
+  current version of the cache of the RLMS involved (see
+  rlms_cache_version), so whenever the RLMS cache entries change, a new
+  response is rendered.
+"""
+
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+from flask import request, Response, has_request_context
+from sqlalchemy import func, event
+
+from labmanager.db import db
+from labmanager.models import RLMSCache
+from labmanager.application import app
+
+class ResponseCache(object):
+    """Bounded (least recently used) map of key to (etag, body, mimetype), valid for ttl seconds."""
+
+    def __init__(self, ttl = 300, max_entries = 2000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+
+            timestamp, etag, body, mimetype = entry
+            if time.time() - timestamp > self.ttl:
+                return None
+
+            # Move it to the end (most recently used)
+            self._entries[key] = entry
+            return etag, body, mimetype
+
+    def set(self, key, body, mimetype):
+        etag = hashlib.sha1(body).hexdigest()
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time(), etag, body, mimetype)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last = False)
+        return etag, body, mimetype
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+RESPONSE_CACHE_TTL = app.config.get('RESPONSE_CACHE_TTL', 300)
+
+RESPONSES = ResponseCache(ttl = RESPONSE_CACHE_TTL, max_entries = app.config.get('RESPONSE_CACHE_MAX_ENTRIES', 2000))
+
+def rlms_cache_version(rlms_id):
+    """
+    Changes whenever an entry of the cache of that RLMS instance is added,
+    replaced or removed. It is calculated only once per request, unless
+    the request itself changes the cache of that RLMS.
+    """
+    versions = None
+    if has_request_context():
+        versions = getattr(request, '_rlms_cache_versions', None)
+        if versions is None:
+            versions = request._rlms_cache_versions = {}
+        if rlms_id in versions:
+            return versions[rlms_id]
+
+    latest, count = db.session.query(func.max(RLMSCache.datetime), func.count(RLMSCache.id)).filter(RLMSCache.rlms_id == rlms_id).first()
+    if versions is not None:
+        versions[rlms_id] = latest, count
+    return latest, count
+
+def _rlms_cache_changed(mapper, connection, target):
+    if has_request_context():
+        versions = getattr(request, '_rlms_cache_versions', None)
+        if versions is not None:
+            versions.pop(target.rlms_id, None)
+
+for _event_name in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(RLMSCache, _event_name, _rlms_cache_changed)
+
+def _to_response(entry):
+    etag, body, mimetype = entry
+    response = Response(body, mimetype = mimetype)
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = RESPONSE_CACHE_TTL
+    # Returns a 304 if the client already has this version
+    return response.make_conditional(request)
+
+def cached_response(rlms_db, dependencies, render):
+    """
+    Return the cached response for this request, or call render() and cache
+    its result. render() must return a Response; anything else (e.g., an
+    error message) is returned as it is, without caching it. dependencies is
+    a tuple with whatever else (besides the URL and the RLMS cache) the
+    rendered response depends on.
+    """
+    def current_key():
+        version = rlms_cache_version(rlms_db.id) if rlms_db is not None else None
+        return (request.url_root, request.path, tuple(sorted(request.args.items(multi = True))), version) + tuple(dependencies)
+
+    entry = RESPONSES.get(current_key())
+    if entry is None:
+        response = render()
+        if not isinstance(response, Response) or response.status_code != 200:
+            return response
+
+        # The version is only queried again if rendering changed the RLMS cache
+        entry = RESPONSES.set(current_key(), response.data, response.mimetype)
+
+    return _to_response(entry)
@@ -10,15 +10,19 @@ import os
 import sys
 import time
 import gzip
+import hashlib
 import threading
 import datetime
 import traceback
 import requests
+from collections import OrderedDict
 
 from flask import url_for
 
+from sqlalchemy import sql, event
+
 from labmanager.db import db
-from labmanager.models import RLMS as dbRLMS, Laboratory as dbLaboratory, UseLog
+from labmanager.models import RLMS as dbRLMS, Laboratory as dbLaboratory, UseLog, LocationCache
 from labmanager.application import app
 from .base import register_blueprint, BaseRLMS, BaseFormCreator, Capabilities, Versions
 from .caches import GlobalCache, VersionCache, InstanceCache, EmptyCache, get_cached_session, CacheDisabler, clean_cache
@@ -170,64 +174,162 @@ def _debug(msg):
     sys.stderr.flush()
 
 
+GEOIP_CHUNK_SIZE = app.config.get('GEOIP_CHUNK_SIZE', 1000)
+GEOIP_CACHE_DAYS = app.config.get('GEOIP_CACHE_DAYS', 30)
+
+_GEOIP_PROGRESS = {
+    # Highest UseLog.id already processed by this process, so rows that
+    # could not be resolved are not retried every hour
+    'last_id': 0,
+}
+
+def _cached_locations(ip_addresses):
+    """Returns { ip_address: (country, city) } for the IP addresses recently stored in the LocationCache."""
+    oldest = datetime.datetime.utcnow() - datetime.timedelta(days = GEOIP_CACHE_DAYS)
+    locations = {}
+    query = db.session.query(LocationCache.pack, LocationCache.country, LocationCache.city)
+    for pack, country, city in query.filter(LocationCache.pack.in_(ip_addresses), LocationCache.lookup_time >= oldest):
+        locations[pack] = (country, city)
+    return locations
+
+def enrich_use_logs(lookup, since_id = 0, chunk_size = GEOIP_CHUNK_SIZE):
+    """
+    Fill the country and city of the UseLogs lacking any of them, walking
+    them by id in chunks of chunk_size and committing after each one, so
+    the job can be interrupted and resumed at any point. lookup(ip_address)
+    returns (country, city) (any of them may be None), and is called once
+    per IP address: results are memoized here and in the LocationCache.
+
+    Returns (last processed id, countries, cities, errors).
+    """
+    memo = {
+        # ip_address: (country, city)
+    }
+    countries = cities = errors = 0
+    last_id = since_id
+
+    while True:
+        rows = db.session.query(UseLog.id, UseLog.ip_address, UseLog.country, UseLog.city).filter(
+                        UseLog.id > last_id,
+                        sql.or_(UseLog.country == None, UseLog.city == None)
+                    ).order_by(UseLog.id).limit(chunk_size).all()
+        if not rows:
+            break
+
+        last_id = rows[-1][0]
+
+        pending = set([ ip_address for _, ip_address, _, _ in rows if ip_address and ip_address not in memo ])
+        if pending:
+            memo.update(_cached_locations(list(pending)))
+
+        now = datetime.datetime.utcnow()
+        for ip_address in pending:
+            if ip_address in memo:
+                continue
+            try:
+                country, city = lookup(ip_address)
+            except Exception:
+                errors += 1
+                country, city = None, None
+            memo[ip_address] = (country, city)
+            db.session.add(LocationCache(pack = ip_address, lookup_time = now, hostname = None, city = city, country = country))
+
+        # One UPDATE per different location in the chunk
+        ids_per_location = {
+            # (country, city): [ids]
+        }
+        for log_id, ip_address, current_country, current_city in rows:
+            country, city = memo.get(ip_address, (None, None))
+            country = country if current_country is None else None
+            city = city if current_city is None else None
+            if country is None and city is None:
+                continue
+            if country is not None:
+                countries += 1
+            if city is not None:
+                cities += 1
+            ids_per_location.setdefault((country, city), []).append(log_id)
+
+        table = UseLog.__table__
+        for (country, city), ids in ids_per_location.iteritems():
+            values = {}
+            if country is not None:
+                values['country'] = country
+            if city is not None:
+                values['city'] = city
+            db.session.execute(table.update().where(table.c.id.in_(ids)).values(**values))
+
+        db.session.commit()
+
+    return last_id, countries, cities, errors
+
 def fill_geoip():
     try:
         from geoip2.database import Reader as GeoIP2Reader
     except ImportError:
         pass
     else:
-        COUNTRY_FILENAME = 'GeoLite2-Country.mmdb'
+        # The City database also contains the country, so a single lookup is enough
         CITY_FILENAME = 'GeoLite2-City.mmdb'
 
-        for filename in [COUNTRY_FILENAME, CITY_FILENAME]:
-            if not os.path.exists(filename):
-                r = requests.get("http://geolite.maxmind.com/download/geoip/database/%s.gz" % filename)
-                open('%s.gz' % filename,'wb').write(r.content)
-                uncompressed = gzip.open('%s.gz' % filename).read()
-                open(filename, 'wb').write(uncompressed)
+        if not os.path.exists(CITY_FILENAME):
+            r = requests.get("http://geolite.maxmind.com/download/geoip/database/%s.gz" % CITY_FILENAME)
+            open('%s.gz' % CITY_FILENAME,'wb').write(r.content)
+            uncompressed = gzip.open('%s.gz' % CITY_FILENAME).read()
+            open(CITY_FILENAME, 'wb').write(uncompressed)
 
-        from labmanager import app
+        city_reader = GeoIP2Reader(CITY_FILENAME)
+
+        def lookup(ip_address):
+            try:
+                results = city_reader.city(ip_address)
+            except Exception:
+                # Not found or invalid address: cached as unknown
+                return None, None
+
+            country = results.country.iso_code if results.country else None
+            city = results.city.name if results.city else None
+            return country, city
 
+        from labmanager import app
 
         with app.app_context():
-            country_reader = GeoIP2Reader(COUNTRY_FILENAME)
-            city_reader = GeoIP2Reader(CITY_FILENAME)
+            try:
+                last_id, countries, cities, errors = enrich_use_logs(lookup, since_id = _GEOIP_PROGRESS['last_id'])
+                _GEOIP_PROGRESS['last_id'] = last_id
+            finally:
+                db.session.remove()
 
-            countries = 0
-            errors = 0
-            cities = 0
-            print db.session.query(UseLog).filter(UseLog.country.is_(None)).count()
-            for log in db.session.query(UseLog).filter(UseLog.country == None).all():
-                ip_address = log.ip_address
+            print "geoip run {} countries, {} cities, {} errors".format(countries, cities, errors)
 
-                try:
-                    country_results = country_reader.country(ip_address)
-                except:
-                    errors += 1
-                    continue
 
-                if country_results:
-                    if country_results.country and country_results.country.iso_code:
-                        log.country = country_results.country.iso_code
-                        countries += 1
+def refresh_snapshots():
+    from labmanager.rlms.snapshots import refresh_widget_snapshots
+    from labmanager import app
 
-            db.session.commit()
+    with app.app_context():
+        try:
+            refresh_widget_snapshots()
+        except Exception:
+            traceback.print_exc()
+        finally:
             db.session.remove()
 
-            for log in db.session.query(UseLog).filter(UseLog.city == None).all():
-                ip_address = log.ip_address
-                try: 
-                    city_results = city_reader.city(ip_address)
-                except:
-                    errors += 1
-                    continue
+def archive_use_logs():
+    from labmanager.archive import apply_retention, get_retention_months
 
-                if city_results and city_results.city and city_results.city.name:
-                    log.city = city_results.city.name
-                    cities += 1
-            db.session.commit()
+    if get_retention_months() is None:
+        return
 
-            print "geoip run {} countries, {} cities, {} errors".format(countries, cities, errors)
+    from labmanager import app
+
+    with app.app_context():
+        try:
+            apply_retention()
+        except Exception:
+            traceback.print_exc()
+        finally:
+            db.session.remove()
 
 
 class TaskRunner(object):
@@ -299,9 +401,11 @@ class TaskRunner(object):
         before = self._now()
         if before.hour == initial.hour and before.minute == initial.minute:
             clean_cache()
+            archive_use_logs()
 
         if before.minute == initial.minute:
             fill_geoip()
+            refresh_snapshots()
 
         future = before + datetime.timedelta(minutes = 1)
         future = future.replace(second = 0, microsecond = 0)
@@ -355,7 +459,7 @@ def get_all_rlms():
 
 
 def is_supported(rlms_type, rlms_version):
-    _, versions, _ = _RLMSs.get(rlms_type, (None, []))
+    _, versions, _ = _RLMSs.get(rlms_type, (None, [], None))
     return rlms_version in versions
 
 def _get_module(rlms_type, rlms_version):
@@ -390,100 +494,245 @@ def get_manager_class(rlms_type, rlms_version, current_rlms_id = None):
         record.per_thread.current_rlms_id = current_rlms_id
     return module.RLMS
 
-def find_smartgateway_link(url, return_url):
-    rlms_by_id = {}
-    for db_rlms in db.session.query(dbRLMS).filter_by(publicly_available=True).all():
-        rlms = db_rlms.get_rlms()
-        rlms_by_id[db_rlms.id] = rlms
-        if Capabilities.URL_FINDER in rlms.get_capabilities():
-            base_urls = rlms.get_base_urls() or []
-            for base_url in base_urls:
-                if url.startswith(base_url):
-                    lab = rlms.get_lab_by_url(url)
-                    if lab is not None:
-                        return url_for('bookmarklet.public_rlms', rlms_id=db_rlms.public_identifier, lab_name=lab.laboratory_id, url=return_url)
-
-    for db_rlms in db.session.query(dbRLMS).filter_by(publicly_available=False).all():
-        rlms = db_rlms.get_rlms()
-        rlms_by_id[db_rlms.id] = rlms
-        if Capabilities.URL_FINDER in rlms.get_capabilities():
-            base_urls = rlms.get_base_urls() or []
-            for base_url in base_urls:
-                if url.startswith(base_url):
-                    lab = rlms.get_lab_by_url(url)
-                    if lab is not None:
-                        db_lab = db.session.query(dbLaboratory).filter_by(rlms=db_rlms, laboratory_id=lab.laboratory_id, publicly_available=True).first()
-                        if db_lab is not None:
-                            return url_for('bookmarklet.public_lab', public_identifier=db_lab.public_identifier, url=return_url)
-    return None
+#
+# The capabilities of an RLMS instance do not change unless its configuration
+# (or the plug-in) does, so they are asked only once per process. Call
+# refresh_capabilities to ask again.
+#
+_CAPABILITIES = {
+    # (rlms_id, kind, version, configuration digest): [ capability1, capability2 ]
+}
+_CAPABILITIES_LOCK = threading.Lock()
+
+def get_capabilities(db_rlms, rlms = None):
+    """Capabilities of the RLMS instance db_rlms. rlms is the plug-in object, if already created."""
+    key = (db_rlms.id, db_rlms.kind, db_rlms.version, hashlib.sha1((db_rlms.configuration or u'').encode('utf8')).hexdigest())
+    capabilities = _CAPABILITIES.get(key)
+    if capabilities is None:
+        if rlms is None:
+            rlms = get_manager_class(db_rlms.kind, db_rlms.version, db_rlms.id)(db_rlms.configuration)
+        capabilities = list(rlms.get_capabilities())
+        with _CAPABILITIES_LOCK:
+            _CAPABILITIES[key] = capabilities
+    return capabilities
+
+def refresh_capabilities(rlms_id = None):
+    """Forget the capabilities of that RLMS instance (or of all of them)."""
+    with _CAPABILITIES_LOCK:
+        if rlms_id is None:
+            _CAPABILITIES.clear()
+        else:
+            for key in list(_CAPABILITIES):
+                if key[0] == rlms_id:
+                    _CAPABILITIES.pop(key, None)
 
-def _get_widgets(rlms, laboratory_id):
-    if Capabilities.WIDGET in rlms.get_capabilities():
+def get_widgets(db_rlms, rlms, laboratory_id):
+    """Widgets of the laboratory, or a single one if the RLMS does not support widgets."""
+    if Capabilities.WIDGET in get_capabilities(db_rlms, rlms):
         return rlms.list_widgets(laboratory_id)
 
     return [ { 'name' : 'lab', 'description' : 'Main view of the laboratory' } ]
 
+#
+# Smart gateway: given the URL of a laboratory (e.g., of its web page),
+# find which RLMS provides it. Only the RLMSs supporting URL_FINDER are
+# asked, and only those with a base URL which is a prefix of the URL.
+#
 
-def find_smartgateway_opensocial_link(url):
-    rlms_by_id = {}
-    for db_rlms in db.session.query(dbRLMS).filter_by(publicly_available=True).all():
-        rlms = db_rlms.get_rlms()
-        rlms_by_id[db_rlms.id] = rlms
-        if Capabilities.URL_FINDER in rlms.get_capabilities():
-            base_urls = rlms.get_base_urls() or []
-            for base_url in base_urls:
-                if url.startswith(base_url):
-                    lab = rlms.get_lab_by_url(url)
-                    if lab is not None:
-                        for widget in _get_widgets(rlms, lab.laboratory_id):
-                            # First widget wins...
-                            return url_for('opensocial.public_rlms_widget_xml', rlms_identifier=db_rlms.public_identifier, lab_name=lab.laboratory_id, widget_name=widget['name'], _external=True)
-
-    for db_rlms in db.session.query(dbRLMS).filter_by(publicly_available=False).all():
+class UrlPrefixTrie(object):
+    """Maps URL prefixes to values. lookup(url) returns the values of all the prefixes of url."""
+
+    def __init__(self):
+        self._root = {}
+
+    def add(self, prefix, value):
+        node = self._root
+        for character in prefix:
+            node = node.setdefault(character, {})
+        node.setdefault(None, []).append(value)
+
+    def lookup(self, url):
+        node = self._root
+        values = list(node.get(None, []))
+        for character in url:
+            node = node.get(character)
+            if node is None:
+                break
+            values.extend(node.get(None, []))
+        return values
+
+BASE_URLS_TTL = app.config.get('SMARTGATEWAY_BASE_URLS_TTL', 600)
+
+_BASE_URLS = {
+    'trie' : None,
+    'timestamp' : 0,
+}
+_BASE_URLS_LOCK = threading.Lock()
+
+def _build_base_urls_trie():
+    trie = UrlPrefixTrie()
+    # Public RLMSs first
+    for position, db_rlms in enumerate(db.session.query(dbRLMS).order_by(dbRLMS.publicly_available.desc(), dbRLMS.id).all()):
+        if not is_supported(db_rlms.kind, db_rlms.version):
+            continue
+
+        try:
+            if Capabilities.URL_FINDER not in get_capabilities(db_rlms):
+                continue
+            base_urls = db_rlms.get_rlms().get_base_urls() or []
+        except Exception:
+            traceback.print_exc()
+            continue
+
+        for base_url in set(base_urls):
+            trie.add(base_url, (position, db_rlms.id))
+    return trie
+
+def get_base_urls_trie():
+    """Trie of the base URLs of all the RLMSs supporting URL_FINDER, rebuilt every SMARTGATEWAY_BASE_URLS_TTL seconds."""
+    with _BASE_URLS_LOCK:
+        trie = _BASE_URLS['trie']
+        timestamp = _BASE_URLS['timestamp']
+
+    if trie is None or time.time() - timestamp > BASE_URLS_TTL:
+        trie = _build_base_urls_trie()
+        with _BASE_URLS_LOCK:
+            _BASE_URLS['trie'] = trie
+            _BASE_URLS['timestamp'] = time.time()
+    return trie
+
+def refresh_base_urls(*args, **kwargs):
+    """Rebuild the trie next time it is used (e.g., when an RLMS is added or changed)."""
+    with _BASE_URLS_LOCK:
+        _BASE_URLS['trie'] = None
+
+class LabsByUrl(object):
+    """
+    Bounded (least recently used) map of (rlms_id, url) to the laboratory
+    identifier returned by get_lab_by_url, or None if it returned nothing.
+    Found laboratories are kept for ttl seconds, and not found ones for
+    not_found_ttl seconds.
+    """
+
+    def __init__(self, ttl = 3600, not_found_ttl = 300, max_entries = 5000):
+        self.ttl = ttl
+        self.not_found_ttl = not_found_ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, rlms_id, url):
+        """Returns (known, laboratory_id)."""
+        key = (rlms_id, url)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return False, None
+
+            timestamp, laboratory_id = entry
+            ttl = self.ttl if laboratory_id is not None else self.not_found_ttl
+            if time.time() - timestamp > ttl:
+                return False, None
+
+            # Move it to the end (most recently used)
+            self._entries[key] = entry
+            return True, laboratory_id
+
+    def set(self, rlms_id, url, laboratory_id):
+        key = (rlms_id, url)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time(), laboratory_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last = False)
+
+    def forget(self, rlms_id = None):
+        with self._lock:
+            if rlms_id is None:
+                self._entries.clear()
+            else:
+                for key in [ key for key in self._entries if key[0] == rlms_id ]:
+                    self._entries.pop(key, None)
+
+LABS_BY_URL = LabsByUrl(ttl = app.config.get('SMARTGATEWAY_URL_TTL', 3600),
+                        not_found_ttl = app.config.get('SMARTGATEWAY_URL_NOT_FOUND_TTL', 300),
+                        max_entries = app.config.get('SMARTGATEWAY_URL_MAX_ENTRIES', 5000))
+
+def _rlms_changed(mapper, connection, target):
+    refresh_base_urls()
+    # The plug-in may now find other laboratories
+    LABS_BY_URL.forget(target.id)
+
+for _event_name in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(dbRLMS, _event_name, _rlms_changed)
+
+def _get_laboratory_id_by_url(db_rlms, rlms, url):
+    known, laboratory_id = LABS_BY_URL.get(db_rlms.id, url)
+    if not known:
+        lab = rlms.get_lab_by_url(url)
+        laboratory_id = lab.laboratory_id if lab is not None else None
+        LABS_BY_URL.set(db_rlms.id, url, laboratory_id)
+    return laboratory_id
+
+def _iter_labs_by_url(url):
+    """Yields (db_rlms, rlms, laboratory_id) for each RLMS which finds a laboratory for that url, public RLMSs first."""
+    positions = {
+        # rlms_id: position
+    }
+    for position, rlms_id in get_base_urls_trie().lookup(url):
+        positions[rlms_id] = min(position, positions.get(rlms_id, position))
+
+    if not positions:
+        return
+
+    candidates = db.session.query(dbRLMS).filter(dbRLMS.id.in_(list(positions))).all()
+    # The trie may be older than the publicly_available flags
+    candidates.sort(key = lambda db_rlms: (not db_rlms.publicly_available, positions[db_rlms.id]))
+    for db_rlms in candidates:
         rlms = db_rlms.get_rlms()
-        rlms_by_id[db_rlms.id] = rlms
-        if Capabilities.URL_FINDER in rlms.get_capabilities():
-            base_urls = rlms.get_base_urls() or []
-            for base_url in base_urls:
-                if url.startswith(base_url):
-                    lab = rlms.get_lab_by_url(url)
-                    if lab is not None:
-                        db_lab = db.session.query(dbLaboratory).filter_by(rlms=db_rlms, laboratory_id=lab.laboratory_id, publicly_available=True).first()
-                        if db_lab is not None:
-                            for widget in _get_widgets(rlms, lab.laboratory_id):
-                                # First widget wins...
-                                return url_for('opensocial.public_widget_xml', lab_name=db_lab.public_identifier, widget_name=widget['name'], _external=True)
+        laboratory_id = _get_laboratory_id_by_url(db_rlms, rlms, url)
+        if laboratory_id is not None:
+            yield db_rlms, rlms, laboratory_id
+
+def _public_laboratory(db_rlms, laboratory_id):
+    return db.session.query(dbLaboratory).filter_by(rlms=db_rlms, laboratory_id=laboratory_id, publicly_available=True).first()
+
+def find_smartgateway_link(url, return_url):
+    for db_rlms, rlms, laboratory_id in _iter_labs_by_url(url):
+        if db_rlms.publicly_available:
+            return url_for('bookmarklet.public_rlms', rlms_id=db_rlms.public_identifier, lab_name=laboratory_id, url=return_url)
+
+        db_lab = _public_laboratory(db_rlms, laboratory_id)
+        if db_lab is not None:
+            return url_for('bookmarklet.public_lab', public_identifier=db_lab.public_identifier, url=return_url)
+    return None
+
+def find_smartgateway_opensocial_link(url):
+    for db_rlms, rlms, laboratory_id in _iter_labs_by_url(url):
+        if db_rlms.publicly_available:
+            for widget in get_widgets(db_rlms, rlms, laboratory_id):
+                # First widget wins...
+                return url_for('opensocial.public_rlms_widget_xml', rlms_identifier=db_rlms.public_identifier, lab_name=laboratory_id, widget_name=widget['name'], _external=True)
+        else:
+            db_lab = _public_laboratory(db_rlms, laboratory_id)
+            if db_lab is not None:
+                for widget in get_widgets(db_rlms, rlms, laboratory_id):
+                    # First widget wins...
+                    return url_for('opensocial.public_widget_xml', lab_name=db_lab.public_identifier, widget_name=widget['name'], _external=True)
     return None
 
 def find_smartgateway_html_link(url):
-    rlms_by_id = {}
-    for db_rlms in db.session.query(dbRLMS).filter_by(publicly_available=True).all():
-        rlms = db_rlms.get_rlms()
-        rlms_by_id[db_rlms.id] = rlms
-        if Capabilities.URL_FINDER in rlms.get_capabilities():
-            base_urls = rlms.get_base_urls() or []
-            for base_url in base_urls:
-                if url.startswith(base_url):
-                    lab = rlms.get_lab_by_url(url)
-                    if lab is not None:
-                        for widget in _get_widgets(rlms, lab.laboratory_id):
-                            # First widget wins...
-                            return url_for('opensocial.public_rlms_widget_html', rlms_identifier=db_rlms.public_identifier, lab_name=lab.laboratory_id, widget_name=widget['name'], _external=True)
-
-    for db_rlms in db.session.query(dbRLMS).filter_by(publicly_available=False).all():
-        rlms = db_rlms.get_rlms()
-        rlms_by_id[db_rlms.id] = rlms
-        if Capabilities.URL_FINDER in rlms.get_capabilities():
-            base_urls = rlms.get_base_urls() or []
-            for base_url in base_urls:
-                if url.startswith(base_url):
-                    lab = rlms.get_lab_by_url(url)
-                    if lab is not None:
-                        db_lab = db.session.query(dbLaboratory).filter_by(rlms=db_rlms, laboratory_id=lab.laboratory_id, publicly_available=True).first()
-                        if db_lab is not None:
-                            for widget in _get_widgets(rlms, lab.laboratory_id):
-                                # First widget wins...
-                                return url_for('opensocial.public_widget_html', lab_name=db_lab.public_identifier, widget_name=widget['name'], _external=True)
+    for db_rlms, rlms, laboratory_id in _iter_labs_by_url(url):
+        if db_rlms.publicly_available:
+            for widget in get_widgets(db_rlms, rlms, laboratory_id):
+                # First widget wins...
+                return url_for('opensocial.public_rlms_widget_html', rlms_identifier=db_rlms.public_identifier, lab_name=laboratory_id, widget_name=widget['name'], _external=True)
+        else:
+            db_lab = _public_laboratory(db_rlms, laboratory_id)
+            if db_lab is not None:
+                for widget in get_widgets(db_rlms, rlms, laboratory_id):
+                    # First widget wins...
+                    return url_for('opensocial.public_widget_html', lab_name=db_lab.public_identifier, widget_name=widget['name'], _external=True)
     return None
 
 
@@ -99,6 +99,86 @@ def run_tasks(tasks, threads = NUM_THREADS):
 
     dbg("All processes are over")
 
+class FanOutTimeout(Exception):
+    pass
+
+FAN_OUT_THREADS = 8
+
+def fan_out_iter(functions, threads = FAN_OUT_THREADS, timeout = 30):
+    """
+    Call each function (without arguments) in up to threads threads, and
+    yield (result, error) for each of them, in the same order as functions,
+    as soon as it (and the previous ones) are finished. Each call has
+    timeout seconds since it starts: if it takes longer, its error is a
+    FanOutTimeout, and its thread is abandoned and replaced by a new one so
+    the remaining calls are not blocked.
+    """
+    pending = Queue.Queue()
+    for position in range(len(functions)):
+        pending.put(position)
+
+    finished = Queue.Queue()
+    started = {
+        # position: time.time()
+    }
+    started_lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                position = pending.get_nowait()
+            except Queue.Empty:
+                break
+
+            with started_lock:
+                started[position] = time.time()
+
+            try:
+                result = (functions[position](), None)
+            except Exception as e:
+                traceback.print_exc()
+                result = (None, e)
+            finished.put((position, result))
+
+    def start_worker():
+        t = threading.Thread(target = worker, name = 'FanOut')
+        t.setDaemon(True)
+        t.start()
+
+    for _ in range(min(threads, len(functions))):
+        start_worker()
+
+    results = {
+        # position: (result, error)
+    }
+    next_position = 0
+    while next_position < len(functions):
+        if next_position in results:
+            yield results.pop(next_position)
+            next_position += 1
+            continue
+
+        try:
+            position, result = finished.get(timeout = 0.1)
+        except Queue.Empty:
+            pass
+        else:
+            if position >= next_position and position not in results:
+                results[position] = result
+
+        now = time.time()
+        with started_lock:
+            expired = [ position for position, start_time in started.items() if position >= next_position and position not in results and now - start_time > timeout ]
+
+        for position in expired:
+            dbg("Call %s took more than %s seconds" % (position, timeout))
+            results[position] = (None, FanOutTimeout("Call took more than %s seconds" % timeout))
+            start_worker()
+
+def fan_out(functions, threads = FAN_OUT_THREADS, timeout = 30):
+    """Same as fan_out_iter, but returning the list of [ (result, error) ]."""
+    return list(fan_out_iter(functions, threads = threads, timeout = timeout))
+
 
 class QueueTask(object):
     RLMS_CLASS = None # TO BE OVERRIDED
@@ -0,0 +1,150 @@
+# -*-*- encoding: utf-8 -*-*-
+#
+# gateway4labs is free software: you can redistribute it and/or modify
+# it under the terms of the BSD 2-Clause License
+# gateway4labs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+
+"""
+  Snapshots of the configuration of a widget (capabilities, translations,
+  check URLs, downloads and the widget description) as provided by the
+  RLMS. Building one calls the plug-in several times, so they are stored
+  in the cache of each RLMS instance (shared by all the processes) and
+  rebuilt by the TaskRunner, or removed when the RLMS is edited. The
+  OpenSocial views only apply the request options (height, scale,
+  autoload) on top of them.
+"""
+
+import hashlib
+import datetime
+import traceback
+import cPickle as pickle
+
+from labmanager.db import db
+from labmanager.models import RLMS as dbRLMS, RLMSCache
+from labmanager.application import app
+from labmanager.rlms import get_manager_class, get_capabilities, Capabilities
+from labmanager.rlms.caches import InstanceCache
+from labmanager.translation_bundles import TranslationBundle, read_only
+
+SNAPSHOT_KEY_PREFIX = u'widget_snapshot:'
+
+# Older snapshots are rebuilt on demand. The TaskRunner refreshes them every
+# hour, so this only matters if it is not running.
+SNAPSHOT_MAX_AGE = datetime.timedelta(seconds = app.config.get('WIDGET_SNAPSHOT_MAX_AGE', 3 * 3600))
+
+def _snapshot_key(laboratory_identifier, widget_name):
+    # Laboratory identifiers may be long URLs, and keys are limited to 255 characters
+    digest = hashlib.sha1(u'%s\n%s' % (laboratory_identifier, widget_name)).hexdigest()
+    return SNAPSHOT_KEY_PREFIX + digest.decode('ascii')
+
+def build_widget_snapshot(rlms_db, laboratory_identifier, widget_name):
+    """Retrieve from the RLMS everything needed to render the widget that does not depend on the request."""
+    RLMS_CLASS = get_manager_class(rlms_db.kind, rlms_db.version, rlms_db.id)
+    rlms = RLMS_CLASS(rlms_db.configuration)
+
+    try:
+        capabilities = get_capabilities(rlms_db, rlms)
+    except Exception as e:
+        traceback.print_exc()
+        raise Exception("Error retrieving capabilities: %s" % e)
+
+    default_height = rlms.get_default_height()
+    default_scale = rlms.get_default_scale()
+
+    if Capabilities.TRANSLATIONS in capabilities:
+        # The plug-in may return the object stored in its cache: it is not copied, only wrapped
+        translations = TranslationBundle(rlms.get_translations(laboratory_identifier))
+    else:
+        translations = TranslationBundle()
+
+    # Only if no translation is regularly provided and translation_list is supoprted
+    if Capabilities.TRANSLATION_LIST in capabilities:
+        translation_list = list((rlms.get_translation_list(laboratory_identifier) or {}).get('supported_languages', []))
+        for lang in translations['translations']:
+            if lang not in translation_list:
+                translation_list.append(lang)
+    else:
+        translation_list = []
+
+    if Capabilities.CHECK_URLS in capabilities:
+        check_urls = rlms.get_check_urls(laboratory_identifier)
+    else:
+        check_urls = []
+
+    if Capabilities.DOWNLOAD_LIST in capabilities:
+        download_list = rlms.get_downloads(laboratory_identifier)
+    else:
+        download_list = {}
+
+    widget = None
+    if Capabilities.WIDGET in capabilities:
+        for current_widget in rlms.list_widgets(laboratory_identifier):
+            if current_widget['name'] == widget_name:
+                widget = current_widget
+                break
+
+    # Snapshots are shared by every request (and thread), so they are read-only
+    return read_only({
+        'laboratory_identifier' : laboratory_identifier,
+        'widget_name' : widget_name,
+        'force_search' : Capabilities.FORCE_SEARCH in capabilities,
+        'default_height' : '{}px'.format(default_height) if default_height else None,
+        'default_scale' : int(default_scale) if default_scale else None,
+        'translations' : translations,
+        'translation_list' : translation_list,
+        'check_urls' : check_urls,
+        'downloads' : download_list,
+        'widget' : widget,
+    })
+
+def get_widget_snapshot(rlms_db, laboratory_identifier, widget_name):
+    """Returns the stored snapshot, building (and storing) it if there is none or it is too old."""
+    cache = InstanceCache(rlms_db.id)
+    key = _snapshot_key(laboratory_identifier, widget_name)
+    snapshot = cache.get(key, min_time = SNAPSHOT_MAX_AGE)
+    if snapshot is None:
+        snapshot = build_widget_snapshot(rlms_db, laboratory_identifier, widget_name)
+        cache[key] = snapshot
+    return snapshot
+
+def invalidate_widget_snapshots(rlms_id):
+    """Remove every snapshot of that RLMS (e.g., after its configuration has changed)."""
+    query = db.session.query(RLMSCache).filter(RLMSCache.rlms_id == rlms_id, RLMSCache.key.like(SNAPSHOT_KEY_PREFIX + u'%'))
+    query.delete(synchronize_session = False)
+    try:
+        db.session.commit()
+    except:
+        db.session.rollback()
+        raise
+
+def refresh_widget_snapshots():
+    """Rebuild all the stored snapshots. Returns the number of snapshots rebuilt."""
+    # Expired ones are not refreshed: if nobody requested them in a while, they are not needed
+    oldest = datetime.datetime.now() - SNAPSHOT_MAX_AGE
+    query = db.session.query(RLMSCache.rlms_id, RLMSCache.value).filter(RLMSCache.key.like(SNAPSHOT_KEY_PREFIX + u'%'), RLMSCache.datetime >= oldest)
+    snapshots_per_rlms = {}
+    for rlms_id, value in query.all():
+        try:
+            previous = pickle.loads(value.decode('base64'))
+        except Exception:
+            continue
+        snapshots_per_rlms.setdefault(rlms_id, []).append((previous['laboratory_identifier'], previous['widget_name']))
+
+    refreshed = 0
+    for rlms_id, snapshots in snapshots_per_rlms.iteritems():
+        rlms_db = db.session.query(dbRLMS).filter_by(id = rlms_id).first()
+        if rlms_db is None:
+            continue
+
+        cache = InstanceCache(rlms_id)
+        for laboratory_identifier, widget_name in snapshots:
+            try:
+                cache[_snapshot_key(laboratory_identifier, widget_name)] = build_widget_snapshot(rlms_db, laboratory_identifier, widget_name)
+            except Exception:
+                traceback.print_exc()
+            else:
+                refreshed += 1
+
+    return refreshed
@@ -1,53 +1,172 @@
 import urlparse
 import codecs
 import os
-import StringIO
+import time
 import zipfile
+import threading
 
-# 
+#
 # Flask imports
-# 
+#
 from flask import Response, render_template, flash
 
+#
+# The files of the SCORM package are read and encoded only once, and kept
+# in memory (get_scorm_template). Only lab.html changes from one package to
+# another. The zip files are not built in memory: each file is sent as
+# soon as it is added to the archive.
+#
 
-def get_scorm_object(authenticate = True, laboratory_identifier = '', lms_path = '/', lms_extension = '/', html_body = '''<div id="gateway4labs_root" />\n'''):
+class ScormTemplate(object):
+    """Contents of labmanager/data/scorm: lab.html (the template) and the rest of files (already encoded)."""
+
+    LAB_HTML = 'lab.html'
+
+    def __init__(self, base_scorm_dir):
+        self.lab_html = None
+        self.lab_html_date_time = None
+        self.files = [
+            # (ZipInfo, bytes)
+        ]
+        for root, dir, files in sorted(os.walk(base_scorm_dir)):
+            for f in sorted(files):
+                file_name = os.path.join(root, f)
+                arc_name  = os.path.join(root[len(base_scorm_dir)+1:], f)
+                content = codecs.open(file_name, 'rb', encoding='utf-8').read()
+                date_time = time.localtime(os.path.getmtime(file_name))[:6]
+                if f == self.LAB_HTML and root == base_scorm_dir:
+                    self.lab_html = content
+                    self.lab_html_date_time = date_time
+                else:
+                    self.files.append((_zip_info(arc_name, date_time), content.encode('utf-8')))
+
+    def render_lab_html(self, authenticate, laboratory_identifier, lms_path, lms_extension, html_body):
+        content = self.lab_html % {
+                    u'EXPERIMENT_COMMENT'    : '//' if authenticate else '',
+                    u'AUTHENTICATE_COMMENT'  : '//' if not authenticate else '',
+                    u'EXPERIMENT_IDENTIFIER' : unicode(laboratory_identifier),
+                    u'LMS_URL'               : unicode(lms_path),
+                    u'LMS_EXTENSION'         : unicode(lms_extension),
+                    u'HTML_CONTENT'          : unicode(html_body),
+                }
+        return content.encode('utf-8')
+
+    def iter_zip(self, authenticate = True, laboratory_identifier = '', lms_path = '/', lms_extension = '/', html_body = '''<div id="gateway4labs_root" />\n'''):
+        """Yields the contents of the SCORM package, file by file."""
+        stream = _ZipStream()
+        zf = zipfile.ZipFile(stream, 'w')
+        if self.lab_html is not None:
+            zf.writestr(_zip_info(self.LAB_HTML, self.lab_html_date_time), self.render_lab_html(authenticate, laboratory_identifier, lms_path, lms_extension, html_body))
+            yield stream.take()
+
+        for zip_info, content in self.files:
+            zf.writestr(zip_info, content)
+            yield stream.take()
+
+        zf.close()
+        yield stream.take()
+
+    def iter_bundle(self, laboratory_identifiers, lms_path = '/', lms_extension = '/'):
+        """Yields a zip file with a SCORM package (scorm_<identifier>.zip) per laboratory identifier."""
+        stream = _ZipStream()
+        zf = zipfile.ZipFile(stream, 'w')
+        date_time = time.localtime()[:6]
+        for laboratory_identifier in laboratory_identifiers:
+            package = ''.join(self.iter_zip(False, laboratory_identifier, lms_path, lms_extension))
+            zf.writestr(_zip_info('scorm_%s.zip' % laboratory_identifier, date_time), package)
+            yield stream.take()
+
+        zf.close()
+        yield stream.take()
+
+class _ZipStream(object):
+    """Write-only file for ZipFile: keeps what has been written until it is taken."""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(data)
+        self._position += len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = ''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def _zip_info(arc_name, date_time):
+    zip_info = zipfile.ZipInfo(arc_name, date_time)
+    # As ZipFile.writestr does with plain names
+    zip_info.external_attr = 0600 << 16
+    return zip_info
+
+def _get_base_scorm_dir():
     import labmanager
     # TODO: better way
     base_dir = os.path.dirname(labmanager.__file__)
-    base_scorm_dir = os.path.join(base_dir, 'data', 'scorm')
-    if not os.path.exists(base_scorm_dir):
-        flash("Error: %s does not exist" % base_scorm_dir)
-        return render_template("lms_admin/scorm_errors.html")
-
-    sio = StringIO.StringIO('')
-    zf = zipfile.ZipFile(sio, 'w')
-    for root, dir, files in os.walk(base_scorm_dir):
-        for f in files:
-            file_name = os.path.join(root, f)
-            arc_name  = os.path.join(root[len(base_scorm_dir)+1:], f)
-            content = codecs.open(file_name, 'rb', encoding='utf-8').read()
-            if f == 'lab.html' and root == base_scorm_dir:
-                content = content % { 
-                            u'EXPERIMENT_COMMENT'    : '//' if authenticate else '',
-                            u'AUTHENTICATE_COMMENT'  : '//' if not authenticate else '',
-                            u'EXPERIMENT_IDENTIFIER' : unicode(laboratory_identifier),
-                            u'LMS_URL'               : unicode(lms_path),
-                            u'LMS_EXTENSION'         : unicode(lms_extension),
-                            u'HTML_CONTENT'          : unicode(html_body),
-                        }
-            zf.writestr(arc_name, content.encode('utf-8'))
-
-    zf.close()
-    return sio.getvalue()
+    return os.path.join(base_dir, 'data', 'scorm')
 
-def get_authentication_scorm(lms_url):
+_SCORM_TEMPLATE = {
+    'template' : None,
+}
+_SCORM_TEMPLATE_LOCK = threading.Lock()
+
+def get_scorm_template():
+    """The ScormTemplate, loaded the first time. None if the SCORM directory does not exist."""
+    with _SCORM_TEMPLATE_LOCK:
+        if _SCORM_TEMPLATE['template'] is None:
+            base_scorm_dir = _get_base_scorm_dir()
+            if not os.path.exists(base_scorm_dir):
+                return None
+            _SCORM_TEMPLATE['template'] = ScormTemplate(base_scorm_dir)
+        return _SCORM_TEMPLATE['template']
+
+def _scorm_errors():
+    flash("Error: %s does not exist" % _get_base_scorm_dir())
+    return render_template("lms_admin/scorm_errors.html")
+
+def get_scorm_object(authenticate = True, laboratory_identifier = '', lms_path = '/', lms_extension = '/', html_body = '''<div id="gateway4labs_root" />\n'''):
+    template = get_scorm_template()
+    if template is None:
+        return _scorm_errors()
+
+    return ''.join(template.iter_zip(authenticate, laboratory_identifier, lms_path, lms_extension, html_body))
+
+def get_lms_paths(lms_url):
+    """Path of the LMS and extension (for the SCORM packages) of the URL of the LMS."""
     lms_path = urlparse.urlparse(lms_url).path or '/'
     extension = '/'
     if 'gateway4labs/' in lms_path:
         extension = lms_path[lms_path.rfind('gateway4labs/lms/list') + len('gateway4labs/lms/list'):]
         lms_path  = lms_path[:lms_path.rfind('gateway4labs/')]
+    return lms_path, extension
 
-    content = get_scorm_object(True, lms_path=lms_path, lms_extension=extension)
-    return Response(content, headers = {'Content-Type' : 'application/zip', 'Content-Disposition' : 'attachment; filename=authenticate_scorm.zip'})
+def get_scorm_response(filename, authenticate = True, laboratory_identifier = '', lms_url = ''):
+    """Streamed response with the SCORM package."""
+    template = get_scorm_template()
+    if template is None:
+        return _scorm_errors()
+
+    lms_path, extension = get_lms_paths(lms_url)
+    content = template.iter_zip(authenticate, laboratory_identifier, lms_path = lms_path, lms_extension = extension)
+    return Response(content, headers = {'Content-Type' : 'application/zip', 'Content-Disposition' : 'attachment; filename=%s' % filename})
+
+def get_authentication_scorm(lms_url):
+    return get_scorm_response('authenticate_scorm.zip', True, lms_url = lms_url)
 
+def get_scorm_bundle_response(filename, laboratory_identifiers, lms_url = ''):
+    """Streamed response with a zip file containing the SCORM package of each laboratory identifier."""
+    template = get_scorm_template()
+    if template is None:
+        return _scorm_errors()
 
+    lms_path, extension = get_lms_paths(lms_url)
+    content = template.iter_bundle(list(laboratory_identifiers), lms_path = lms_path, lms_extension = extension)
+    return Response(content, headers = {'Content-Type' : 'application/zip', 'Content-Disposition' : 'attachment; filename=%s' % filename})
@@ -0,0 +1,154 @@
+# -*-*- encoding: utf-8 -*-*-
+#
+# gateway4labs is free software: you can redistribute it and/or modify
+# it under the terms of the BSD 2-Clause License
+# gateway4labs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+
+"""
+  Bulk synchronization of tables with an external source (e.g., the export
+  of the App Composer). Each row is compared by a hash of the synchronized
+  columns, so only the new and changed rows are written, in batches and
+  without creating ORM objects. With dry_run, nothing is written and only
+  the report is returned.
+"""
+
+import json
+import hashlib
+import datetime
+
+from sqlalchemy import sql
+
+from labmanager.db import db
+from labmanager.models import GoLabOAuthUser, EmbedApplication, EmbedApplicationTranslation
+from labmanager.application import app
+
+SYNC_BATCH_SIZE = app.config.get('SYNC_BATCH_SIZE', 500)
+
+def row_hash(values):
+    normalized = []
+    for value in values:
+        if isinstance(value, str):
+            value = value.decode('utf8')
+        normalized.append(value)
+    return hashlib.sha1(repr(tuple(normalized))).hexdigest()
+
+def _batches(rows, batch_size):
+    for position in xrange(0, len(rows), batch_size):
+        yield rows[position:position + batch_size]
+
+class TableSync(object):
+    """
+    Differences between the rows of a table and the incoming ones. Rows are
+    identified by key_columns, and only the columns are compared (the rest
+    of the incoming values are only used when inserting).
+    """
+
+    def __init__(self, table, key_columns, columns):
+        self.table = table
+        self.key_columns = tuple(key_columns)
+        self.columns = tuple(columns)
+        self.inserts = []
+        self.updates = []
+        self.unchanged = 0
+
+    def compare(self, incoming):
+        table = self.table
+        selected = [ table.c.id ] + [ table.c[column] for column in self.key_columns + self.columns ]
+        current = {
+            # key: (id, hash)
+        }
+        for row in db.session.execute(sql.select(selected)):
+            key = tuple(row[column] for column in self.key_columns)
+            current[key] = (row['id'], row_hash(row[column] for column in self.columns))
+
+        for values in incoming:
+            key = tuple(values[column] for column in self.key_columns)
+            if key not in current:
+                self.inserts.append(values)
+                # Repeated in the incoming rows: only the first one
+                current[key] = (None, row_hash(values[column] for column in self.columns))
+                continue
+
+            row_id, current_hash = current[key]
+            if row_id is None or row_hash(values[column] for column in self.columns) == current_hash:
+                self.unchanged += 1
+            else:
+                update = dict((column, values[column]) for column in self.columns)
+                update['_id'] = row_id
+                self.updates.append(update)
+        return self
+
+    def apply(self, batch_size = None):
+        batch_size = batch_size or SYNC_BATCH_SIZE
+        for batch in _batches(self.inserts, batch_size):
+            db.session.execute(self.table.insert(), batch)
+
+        statement = self.table.update().where(self.table.c.id == sql.bindparam('_id'))
+        for batch in _batches(self.updates, batch_size):
+            db.session.execute(statement, batch)
+
+    def report(self):
+        return { 'inserted' : len(self.inserts), 'updated' : len(self.updates), 'unchanged' : self.unchanged }
+
+COMPOSER_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+def sync_embed_applications(contents, dry_run = False, batch_size = None):
+    """
+    Add or update the users, apps and translations of an App Composer export
+    (contents, as in /export-embed.json). Nothing is ever removed. Returns a
+    report such as {'users' : {'inserted' : 1, 'updated' : 0, 'unchanged' : 5}, 'apps' : ..., 'translations' : ...}
+    """
+    report = {}
+    try:
+        users = TableSync(GoLabOAuthUser.__table__, ('email',), ('display_name',))
+        users.compare([ { 'email' : user['email'], 'display_name' : user['display_name'], 'admin' : False } for user in contents['users'] ])
+        if not dry_run:
+            users.apply(batch_size)
+        report['users'] = users.report()
+
+        # New users only have an identifier once inserted (not in a dry run)
+        user_ids = dict(db.session.query(GoLabOAuthUser.email, GoLabOAuthUser.id).all())
+        default_age_ranges = ','.join(EmbedApplication.text2age_ranges("[4, 20]"))
+        apps = TableSync(EmbedApplication.__table__, ('identifier',), ('url', 'name', 'height', 'scale', 'creation', 'last_update'))
+        apps.compare([ {
+                'identifier' : embed_app['identifier'],
+                'url' : embed_app['url'],
+                'name' : embed_app['name'],
+                'height' : embed_app['height'],
+                'scale' : embed_app['scale'],
+                'creation' : datetime.datetime.strptime(embed_app['creation'], COMPOSER_DATE_FORMAT),
+                'last_update' : datetime.datetime.strptime(embed_app['last_update'], COMPOSER_DATE_FORMAT),
+                'owner_id' : user_ids.get(embed_app['owner_mail']),
+                'age_ranges_commas' : default_age_ranges,
+                'domains_json' : json.dumps([]),
+            } for embed_app in contents['apps'] ])
+        if not dry_run:
+            apps.apply(batch_size)
+        report['apps'] = apps.report()
+
+        app_ids = dict(db.session.query(EmbedApplication.identifier, EmbedApplication.id).all())
+        translations = TableSync(EmbedApplicationTranslation.__table__, ('embed_application_id', 'language'), ('url',))
+        # In a dry run, the new apps are identified by their public identifier instead
+        translations.compare([ {
+                'embed_application_id' : app_ids.get(embed_app['identifier'], embed_app['identifier']),
+                'language' : translation['language'],
+                'url' : translation['url'],
+            } for embed_app in contents['apps'] for translation in embed_app['translations'] ])
+        if not dry_run:
+            translations.apply(batch_size)
+        report['translations'] = translations.report()
+    except:
+        db.session.rollback()
+        raise
+
+    if dry_run:
+        db.session.rollback()
+    else:
+        db.session.commit()
+    return report
+
+def format_report(report):
+    return '; '.join([ "%s: %s inserted, %s updated, %s unchanged" % (name, report[name]['inserted'], report[name]['updated'], report[name]['unchanged'])
+                       for name in sorted(report) ])
@@ -0,0 +1,60 @@
+import os
+import gzip
+import shutil
+import datetime
+import tempfile
+
+from labmanager.db import db
+from labmanager.models import UseLog
+from labmanager.archive import apply_retention, archive_month, restore_archive, expired_months, retention_limit, month_range
+from labmanager.tests.util import G4lTestCase
+
+class ArchiveTest(G4lTestCase):
+    def setUp(self):
+        super(ArchiveTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        for dtime in [ datetime.datetime(2017, 12, 3), datetime.datetime(2017, 12, 31, 23), datetime.datetime(2018, 1, 1), datetime.datetime(2018, 3, 1) ]:
+            db.session.add(UseLog(url = u'http://a', ip_address = u'127.0.0.0', web_browser = u'Mozilla', user_agent = None, timezone_minutes = 0, lang_header = None, dtime = dtime))
+        db.session.commit()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(ArchiveTest, self).tearDown()
+
+    def test_limits(self):
+        self.assertEquals(datetime.date(2018, 1, 1), retention_limit(2, datetime.date(2018, 3, 15)))
+        self.assertEquals(datetime.date(2017, 12, 1), retention_limit(3, datetime.date(2018, 3, 1)))
+        self.assertEquals((datetime.date(2017, 12, 1), datetime.date(2018, 1, 1)), month_range(2017, 12))
+
+    def test_apply_retention(self):
+        today = datetime.date(2018, 3, 15)
+        self.assertEquals([ (2017, 12) ], expired_months(2, today))
+
+        results = apply_retention(2, self.directory, today)
+        self.assertEquals(1, len(results))
+        filename, rows = results[0]
+        self.assertEquals(2, rows)
+        self.assertEquals('uselogs-2017-12.json.gz', os.path.basename(filename))
+
+        lines = gzip.open(filename).read().strip().splitlines()
+        self.assertEquals(2, len(lines))
+        self.assertEquals(2, db.session.query(UseLog).count())
+        self.assertEquals([], expired_months(2, today))
+
+    def test_disabled_by_default(self):
+        self.assertEquals([], apply_retention(directory = self.directory))
+        self.assertEquals(4, db.session.query(UseLog).count())
+
+    def test_restore(self):
+        table = UseLog.__table__
+        query = table.select().where(table.c.year == 2017).order_by(table.c.id)
+        original = [ dict(row) for row in db.session.execute(query) ]
+        self.assertEquals(u'Mozilla', original[0]['web_browser'])
+
+        filename, rows = archive_month(2017, 12, self.directory, chunk_size = 1)
+        self.assertEquals(2, rows)
+        self.assertEquals(2, db.session.query(UseLog).count())
+
+        self.assertEquals(2, restore_archive(filename, chunk_size = 1))
+        self.assertEquals(original, [ dict(row) for row in db.session.execute(query) ])
+        self.assertEquals(4, db.session.query(UseLog).count())
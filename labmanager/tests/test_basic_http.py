@@ -0,0 +1,110 @@
+import json
+import base64
+import hashlib
+
+from sqlalchemy import event
+
+from labmanager import ALGORITHM
+from labmanager.db import db
+from labmanager.models import BasicHttpCredentials, LearningTool, RLMS, Laboratory, PermissionToLt, Course, PermissionToCourse
+from labmanager.views import basic_http
+from labmanager.tests.util import G4lTestCase
+
+_STATEMENTS = {
+    'engine' : None,
+    'current' : None,
+}
+
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    if _STATEMENTS['current'] is not None:
+        _STATEMENTS['current'].append(statement)
+
+class BasicHttpTestCase(G4lTestCase):
+    def setUp(self):
+        super(BasicHttpTestCase, self).setUp()
+        basic_http.clear_verified_credentials()
+        if _STATEMENTS['engine'] is not db.engine:
+            event.listen(db.engine, 'before_cursor_execute', _count_statement)
+            _STATEMENTS['engine'] = db.engine
+        self.statements = _STATEMENTS['current'] = []
+
+    def tearDown(self):
+        _STATEMENTS['current'] = None
+        basic_http.clear_verified_credentials()
+        super(BasicHttpTestCase, self).tearDown()
+
+    def _headers(self, username = 'uned', password = 'password'):
+        return { 'Authorization' : 'Basic %s' % base64.b64encode('%s:%s' % (username, password)) }
+
+class CredentialsTest(BasicHttpTestCase):
+    def test_cached(self):
+        rv = self.client.get('/labmanager/requests/', headers = self._headers())
+        self.assert_200(rv)
+        self.assertIn('robot', rv.data)
+
+        self.statements[:] = []
+        rv = self.client.get('/labmanager/requests/', headers = self._headers())
+        self.assert_200(rv)
+        self.assertIn('robot', rv.data)
+        # Neither the credentials nor the LT are queried again
+        self.assertEquals([], [ statement for statement in self.statements if 'basic_http_credentials' in statement ])
+        self.assertEquals([], [ statement for statement in self.statements if 'learning_tools' in statement ])
+
+    def test_invalid(self):
+        self.assert_401(self.client.get('/labmanager/requests/', headers = self._headers(password = 'wrong')))
+        self.assert_401(self.client.get('/labmanager/requests/'))
+
+    def test_credentials_changed(self):
+        self.assert_200(self.client.get('/labmanager/requests/', headers = self._headers()))
+        credential = db.session.query(BasicHttpCredentials).filter_by(lt_login = u'uned').one()
+        credential.lt_password = unicode(hashlib.new(ALGORITHM, 'new password').hexdigest())
+        db.session.commit()
+
+        self.assert_401(self.client.get('/labmanager/requests/', headers = self._headers()))
+        self.assert_200(self.client.get('/labmanager/requests/', headers = self._headers(password = 'new password')))
+
+class ReservationTest(BasicHttpTestCase):
+    def setUp(self):
+        super(ReservationTest, self).setUp()
+        rlms = RLMS(kind = u'Virtual labs', url = u'http://example.com/', name = u'Virtual', location = u'Bilbao', version = u'0.1',
+                    configuration = json.dumps({ 'web' : 'http://example.com/lab.html', 'web_name' : 'lab' }))
+        lt = db.session.query(LearningTool).filter_by(name = u'uned').one()
+        for courses in (1, 10):
+            lab = Laboratory(name = u'lab-%s' % courses, laboratory_id = u'lab-%s' % courses, rlms = rlms)
+            permission = PermissionToLt(lt = lt, laboratory = lab, local_identifier = u'virtual-%s' % courses, configuration = u'{}')
+            db.session.add(permission)
+            for position in range(courses):
+                course = Course(name = u'Course %s-%s' % (courses, position), lt = lt, context_id = u'course-%s-%s' % (courses, position))
+                db.session.add(PermissionToCourse(course = course, permission_to_lt = permission, configuration = u'{}'))
+        db.session.commit()
+
+    def _reserve(self, experiment, courses):
+        data = {
+            'courses' : courses,
+            'request-payload' : json.dumps({ 'action' : 'reserve', 'experiment' : experiment }),
+            'user-id' : u'student',
+            'full-name' : u'Student',
+        }
+        self.statements[:] = []
+        rv = self.client.post('/labmanager/requests/', data = json.dumps(data), content_type = 'application/json', headers = self._headers())
+        self.assert_200(rv)
+        self.assertEquals('http://example.com/lab.html', rv.data)
+        return len(self.statements)
+
+    def test_statements_per_reservation(self):
+        # Credentials verified and RLMS plug-in loaded
+        self._reserve(u'virtual-1', [ u'course-1-0' ])
+
+        one_course = self._reserve(u'virtual-1', [ u'course-1-0' ])
+        ten_courses = self._reserve(u'virtual-10', [ u'course-10-%s' % position for position in range(10) ])
+        self.assertEquals(one_course, ten_courses)
+
+    def test_not_enrolled(self):
+        data = {
+            'courses' : [ u'course-1-0' ],
+            'request-payload' : json.dumps({ 'action' : 'reserve', 'experiment' : u'virtual-10' }),
+            'user-id' : u'student',
+            'full-name' : u'Student',
+        }
+        rv = self.client.post('/labmanager/requests/', data = json.dumps(data), content_type = 'application/json', headers = self._headers())
+        self.assertNotEquals('http://example.com/lab.html', rv.data)
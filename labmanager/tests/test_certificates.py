@@ -0,0 +1,30 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from labmanager.certificates import build_ca_bundle
+
+class CaBundleTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.base = os.path.join(self.directory, 'base.pem')
+        self.extra = os.path.join(self.directory, 'extra.crt')
+        with open(self.base, 'wb') as f:
+            f.write('BASE')
+        with open(self.extra, 'wb') as f:
+            f.write('EXTRA\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_build(self):
+        path = os.path.join(self.directory, 'bundle.pem')
+        self.assertEquals(path, build_ca_bundle(path, base_bundle = self.base, extra_certificates = [ self.extra ]))
+        self.assertEquals('BASE\nEXTRA\n', open(path).read())
+
+        # The base bundle is never modified, and certificates are not added twice
+        self.assertEquals('BASE', open(self.base).read())
+        build_ca_bundle(path, base_bundle = path, extra_certificates = [ self.extra ])
+        self.assertEquals('BASE\nEXTRA\n', open(path).read())
+        self.assertEquals([ 'base.pem', 'bundle.pem', 'extra.crt' ], sorted(os.listdir(self.directory)))
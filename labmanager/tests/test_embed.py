@@ -0,0 +1,103 @@
+import json
+import threading
+import unittest
+
+from labmanager.views import embed
+from labmanager.tests.util import G4lTestCase
+
+class FakeResponse(object):
+    def __init__(self, chunks, content_type = 'text/html; charset=utf-8', status_code = 200, headers = None):
+        self.chunks = chunks
+        self.read = []
+        self.status_code = status_code
+        self.headers = { 'content-type' : content_type }
+        self.headers.update(headers or {})
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        for chunk in self.chunks:
+            self.read.append(chunk)
+            yield chunk
+
+    def close(self):
+        self.closed = True
+
+class UrlMetadataTestCase(unittest.TestCase):
+    def setUp(self):
+        self.requested = []
+        self.responses = {}
+        self.original_get = embed.requests.get
+
+        def get(url, **kwargs):
+            self.requested.append(url)
+            response = self.responses[url]
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        embed.requests.get = get
+        embed.clear_url_metadata()
+
+    def tearDown(self):
+        embed.requests.get = self.original_get
+        embed.clear_url_metadata()
+
+class UrlMetadataTest(UrlMetadataTestCase):
+    def test_head_only(self):
+        response = FakeResponse([ '<html><head><TITLE> My lab </TITLE>', '<meta name="description" content="A lab"></he', 'ad><body>', 'never read' ])
+        self.responses['http://example.com/'] = response
+        metadata = embed.get_url_metadata('http://example.com/')
+        self.assertEquals(u'My lab', metadata['name'])
+        self.assertEquals(u'A lab', metadata['description'])
+        self.assertEquals(3, len(response.read))
+        self.assertTrue(response.closed)
+
+        # No <title>
+        self.responses['http://example.com/notitle'] = FakeResponse([ '<html><body>Hi</body></html>' ])
+        self.assertEquals('', embed.get_url_metadata('http://example.com/notitle')['name'])
+
+    def test_cached(self):
+        self.responses['http://example.com/'] = FakeResponse([ '<html><head><title>Lab</title></head></html>' ], headers = { 'X-Frame-Options' : 'DENY' })
+        self.assertEquals('deny', embed.get_url_metadata('http://example.com/')['x_frame_options'])
+        self.assertEquals('deny', embed.get_url_metadata('http://example.com/', timeout = 5)['x_frame_options'])
+        self.assertEquals([ 'http://example.com/' ], self.requested)
+
+    def test_errors_expire_sooner(self):
+        self.responses['http://example.com/'] = Exception("Timeout")
+        original_ttl = embed.URL_METADATA_ERROR_TTL
+        embed.URL_METADATA_ERROR_TTL = -1
+        try:
+            self.assertTrue(embed.get_url_metadata('http://example.com/')['error_retrieving'])
+            self.assertTrue(embed.get_url_metadata('http://example.com/')['error_retrieving'])
+        finally:
+            embed.URL_METADATA_ERROR_TTL = original_ttl
+        self.assertEquals(2, len(self.requested))
+
+    def test_busy(self):
+        slots = embed._URL_METADATA_SLOTS
+        embed._URL_METADATA_SLOTS = threading.BoundedSemaphore(1)
+        try:
+            embed._URL_METADATA_SLOTS.acquire()
+            self.assertTrue(embed.get_url_metadata('http://example.com/')['busy'])
+            embed._URL_METADATA_SLOTS.release()
+        finally:
+            embed._URL_METADATA_SLOTS = slots
+        self.assertEquals([], self.requested)
+
+class CheckJsonTest(UrlMetadataTestCase, G4lTestCase):
+    def setUp(self):
+        G4lTestCase.setUp(self)
+        UrlMetadataTestCase.setUp(self)
+
+    def tearDown(self):
+        UrlMetadataTestCase.tearDown(self)
+        G4lTestCase.tearDown(self)
+
+    def test_check(self):
+        self.responses['http://example.com/'] = FakeResponse([ '<html><head><title>Lab</title></head></html>' ])
+        for _ in range(2):
+            rv = self.client.get('/embed/check.json?url=http://example.com/')
+            contents = json.loads(rv.data)
+            self.assertFalse(contents['error'])
+            self.assertEquals(u'Lab', contents['name'])
+        self.assertEquals(1, len(self.requested))
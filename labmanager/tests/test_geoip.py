@@ -0,0 +1,48 @@
+import datetime
+
+from labmanager.db import db
+from labmanager.models import UseLog, LocationCache
+from labmanager.rlms import enrich_use_logs
+from labmanager.tests.util import G4lTestCase
+
+LOCATIONS = {
+    u'1.1.1.1': (u'ES', u'Bilbao'),
+    u'2.2.2.2': (u'CH', None),
+}
+
+class EnrichUseLogsTest(G4lTestCase):
+    def setUp(self):
+        super(EnrichUseLogsTest, self).setUp()
+        self.lookups = []
+        for ip_address in [u'1.1.1.1', u'2.2.2.2', u'1.1.1.1', u'3.3.3.3', u'1.1.1.1']:
+            db.session.add(UseLog(url = u'http://a', ip_address = ip_address, web_browser = u'Mozilla', user_agent = None, timezone_minutes = 0, lang_header = None, dtime = datetime.datetime(2018, 1, 1)))
+        db.session.commit()
+
+    def lookup(self, ip_address):
+        self.lookups.append(ip_address)
+        if ip_address not in LOCATIONS:
+            raise ValueError("Unknown address")
+        return LOCATIONS[ip_address]
+
+    def test_single_pass(self):
+        last_id, countries, cities, errors = enrich_use_logs(self.lookup, chunk_size = 2)
+        self.assertEquals(5, last_id)
+        self.assertEquals((4, 3, 1), (countries, cities, errors))
+        # Each IP address is only looked up once
+        self.assertEquals(sorted(set(self.lookups)), sorted(self.lookups))
+
+        locations = [ (log.ip_address, log.country, log.city) for log in db.session.query(UseLog).order_by(UseLog.id) ]
+        self.assertEquals((u'1.1.1.1', u'ES', u'Bilbao'), locations[0])
+        self.assertEquals((u'2.2.2.2', u'CH', None), locations[1])
+        self.assertEquals((u'3.3.3.3', None, None), locations[3])
+        self.assertEquals(3, db.session.query(LocationCache).count())
+
+    def test_resume_uses_location_cache(self):
+        enrich_use_logs(self.lookup, chunk_size = 10)
+        db.session.add(UseLog(url = u'http://a', ip_address = u'1.1.1.1', web_browser = u'Mozilla', user_agent = None, timezone_minutes = 0, lang_header = None))
+        db.session.commit()
+
+        self.lookups = []
+        last_id, countries, cities, errors = enrich_use_logs(self.lookup, since_id = 5)
+        self.assertEquals([], self.lookups)
+        self.assertEquals((6, 1, 1), (last_id, countries, cities))
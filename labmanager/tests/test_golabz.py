@@ -0,0 +1,165 @@
+import time
+import json
+import datetime
+import unittest
+
+from labmanager.golabz import CatalogCache, BookingIndex, build_labs_index, golab_bookings
+from labmanager.tests.util import G4lTestCase
+
+FIXTURE = [
+    {
+        'title': 'Lab 1',
+        'lab_golabz_page': 'http://www.golabz.eu/lab/lab1',
+        'lab_apps': [
+            { 'app_url': 'http://gateway.golabz.eu/os/pub/lab1/w_default.xml' },
+            { 'app_url': 'http://gateway.golabz.eu/os/pub/lab1/w_other.xml' },
+        ]
+    },
+    {
+        'title': 'Lab 2',
+        'lab_golabz_page': 'http://www.golabz.eu/lab/lab2',
+        'lab_apps': []
+    },
+]
+
+class CountingSource(object):
+    def __init__(self, contents):
+        self.contents = contents
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if isinstance(self.contents, Exception):
+            raise self.contents
+        return self.contents
+
+class CatalogCacheTest(unittest.TestCase):
+    def test_index_built_once(self):
+        source = CountingSource(FIXTURE)
+        cache = CatalogCache('test', source, ttl = 3600, builder = build_labs_index)
+        catalog = cache.get()
+        self.assertEquals('Lab 1', catalog['lab_per_url']['http://gateway.golabz.eu/os/pub/lab1/w_other.xml']['title'])
+        self.assertTrue(cache.get() is catalog)
+        self.assertEquals(1, source.calls)
+
+    def test_stale_value_returned_while_refreshing(self):
+        source = CountingSource(FIXTURE)
+        cache = CatalogCache('test', source, ttl = 0, builder = build_labs_index)
+        first = cache.get()
+        time.sleep(0.01)
+        self.assertTrue(cache.get() is first)
+        for _ in range(100):
+            if source.calls > 1:
+                break
+            time.sleep(0.01)
+        self.assertEquals(2, source.calls)
+
+    def test_failing_source(self):
+        cache = CatalogCache('test', CountingSource(ValueError("golabz is down")))
+        self.assertEquals(None, cache.get())
+
+    def test_set_source(self):
+        cache = CatalogCache('test', CountingSource(ValueError("golabz is down")), builder = build_labs_index)
+        cache.set_source(CountingSource(FIXTURE))
+        self.assertEquals(2, len(cache.get()['labs']))
+
+BOOKINGS_FIXTURE = [
+    {
+        'ils_url': 'http://graasp.eu/ils/ils1/?lang=en',
+        'lab_apps': [
+            { 'app_url': 'http://gateway.golabz.eu/os/pub/lab1/w_default.xml' },
+            { 'app_url': 'http://gateway.golabz.eu/os/pub/lab1/w_other.xml' },
+        ],
+        'start_time': '2016-01-01T10:00:00',
+        'end_time': '2016-01-01T12:00:00',
+    },
+    {
+        # A long slot starting before the previous one
+        'ils_url': 'http://graasp.eu/ils/ils2/?lang=en',
+        'lab_apps': [
+            { 'app_url': 'http://gateway.golabz.eu/os/pub/lab1/w_default.xml' },
+        ],
+        'start_time': '2016-01-01T08:00:00',
+        'end_time': '2016-01-01T20:00:00',
+    },
+    {
+        'ils_url': 'http://graasp.eu/ils/ils3/?lang=en',
+        'lab_apps': [
+            { 'app_url': 'http://gateway.golabz.eu/os/pub/lab10/w_default.xml' },
+        ],
+        'start_time': '2016-01-01T10:00:00',
+        'end_time': '2016-01-01T12:00:00',
+    },
+    {
+        'ils_url': 'http://graasp.eu/ils/ils4/?lang=en',
+        'lab_apps': [
+            { 'app_url': 'http://gateway.golabz.eu/os/pub/lab1/w_default.xml' },
+        ],
+        'start_time': 'invalid',
+        'end_time': '2016-01-01T12:00:00',
+    },
+]
+
+class BookingIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = BookingIndex(BOOKINGS_FIXTURE)
+
+    def test_current_slots(self):
+        now = datetime.datetime(2016, 1, 1, 11, 0)
+        slots = self.index.current_slots('http://gateway.golabz.eu/os/pub/lab1/', now)
+        # The first slot is listed once, even if two apps match
+        self.assertEquals([
+            (datetime.datetime(2016, 1, 1, 12, 0), 'http://graasp.eu/ils/ils1/?lang=en'),
+            (datetime.datetime(2016, 1, 1, 20, 0), 'http://graasp.eu/ils/ils2/?lang=en'),
+        ], slots)
+
+    def test_only_long_slot(self):
+        now = datetime.datetime(2016, 1, 1, 13, 0)
+        slots = self.index.current_slots('http://gateway.golabz.eu/os/pub/lab1/', now)
+        self.assertEquals([ (datetime.datetime(2016, 1, 1, 20, 0), 'http://graasp.eu/ils/ils2/?lang=en') ], slots)
+
+    def test_no_slots(self):
+        self.assertEquals([], self.index.current_slots('http://gateway.golabz.eu/os/pub/lab1/', datetime.datetime(2016, 1, 1, 7, 0)))
+        self.assertEquals([], self.index.current_slots('http://gateway.golabz.eu/os/pub/lab1/', datetime.datetime(2016, 1, 1, 20, 0)))
+        self.assertEquals([], self.index.current_slots('http://gateway.golabz.eu/os/pub/lab2/', datetime.datetime(2016, 1, 1, 11, 0)))
+
+    def test_prefix(self):
+        now = datetime.datetime(2016, 1, 1, 11, 0)
+        self.assertEquals(3, len(self.index.current_slots('http://gateway.golabz.eu/os/pub/lab1', now)))
+
+class CheckBookingTest(G4lTestCase):
+    def setUp(self):
+        super(CheckBookingTest, self).setUp()
+        now = datetime.datetime.utcnow()
+        slots = [{
+            'ils_url': 'http://graasp.eu/ils/booked_ils/?lang=en',
+            'lab_apps': [
+                { 'app_url': 'http://localhost/os/pub/booked/w_default.xml' },
+            ],
+            'start_time': (now - datetime.timedelta(hours = 1)).strftime('%Y-%m-%dT%H:%M:%S'),
+            'end_time': (now + datetime.timedelta(hours = 1)).strftime('%Y-%m-%dT%H:%M:%S'),
+        }]
+        self.source = CountingSource(slots)
+        golab_bookings.set_source(self.source)
+
+    def tearDown(self):
+        golab_bookings.set_source(CountingSource(ValueError("No booking service in the tests")))
+        super(CheckBookingTest, self).tearDown()
+
+    def test_booked(self):
+        response = json.loads(self.client.get('/os/public/booking/booked/').data)
+        self.assertTrue(response['booked'])
+
+        response = json.loads(self.client.get('/os/public/booking/booked/?ils_student_url=http://graasp.eu/ils/booked_ils/').data)
+        self.assertFalse(response['booked'])
+
+        response = json.loads(self.client.get('/os/public/booking/other/').data)
+        self.assertFalse(response['booked'])
+
+        # The booking service was only requested once
+        self.assertEquals(1, self.source.calls)
+
+    def test_service_down(self):
+        golab_bookings.set_source(CountingSource(ValueError("golabz is down")))
+        response = json.loads(self.client.get('/os/public/booking/booked/').data)
+        self.assertFalse(response['booked'])
@@ -1,6 +1,11 @@
+import uuid
 import unittest
 
-from labmanager.models import RLMS, LabManagerUser
+from sqlalchemy.exc import IntegrityError
+
+from labmanager.db import db
+from labmanager.models import RLMS, LabManagerUser, GoLabOAuthUser, EmbedApplication, ManualApplication, add_with_unique_identifier
+from labmanager.tests.util import G4lTestCase
 
 class ModelsReprTest(unittest.TestCase):
     def assert_repr(self, obj):
@@ -20,3 +25,42 @@ class ModelsReprTest(unittest.TestCase):
     def test_rlms(self):
         rlms = RLMS(kind = u'Super cool RLMS', location = u'World', url = u'http://foo/', version = u'3.1415', configuration = u'{}', publicly_available = True, public_identifier = u'yeah')
         self.assert_repr(rlms)
+
+class UniqueIdentifierTest(G4lTestCase):
+    def setUp(self):
+        super(UniqueIdentifierTest, self).setUp()
+        self.owner = GoLabOAuthUser(email = u'owner@example.com', display_name = u'Owner')
+        self.first = add_with_unique_identifier(EmbedApplication(url = u'http://example.com/', name = u'First', owner = self.owner))
+        self.first_identifier = self.first.identifier
+
+    def test_retried_on_conflict(self):
+        # The first identifier generated is already taken
+        identifiers = [ uuid.UUID(self.first_identifier) ]
+        original_uuid4 = uuid.uuid4
+        uuid.uuid4 = lambda : identifiers.pop(0) if identifiers else original_uuid4()
+        try:
+            second = EmbedApplication(url = u'http://example.com/', name = u'Second', owner = self.owner)
+        finally:
+            uuid.uuid4 = original_uuid4
+        self.assertEquals(self.first_identifier, second.identifier)
+
+        add_with_unique_identifier(second)
+        self.assertNotEquals(self.first_identifier, second.identifier)
+        self.assertEquals(2, db.session.query(EmbedApplication).count())
+
+    def test_provided_identifier(self):
+        second = EmbedApplication(url = u'http://example.com/', name = u'Second', owner = self.owner, identifier = self.first_identifier)
+        self.assertRaises(IntegrityError, add_with_unique_identifier, second)
+        self.assertEquals(self.first_identifier, second.identifier)
+        self.assertEquals(1, db.session.query(EmbedApplication).count())
+
+        # Another table: not a conflict
+        manual = ManualApplication(name = u'Manual', owner = self.owner, identifier = self.first_identifier)
+        add_with_unique_identifier(manual)
+        self.assertEquals(self.first_identifier, manual.identifier)
+
+    def test_other_errors(self):
+        second = EmbedApplication(url = u'http://example.com/', name = None, owner = self.owner)
+        identifier = second.identifier
+        self.assertRaises(IntegrityError, add_with_unique_identifier, second)
+        self.assertEquals(identifier, second.identifier)
@@ -0,0 +1,194 @@
+import json
+import unittest
+
+from labmanager.db import db
+from labmanager.models import RLMS, Laboratory
+from labmanager.rlms import get_capabilities, get_widgets, refresh_capabilities
+from labmanager.rlms.ext import virtual
+from labmanager.response_cache import RESPONSES
+from labmanager.rlms.snapshots import get_widget_snapshot, invalidate_widget_snapshots, refresh_widget_snapshots
+from labmanager.tests.util import G4lTestCase
+from labmanager.views.opensocial import _translations_to_xml
+
+class VirtualLabTestCase(G4lTestCase):
+    def setUp(self):
+        super(VirtualLabTestCase, self).setUp()
+        RESPONSES.clear()
+        self.rlms = RLMS(kind = u'Virtual labs', url = u'http://example.com/', name = u'Virtual', location = u'Bilbao', version = u'0.1',
+                         configuration = json.dumps({ 'web' : 'http://example.com/lab.html', 'web_name' : 'lab', 'height' : '400px' }))
+        db.session.add(self.rlms)
+        lab = Laboratory(name = u'lab', laboratory_id = u'lab', rlms = self.rlms, visibility = u'public', available = True)
+        lab.publicly_available = True
+        lab.public_identifier = u'public-lab'
+        db.session.add(lab)
+        db.session.commit()
+
+        self.calls = []
+        self.original_list_widgets = virtual.RLMS.__dict__['list_widgets']
+        calls = self.calls
+        original_list_widgets = self.original_list_widgets
+        def list_widgets(rlms, laboratory_id, **kwargs):
+            calls.append(laboratory_id)
+            return original_list_widgets(rlms, laboratory_id, **kwargs)
+        virtual.RLMS.list_widgets = list_widgets
+
+    def tearDown(self):
+        virtual.RLMS.list_widgets = self.original_list_widgets
+        super(VirtualLabTestCase, self).tearDown()
+
+class WidgetSnapshotTest(VirtualLabTestCase):
+    def test_snapshot_reused(self):
+        rv = self.client.get('/os/pub/public-lab/w_default.xml')
+        self.assert_200(rv)
+        self.assertIn('400px', rv.data)
+        self.assertIn('http://example.com/lab.html', rv.data)
+
+        # Request options are applied on top of the same snapshot
+        rv = self.client.get('/os/pub/public-lab/w_default.xml?height=700')
+        self.assertIn('700px', rv.data)
+        self.assertNotIn('400px', rv.data)
+        self.assertEquals([ u'lab' ], self.calls)
+
+        # The snapshot is not modified by the request options
+        self.assertEquals('400px', get_widget_snapshot(self.rlms, u'lab', u'default')['widget']['height'])
+
+    def test_invalidate_and_refresh(self):
+        get_widget_snapshot(self.rlms, u'lab', u'default')
+        self.assertEquals(1, refresh_widget_snapshots())
+        self.assertEquals(2, len(self.calls))
+
+        invalidate_widget_snapshots(self.rlms.id)
+        self.assertEquals(0, refresh_widget_snapshots())
+        get_widget_snapshot(self.rlms, u'lab', u'default')
+        self.assertEquals(3, len(self.calls))
+
+class ResponseCacheTest(VirtualLabTestCase):
+    def test_etag(self):
+        rv = self.client.get('/os/pub/public-lab/w_default.xml')
+        self.assert_200(rv)
+        etag = rv.headers['ETag']
+        self.assertIn('max-age', rv.headers['Cache-Control'])
+
+        rv = self.client.get('/os/pub/public-lab/w_default.xml', headers = { 'If-None-Match' : etag })
+        self.assertEquals(304, rv.status_code)
+        self.assertEquals('', rv.data)
+
+        rv = self.client.get('/os/pub/public-lab/languages/en_ALL.xml')
+        self.assert_200(rv)
+        self.assertIn('messagebundle', rv.data)
+
+    def test_per_host(self):
+        http = self.client.get('/os/pub/public-lab/w_default.xml')
+        self.assert_200(http)
+        https = self.client.get('/os/pub/public-lab/w_default.xml', base_url = 'https://localhost/')
+        self.assert_200(https)
+        self.assertIn('https://localhost/', https.data)
+        self.assertNotIn('http://localhost/', https.data)
+        self.assertNotEquals(http.headers['ETag'], https.headers['ETag'])
+
+        other_host = self.client.get('/os/pub/public-lab/w_default.xml', base_url = 'http://example.org/')
+        self.assertIn('http://example.org/', other_host.data)
+        self.assertNotIn('http://localhost/', other_host.data)
+
+    def test_invalidated_with_rlms_cache(self):
+        self.client.get('/os/pub/public-lab/w_default.xml')
+        self.client.get('/os/pub/public-lab/w_default.xml')
+        self.assertEquals(1, len(self.calls))
+
+        invalidate_widget_snapshots(self.rlms.id)
+        self.client.get('/os/pub/public-lab/w_default.xml')
+        self.assertEquals(2, len(self.calls))
+
+class CapabilitiesTest(VirtualLabTestCase):
+    def setUp(self):
+        super(CapabilitiesTest, self).setUp()
+        refresh_capabilities()
+        self.capability_calls = []
+        self.original_get_capabilities = virtual.RLMS.__dict__['get_capabilities']
+        capability_calls = self.capability_calls
+        original_get_capabilities = self.original_get_capabilities
+        def counting_get_capabilities(rlms):
+            capability_calls.append(rlms)
+            return original_get_capabilities(rlms)
+        virtual.RLMS.get_capabilities = counting_get_capabilities
+
+    def tearDown(self):
+        virtual.RLMS.get_capabilities = self.original_get_capabilities
+        super(CapabilitiesTest, self).tearDown()
+
+    def test_memoized_per_instance(self):
+        rlms_db = db.session.query(RLMS).filter_by(name = u'Virtual').first()
+        self.assertEquals(get_capabilities(rlms_db), get_capabilities(rlms_db))
+        self.assertEquals([ { 'name' : 'default', 'description' : 'Default widget' } ], [ dict(name = w['name'], description = w['description']) for w in get_widgets(rlms_db, rlms_db.get_rlms(), u'lab') ])
+        self.assertEquals(1, len(self.capability_calls))
+
+        refresh_capabilities(rlms_db.id)
+        get_capabilities(rlms_db)
+        self.assertEquals(2, len(self.capability_calls))
+
+        # A new configuration is a new instance
+        rlms_db.configuration = json.dumps({ 'web' : 'http://example.com/other.html', 'web_name' : 'lab' })
+        get_capabilities(rlms_db)
+        self.assertEquals(3, len(self.capability_calls))
+
+class TranslationsXmlTest(unittest.TestCase):
+    def test_serialization(self):
+        bundle = {
+            'mails' : [ 'a@example.com', 'b@example.com' ],
+            'translations' : {
+                'en' : {
+                    'second' : { 'value' : u'Caf\xe9 <b> & "more"', 'category' : 'c' },
+                    'first' : { 'value' : 'First', 'namespace' : 'http://ns' },
+                    'empty' : { 'value' : '' },
+                    'ignored' : { 'namespace' : 'http://ns' },
+                }
+            }
+        }
+        expected = ("<?xml version='1.0' encoding='UTF-8'?>\n"
+                    '<messagebundle automatic="false" mails="a@example.com,b@example.com">\n'
+                    '  <msg name="empty" />\n'
+                    '  <msg name="first" namespace="http://ns">First</msg>\n'
+                    '  <msg category="c" name="second">Caf\xc3\xa9 &lt;b&gt; &amp; "more"</msg>\n'
+                    '</messagebundle>\n')
+        self.assertEquals(expected, _translations_to_xml(bundle, 'en'))
+        self.assertEquals("<?xml version='1.0' encoding='UTF-8'?>\n<messagebundle automatic=\"false\" mails=\"a@example.com,b@example.com\" />", _translations_to_xml(bundle, 'es'))
+
+    def test_memoized_per_version(self):
+        bundle = { 'translations' : { 'en' : { 'key' : { 'value' : 'old' } } } }
+        self.assertIn('old', _translations_to_xml(bundle, 'en', version = 'test-memo'))
+        bundle['translations']['en']['key']['value'] = 'new'
+        self.assertIn('old', _translations_to_xml(bundle, 'en', version = 'test-memo'))
+        self.assertIn('new', _translations_to_xml(bundle, 'en', version = 'test-memo-2'))
+
+class SharedTranslationsTest(G4lTestCase):
+    def setUp(self):
+        super(SharedTranslationsTest, self).setUp()
+        RESPONSES.clear()
+        rlms = RLMS(kind = u'Virtual labs', url = u'http://example.com/', name = u'Virtual', location = u'Bilbao', version = u'0.1',
+                    configuration = json.dumps({ 'web' : 'http://example.com/lab.html', 'web_name' : 'lab', 'translation_url' : 'http://example.com/translations.json' }))
+        db.session.add(rlms)
+        lab = Laboratory(name = u'lab', laboratory_id = u'lab', rlms = rlms, visibility = u'public', available = True)
+        lab.publicly_available = True
+        lab.public_identifier = u'public-lab'
+        db.session.add(lab)
+        db.session.commit()
+
+        # As if it was stored in the cache of the plug-in
+        self.shared = { 'translations' : { 'en' : { 'lab_title' : { 'value' : 'Lab' } } } }
+        shared = self.shared
+        self.original_get_translations = virtual.RLMS.__dict__['get_translations']
+        virtual.RLMS.get_translations = lambda rlms, laboratory_id, **kwargs: shared
+
+    def tearDown(self):
+        virtual.RLMS.get_translations = self.original_get_translations
+        super(SharedTranslationsTest, self).tearDown()
+
+    def test_defaults_do_not_modify_shared_translations(self):
+        rv = self.client.get('/os/pub/public-lab/languages/en_ALL.xml')
+        self.assert_200(rv)
+        self.assertIn('lab_title', rv.data)
+        self.assertIn('g4l_system', rv.data)
+        self.assertEquals({ 'translations' : { 'en' : { 'lab_title' : { 'value' : 'Lab' } } } }, self.shared)
+
+        rv = self.client.get('/os/pub/public-lab/languages/es_ALL.xml')
+        self.assertNotIn('g4l_system', rv.data)
@@ -0,0 +1,269 @@
+import json
+import time
+import datetime
+import unittest
+
+from labmanager.db import db
+from labmanager.models import RLMS, Laboratory, RepositoryMetadata
+from labmanager.rlms.ext import virtual
+from labmanager.rlms.queue import fan_out, FanOutTimeout
+from labmanager.views import repository
+from labmanager.tests.util import G4lTestCase
+
+class RepositoryTestCase(G4lTestCase):
+    def setUp(self):
+        super(RepositoryTestCase, self).setUp()
+        repository.clear_failed_sources()
+        self.public_rlms = self._add_rlms(u'Public RLMS', u'http://example.com/rlms.html')
+        self.public_rlms.publicly_available = True
+        self.public_rlms.public_identifier = u'public-rlms'
+
+        lab_rlms = self._add_rlms(u'Lab RLMS', u'http://example.com/lab.html')
+        self.lab = Laboratory(name = u'lab', laboratory_id = u'Lab RLMS', rlms = lab_rlms, visibility = u'public', available = True)
+        self.lab.publicly_available = True
+        self.lab.public_identifier = u'public-lab'
+        db.session.add(self.lab)
+        db.session.commit()
+        self.public_rlms_id = self.public_rlms.id
+
+        self.calls = []
+        self.original_get_laboratories = virtual.RLMS.__dict__['get_laboratories']
+        calls = self.calls
+        original_get_laboratories = self.original_get_laboratories
+        def get_laboratories(rlms, **kwargs):
+            calls.append(rlms.name)
+            return original_get_laboratories(rlms, **kwargs)
+        virtual.RLMS.get_laboratories = get_laboratories
+
+    def tearDown(self):
+        virtual.RLMS.get_laboratories = self.original_get_laboratories
+        repository.clear_failed_sources()
+        super(RepositoryTestCase, self).tearDown()
+
+    def _add_rlms(self, name, web):
+        rlms = RLMS(kind = u'Virtual labs', url = u'http://example.com/', name = name, location = u'Bilbao', version = u'0.1',
+                         configuration = json.dumps({ 'web' : web, 'web_name' : name }))
+        db.session.add(rlms)
+        return rlms
+
+    def _get_json(self, url, **kwargs):
+        rv = self.client.get(url, **kwargs)
+        self.assert_200(rv)
+        return json.loads(rv.data)
+
+class IncrementalMetadataTest(RepositoryTestCase):
+    def test_metadata_stored(self):
+        resources = self._get_json('/repo/metadata.json')['resources']
+        self.assertEquals([ u'Lab RLMS', u'Public RLMS' ], [ resource['title'] for resource in resources ])
+        self.assertEquals(u'http://localhost/os/pub/public-lab/w_default.xml', resources[0]['lab_apps'][0]['app_url'])
+        self.assertEquals(2, len(self.calls))
+
+        # Stored: the RLMSs are not asked again, in any format
+        self.assertEquals(resources, self._get_json('/repo/metadata.json')['resources'])
+        rv = self.client.get('/repo/metadata.xml')
+        self.assert_200(rv)
+        self.assertIn('<title>Public RLMS</title>', rv.data)
+        self.assertEquals(2, len(self.calls))
+        self.assertEquals(2, db.session.query(RepositoryMetadata).count())
+
+    def test_only_changed_sources_rebuilt(self):
+        self.client.get('/repo/metadata.json').data
+        public_rlms = db.session.query(RLMS).filter_by(public_identifier = u'public-rlms').first()
+        public_rlms.configuration = json.dumps({ 'web' : 'http://example.com/new.html', 'web_name' : u'Public RLMS' })
+        db.session.commit()
+
+        resources = self._get_json('/repo/metadata.json')['resources']
+        # The RLMSs are asked in parallel
+        self.assertEquals([ u'Lab RLMS', u'Public RLMS', u'Public RLMS' ], sorted(self.calls))
+        self.assertEquals(2, len(resources))
+
+    def test_conditional_requests(self):
+        # Built and stored before the response starts
+        rv = self.client.get('/repo/metadata.json')
+        self.assertEquals(2, db.session.query(RepositoryMetadata).count())
+        etag = rv.headers['ETag']
+        rv.data
+
+        rv = self.client.get('/repo/metadata.json')
+        rv.data
+        self.assertEquals(etag, rv.headers['ETag'])
+        last_modified = rv.headers['Last-Modified']
+
+        rv = self.client.get('/repo/metadata.json', headers = { 'If-None-Match' : etag })
+        self.assertEquals(304, rv.status_code)
+
+        rv = self.client.get('/repo/metadata.json', headers = { 'If-Modified-Since' : last_modified })
+        self.assertEquals(304, rv.status_code)
+
+        # Rebuilt, but with the same contents: still the same ETag
+        self.client.get('/repo/metadata.json?nocache=1').data
+        rv = self.client.get('/repo/metadata.json', headers = { 'If-None-Match' : etag })
+        self.assertEquals(304, rv.status_code)
+
+    def test_since(self):
+        before = (datetime.datetime.utcnow() - datetime.timedelta(seconds = 1)).strftime('%Y-%m-%dT%H:%M:%S')
+        contents = self._get_json('/repo/metadata.json?since=%s' % before)
+        self.assertEquals(2, len(contents['resources']))
+        self.assertEquals([], contents['deleted'])
+
+        after = (datetime.datetime.utcnow() + datetime.timedelta(seconds = 1)).strftime('%Y-%m-%dT%H:%M:%S')
+        contents = self._get_json('/repo/metadata.json?since=%s' % after)
+        self.assertEquals([], contents['resources'])
+
+        deleted_id = self._get_json('/repo/metadata.json')['resources'][0]['id']
+        lab = db.session.query(Laboratory).filter_by(public_identifier = u'public-lab').first()
+        lab.publicly_available = False
+        db.session.commit()
+        contents = self._get_json('/repo/metadata.json?since=%s' % before)
+        self.assertEquals([ u'Public RLMS' ], [ resource['title'] for resource in contents['resources'] ])
+        self.assertEquals([ deleted_id ], contents['deleted'])
+
+        rv = self.client.get('/repo/metadata.xml?since=%s' % before)
+        self.assertIn('<id>%s</id>' % deleted_id, rv.data)
+
+        rv = self.client.get('/repo/metadata.json?since=yesterday')
+        self.assertEquals(400, rv.status_code)
+
+    def test_host_independent(self):
+        resources = self._get_json('/repo/metadata.json')['resources']
+        modified = db.session.query(RepositoryMetadata.modified).order_by(RepositoryMetadata.id).all()
+
+        https_resources = self._get_json('/repo/metadata.json', base_url = 'https://example.org/')['resources']
+        self.assertEquals(2, len(self.calls))
+        self.assertEquals(modified, db.session.query(RepositoryMetadata.modified).order_by(RepositoryMetadata.id).all())
+
+        self.assertEquals(u'http://localhost/os/pub/public-lab/w_default.xml', resources[0]['lab_apps'][0]['app_url'])
+        # The widgets are linked through http
+        self.assertEquals(u'http://example.org/os/pub/public-lab/w_default.xml', https_resources[0]['lab_apps'][0]['app_url'])
+        self.assertTrue(https_resources[0]['lab_apps'][0]['external_url'].startswith(u'https://example.org/repo/preview/'))
+
+        rv = self.client.get('/repo/metadata.xml', base_url = 'https://example.org/')
+        self.assertIn('<appUrl>http://example.org/os/pub/public-lab/w_default.xml</appUrl>', rv.data)
+
+    def test_deleted_ids_pruned(self):
+        deleted_id = self._get_json('/repo/metadata.json')['resources'][0]['id']
+        lab = db.session.query(Laboratory).filter_by(public_identifier = u'public-lab').first()
+        lab.publicly_available = False
+        db.session.commit()
+        self.client.get('/repo/metadata.json').data
+
+        entry = db.session.query(RepositoryMetadata).filter_by(fingerprint = None).one()
+        deleted = (datetime.datetime.utcnow() - datetime.timedelta(days = 40)).strftime('%Y-%m-%dT%H:%M:%S')
+        self.assertEquals([ deleted_id ], [ resource_id for resource_id, _ in json.loads(entry.deleted_ids) ])
+        entry.deleted_ids = json.dumps([ [ deleted_id, deleted ] ])
+        db.session.commit()
+
+        # Too old to know what was deleted since then: the complete list is sent
+        contents = self._get_json('/repo/metadata.json?since=%s' % deleted)
+        self.assertNotIn('deleted', contents)
+        self.assertEquals([ u'Public RLMS' ], [ resource['title'] for resource in contents['resources'] ])
+
+        # Once forgotten, the source is removed
+        self.client.get('/repo/metadata.json').data
+        self.assertEquals(0, db.session.query(RepositoryMetadata).filter_by(fingerprint = None).count())
+
+class FanOutTest(unittest.TestCase):
+    def test_order_and_errors(self):
+        def failing():
+            raise ValueError("RLMS down")
+
+        def slow(value):
+            def call():
+                time.sleep(0.05)
+                return value
+            return call
+
+        results = fan_out([ slow(1), failing, lambda : 3, slow(4) ], threads = 2, timeout = 5)
+        self.assertEquals([ 1, None, 3, 4 ], [ result for result, _ in results ])
+        self.assertTrue(isinstance(results[1][1], ValueError))
+
+    def test_timeout(self):
+        results = fan_out([ lambda : time.sleep(2), lambda : 2, lambda : 3 ], threads = 1, timeout = 0.2)
+        self.assertTrue(isinstance(results[0][1], FanOutTimeout))
+        # The rest were still called, even if the only thread was blocked
+        self.assertEquals([ 2, 3 ], [ result for result, _ in results[1:] ])
+
+class PartialMetadataTest(RepositoryTestCase):
+    def test_slow_rlms(self):
+        original_get_laboratories = virtual.RLMS.get_laboratories
+        def get_laboratories(rlms, **kwargs):
+            if rlms.name == u'Public RLMS':
+                time.sleep(1)
+            return original_get_laboratories(rlms, **kwargs)
+        virtual.RLMS.get_laboratories = get_laboratories
+
+        original_timeout = repository.REPOSITORY_RLMS_TIMEOUT
+        repository.REPOSITORY_RLMS_TIMEOUT = 0.2
+        try:
+            contents = self._get_json('/repo/metadata.json')
+            xml_contents = self.client.get('/repo/metadata.xml').data
+        finally:
+            repository.REPOSITORY_RLMS_TIMEOUT = original_timeout
+
+        self.assertEquals([ u'Lab RLMS' ], [ resource['title'] for resource in contents['resources'] ])
+        self.assertEquals([ { 'source' : u'rlms:%s' % self.public_rlms_id, 'name' : u'Public RLMS', 'error' : 'timeout' } ], contents['errors'])
+        self.assertIn('<error>timeout</error>', xml_contents)
+
+        # Once it is retried, it is added
+        original_retry_after = repository.REPOSITORY_RETRY_AFTER
+        repository.REPOSITORY_RETRY_AFTER = 0
+        try:
+            contents = self._get_json('/repo/metadata.json')
+        finally:
+            repository.REPOSITORY_RETRY_AFTER = original_retry_after
+        self.assertEquals([ u'Lab RLMS', u'Public RLMS' ], [ resource['title'] for resource in contents['resources'] ])
+        self.assertNotIn('errors', contents)
+
+    def test_failed_rlms_backoff(self):
+        self.client.get('/repo/metadata.json').data
+        public_rlms = db.session.query(RLMS).filter_by(public_identifier = u'public-rlms').first()
+        public_rlms.configuration = json.dumps({ 'web' : 'http://example.com/new.html', 'web_name' : u'Public RLMS' })
+        db.session.commit()
+
+        original_get_laboratories = virtual.RLMS.get_laboratories
+        def get_laboratories(rlms, **kwargs):
+            if rlms.name == u'Public RLMS':
+                raise Exception("RLMS down")
+            return original_get_laboratories(rlms, **kwargs)
+        virtual.RLMS.get_laboratories = get_laboratories
+
+        for _ in range(3):
+            contents = self._get_json('/repo/metadata.json')
+            # The stored metadata is still served
+            self.assertEquals([ u'Lab RLMS', u'Public RLMS' ], [ resource['title'] for resource in contents['resources'] ])
+            self.assertEquals('error', contents['errors'][0]['error'])
+        # Asked only once after the change
+        self.assertEquals([ u'Lab RLMS', u'Public RLMS' ], sorted(self.calls))
+
+class StreamingSerializersTest(unittest.TestCase):
+    RESOURCES = [
+        { 'id' : u'a', 'title' : u'Lab & <co>', 'labApps' : [ { 'labApp' : { 'appUrl' : u'http://example.com/?a=1&b=2', 'appTitle' : u'default' } } ],
+          'domains' : { 'domain' : [] }, 'ageRanges' : { 'ageRange' : [ u'12-13' ] }, 'keywords' : {} },
+        { 'id' : u'b', 'title' : u'\xd1and\xfa', 'labApps' : [], 'domains' : { 'domain' : [ u'Physics', u'Chemistry' ] },
+          'ageRanges' : { 'ageRange' : [] }, 'keywords' : { 'keyword' : [ u'k' ] } },
+    ]
+
+    def _items(self):
+        # Two sources, one of them failing, and one empty
+        return [ (self.RESOURCES[:1], [], None), ([], [], { 'source' : u'rlms:1', 'name' : u'RLMS', 'error' : 'timeout' }), (self.RESOURCES[1:], [ u'c' ], None) ]
+
+    def test_xml(self):
+        contents = ''.join(repository.serialize_xml(self._items()))
+        expected = repository.dict2xml({ 'resources' : { 'resource' : self.RESOURCES, 'errors' : { 'error' : [ { 'source' : u'rlms:1', 'name' : u'RLMS', 'error' : 'timeout' } ] } } })
+        # Same elements, but resources first
+        self.assertEquals(sorted(expected.encode('utf8').split('\n')), sorted(contents.split('\n')))
+        self.assertTrue(contents.startswith('<resources>\n  <resource>\n'))
+
+        contents = ''.join(repository.serialize_xml([ (self.RESOURCES, [], None) ]))
+        self.assertEquals(repository.dict2xml({ 'resources' : { 'resource' : self.RESOURCES } }).encode('utf8'), contents)
+
+        contents = ''.join(repository.serialize_xml([]))
+        self.assertEquals(repository.dict2xml({ 'resources' : { 'resource' : [] } }), contents)
+
+    def test_json(self):
+        contents = json.loads(''.join(repository.serialize_json(self._items(), since = datetime.datetime.utcnow())))
+        self.assertEquals(self.RESOURCES, contents['resources'])
+        self.assertEquals([ u'c' ], contents['deleted'])
+        self.assertEquals(1, len(contents['errors']))
+
+        self.assertEquals({ 'resources' : [] }, json.loads(''.join(repository.serialize_json([]))))
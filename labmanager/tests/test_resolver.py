@@ -0,0 +1,42 @@
+from labmanager.db import db
+from labmanager.models import Laboratory
+from labmanager.resolver import resolve_lab
+from labmanager.tests.util import G4lTestCase
+
+class ResolveLabTest(G4lTestCase):
+    def test_permission(self):
+        resolution = resolve_lab(u'robot', u'school1')
+        self.assertEquals(u'school1', resolution.institution.name)
+        self.assertEquals(u'robot', resolution.permission.local_identifier)
+        self.assertEquals(u'school1', resolution.permission.lt.name)
+        self.assertIsNone(resolution.public_laboratory)
+        self.assertEquals(resolution.permission.laboratory, resolution.laboratory)
+        self.assertEquals(resolution.laboratory.rlms, resolution.rlms)
+
+    def test_not_found(self):
+        resolution = resolve_lab(u'robot', u'does-not-exist')
+        self.assertIsNone(resolution.institution)
+        self.assertIsNone(resolution.laboratory)
+
+        resolution = resolve_lab(u'not-a-lab', u'school1')
+        self.assertEquals(u'school1', resolution.institution.name)
+        self.assertIsNone(resolution.permission)
+        self.assertIsNone(resolve_lab(u'not-a-lab').laboratory)
+
+    def test_public(self):
+        self.assertIsNone(resolve_lab(u'public-robot').laboratory)
+
+        lab = db.session.query(Laboratory).filter_by(name = u'robot-movement@Robot experiments').first()
+        lab.publicly_available = True
+        lab.public_identifier = u'public-robot'
+        db.session.commit()
+
+        self.assertEquals(lab, resolve_lab(u'public-robot').laboratory)
+        resolution = resolve_lab(u'public-robot', u'school2')
+        self.assertEquals(lab, resolution.public_laboratory)
+        self.assertEquals(lab.rlms, resolution.rlms)
+        self.assertEquals(u'school2', resolution.institution.name)
+
+        resolution = resolve_lab(u'public-robot', u'does-not-exist')
+        self.assertEquals(lab, resolution.laboratory)
+        self.assertIsNone(resolution.institution)
@@ -0,0 +1,53 @@
+import os
+import zipfile
+import unittest
+import StringIO
+
+from labmanager import scorm
+
+class ScormPackageTest(unittest.TestCase):
+    def _open(self, contents):
+        return zipfile.ZipFile(StringIO.StringIO(contents))
+
+    def test_package(self):
+        zf = self._open(scorm.get_scorm_object(False, u'my-lab', u'/moodle/', u'/ext/'))
+        self.assertEquals(None, zf.testzip())
+
+        base_scorm_dir = scorm._get_base_scorm_dir()
+        expected = sorted(os.path.join(root[len(base_scorm_dir)+1:], f) for root, _, files in os.walk(base_scorm_dir) for f in files)
+        self.assertEquals(expected, sorted(zf.namelist()))
+
+        lab_html = zf.read('lab.html')
+        self.assertIn('lab.load("my-lab");', lab_html)
+        self.assertIn('new Laboratory("/moodle/", "/ext/");', lab_html)
+        self.assertIn('//lab.authenticate();', lab_html)
+        self.assertEquals(open(os.path.join(base_scorm_dir, 'imsmanifest.xml'), 'rb').read(), zf.read('imsmanifest.xml'))
+
+    def test_streamed(self):
+        template = scorm.get_scorm_template()
+        self.assertTrue(template is scorm.get_scorm_template())
+
+        chunks = list(template.iter_zip(True))
+        # One chunk per file, plus the central directory
+        self.assertEquals(len(template.files) + 2, len(chunks))
+        zf = self._open(''.join(chunks))
+        self.assertIn('%slab.load' % '//', zf.read('lab.html'))
+
+        # Same contents every time
+        self.assertEquals(''.join(chunks), ''.join(template.iter_zip(True)))
+
+    def test_lms_paths(self):
+        self.assertEquals(('/moodle/', '/'), scorm.get_lms_paths('http://example.com/moodle/'))
+        self.assertEquals(('/moodle/', '/ext.php'), scorm.get_lms_paths('http://example.com/moodle/gateway4labs/lms/list/ext.php'))
+        self.assertEquals(('/', '/'), scorm.get_lms_paths(''))
+
+    def test_bundle(self):
+        template = scorm.get_scorm_template()
+        chunks = list(template.iter_bundle([ u'lab1', u'lab2' ], u'/moodle/', u'/'))
+        self.assertEquals(3, len(chunks))
+
+        bundle = self._open(''.join(chunks))
+        self.assertEquals([ 'scorm_lab1.zip', 'scorm_lab2.zip' ], bundle.namelist())
+        for laboratory_identifier in (u'lab1', u'lab2'):
+            package = bundle.read('scorm_%s.zip' % laboratory_identifier)
+            self.assertEquals(scorm.get_scorm_object(False, laboratory_identifier, u'/moodle/', u'/'), package)
@@ -0,0 +1,152 @@
+import json
+import time
+import unittest
+
+from flask import url_for
+
+from labmanager.db import db
+from labmanager.models import RLMS, Laboratory
+from labmanager.rlms import Capabilities, Laboratory as RLMSLaboratory, UrlPrefixTrie, LabsByUrl, LABS_BY_URL, refresh_capabilities, refresh_base_urls
+from labmanager.rlms import find_smartgateway_link, find_smartgateway_opensocial_link, find_smartgateway_html_link
+from labmanager.rlms.ext import virtual
+from labmanager.tests.util import G4lTestCase
+
+class UrlPrefixTrieTest(unittest.TestCase):
+    def test_lookup(self):
+        trie = UrlPrefixTrie()
+        trie.add('http://example.com/', 1)
+        trie.add('http://example.com/labs/', 2)
+        trie.add('http://example.org/', 3)
+        trie.add('http://example.com/', 4)
+        self.assertEquals([ 1, 4, 2 ], trie.lookup('http://example.com/labs/lab1'))
+        self.assertEquals([ 1, 4 ], trie.lookup('http://example.com/'))
+        self.assertEquals([], trie.lookup('http://example.net/labs/'))
+        self.assertEquals([], trie.lookup('http://'))
+
+class LabsByUrlTest(unittest.TestCase):
+    def test_ttl_and_bounds(self):
+        labs_by_url = LabsByUrl(ttl = 60, not_found_ttl = 0.1, max_entries = 2)
+        labs_by_url.set(1, 'http://example.com/a', 'a')
+        labs_by_url.set(1, 'http://example.com/b', None)
+        self.assertEquals((True, 'a'), labs_by_url.get(1, 'http://example.com/a'))
+        self.assertEquals((True, None), labs_by_url.get(1, 'http://example.com/b'))
+        self.assertEquals((False, None), labs_by_url.get(2, 'http://example.com/a'))
+
+        time.sleep(0.2)
+        # Not found results expire first
+        self.assertEquals((False, None), labs_by_url.get(1, 'http://example.com/b'))
+        self.assertEquals((True, 'a'), labs_by_url.get(1, 'http://example.com/a'))
+
+        labs_by_url.set(2, 'http://example.com/c', 'c')
+        labs_by_url.set(2, 'http://example.com/d', 'd')
+        self.assertEquals((False, None), labs_by_url.get(1, 'http://example.com/a'))
+
+        labs_by_url.forget(2)
+        self.assertEquals((False, None), labs_by_url.get(2, 'http://example.com/c'))
+
+class SmartGatewayTest(G4lTestCase):
+    def setUp(self):
+        super(SmartGatewayTest, self).setUp()
+        self.calls = []
+        calls = self.calls
+
+        self.original_methods = dict(virtual.RLMS.__dict__)
+        original_get_capabilities = virtual.RLMS.get_capabilities
+
+        def get_capabilities(rlms):
+            return original_get_capabilities(rlms) + [ Capabilities.URL_FINDER ]
+
+        def get_base_urls(rlms):
+            return [ rlms.web ]
+
+        def get_lab_by_url(rlms, url):
+            calls.append(rlms.name)
+            if url.startswith(rlms.web + 'lab/'):
+                return RLMSLaboratory(url, url, autoload = True)
+            return None
+
+        virtual.RLMS.get_capabilities = get_capabilities
+        virtual.RLMS.get_base_urls = get_base_urls
+        virtual.RLMS.get_lab_by_url = get_lab_by_url
+
+        public_rlms = self._add_rlms(u'Public', u'http://public.example.com/')
+        public_rlms.publicly_available = True
+        public_rlms.public_identifier = u'public-rlms'
+
+        private_rlms = self._add_rlms(u'Private', u'http://private.example.com/')
+        self._add_rlms(u'Other', u'http://other.example.com/')
+        lab = Laboratory(name = u'lab', laboratory_id = u'http://private.example.com/lab/1', rlms = private_rlms, visibility = u'public', available = True)
+        lab.publicly_available = True
+        lab.public_identifier = u'private-lab'
+        db.session.add(lab)
+        db.session.commit()
+
+        refresh_capabilities()
+        refresh_base_urls()
+        LABS_BY_URL.forget()
+
+    def tearDown(self):
+        for name in ('get_capabilities', 'get_base_urls', 'get_lab_by_url'):
+            if name in self.original_methods:
+                setattr(virtual.RLMS, name, self.original_methods[name])
+            else:
+                delattr(virtual.RLMS, name)
+        refresh_capabilities()
+        refresh_base_urls()
+        LABS_BY_URL.forget()
+        super(SmartGatewayTest, self).tearDown()
+
+    def _add_rlms(self, name, web):
+        rlms = RLMS(kind = u'Virtual labs', url = u'http://example.com/', name = name, location = u'Bilbao', version = u'0.1',
+                         configuration = json.dumps({ 'web' : web, 'web_name' : name }))
+        db.session.add(rlms)
+        return rlms
+
+    def test_public_rlms(self):
+        with self.app.test_request_context():
+            url = u'http://public.example.com/lab/1'
+            self.assertEquals(url_for('bookmarklet.public_rlms', rlms_id = u'public-rlms', lab_name = url, url = u'http://back'), find_smartgateway_link(url, u'http://back'))
+            self.assertEquals(url_for('opensocial.public_rlms_widget_xml', rlms_identifier = u'public-rlms', lab_name = url, widget_name = 'default', _external = True), find_smartgateway_opensocial_link(url))
+        # Only the plug-in with that base URL is asked, and only once
+        self.assertEquals([ u'Public' ], self.calls)
+
+    def test_public_laboratory(self):
+        with self.app.test_request_context():
+            url = u'http://private.example.com/lab/1'
+            self.assertEquals(url_for('bookmarklet.public_lab', public_identifier = u'private-lab', url = u'http://back'), find_smartgateway_link(url, u'http://back'))
+            self.assertEquals(url_for('opensocial.public_widget_html', lab_name = u'private-lab', widget_name = 'default', _external = True), find_smartgateway_html_link(url))
+
+            # Found by the plug-in, but not publicly available
+            self.assertEquals(None, find_smartgateway_link(u'http://private.example.com/lab/2', u'http://back'))
+        self.assertEquals([ u'Private' ] * 2, self.calls)
+
+    def test_not_found(self):
+        with self.app.test_request_context():
+            self.assertEquals(None, find_smartgateway_link(u'http://unknown.example.com/lab/1', u'http://back'))
+            self.assertEquals(None, find_smartgateway_html_link(u'http://other.example.com/lab'))
+        self.assertEquals([ u'Other' ], self.calls)
+
+    def test_rlms_changes(self):
+        with self.app.test_request_context():
+            self.assertEquals(None, find_smartgateway_link(u'http://new.example.com/lab/1', u'http://back'))
+            new_rlms = self._add_rlms(u'New', u'http://new.example.com/')
+            new_rlms.publicly_available = True
+            new_rlms.public_identifier = u'new-rlms'
+            db.session.commit()
+            self.assertNotEquals(None, find_smartgateway_link(u'http://new.example.com/lab/1', u'http://back'))
+
+    def test_not_found_memoized(self):
+        with self.app.test_request_context():
+            for _ in range(3):
+                self.assertEquals(None, find_smartgateway_opensocial_link(u'http://public.example.com/other'))
+        self.assertEquals([ u'Public' ], self.calls)
+
+    def test_configuration_changes(self):
+        with self.app.test_request_context():
+            url = u'http://public.example.com/lab/1'
+            find_smartgateway_link(url, u'http://back')
+            public_rlms = db.session.query(RLMS).filter_by(public_identifier = u'public-rlms').first()
+            public_rlms.configuration = json.dumps({ 'web' : u'http://public.example.com/', 'web_name' : u'Public (new)' })
+            db.session.commit()
+            find_smartgateway_link(url, u'http://back')
+        self.assertEquals([ u'Public', u'Public (new)' ], self.calls)
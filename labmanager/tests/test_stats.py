@@ -0,0 +1,79 @@
+import json
+import datetime
+import unittest
+
+from labmanager.db import db
+from labmanager.golabz import golabz_labs, composer_status
+from labmanager.models import UseLog
+from labmanager.tests.util import G4lTestCase
+from labmanager.views.stats import top_urls_per_period, iter_use_logs
+
+class TopUrlsTest(unittest.TestCase):
+    def test_top_per_period(self):
+        rows = [
+            (5, 2018, 1, u'http://a'),
+            (7, 2018, 1, u'http://b'),
+            (1, 2018, 1, u'http://c'),
+            (9, 2018, 1, u'http://d'),
+            (3, 2018, 2, u'http://a'),
+        ]
+        results = top_urls_per_period(rows, 2, { u'http://d' : { 'title' : 'D' } })
+        self.assertEquals([ u'http://d', u'http://b' ], [ r['url'] for r in results[2018, 1] ])
+        self.assertEquals({ 'title' : 'D' }, results[2018, 1][0]['data'])
+        self.assertEquals([ 3 ], [ r['count'] for r in results[2018, 2] ])
+
+    def test_filter_keeps_period(self):
+        rows = [ (5, 2018, 12, u'http://a') ]
+        results = top_urls_per_period(rows, 10, {}, lambda url, data: False)
+        self.assertEquals({ (2018, 12) : [] }, results)
+
+class StatsViewsTest(G4lTestCase):
+    def setUp(self):
+        super(StatsViewsTest, self).setUp()
+        self.app.config['EASYADMIN_KEY'] = 'secret-key'
+        golabz_labs.set_source(lambda : [ { 'title' : 'Lab A', 'lab_golabz_page' : 'http://golabz/a', 'lab_apps' : [ { 'app_url' : u'http://a' } ] } ])
+        composer_status.set_source(lambda : { 'failing' : [], 'flash' : [], 'ssl' : [] })
+        for n, url in enumerate([u'http://a', u'http://a', u'http://b']):
+            log = UseLog(url = url, ip_address = u'127.0.0.0', web_browser = u'Mozilla', user_agent = None, timezone_minutes = 0, lang_header = None, dtime = datetime.datetime(2018, 1, n + 1))
+            log.city = u'Bilbao'
+            log.country = u'ES'
+            db.session.add(log)
+        db.session.commit()
+
+    def test_monthly(self):
+        rv = self.client.get('/stats/monthly?key=secret-key&n=1')
+        self.assert_200(rv)
+        self.assertIn('Lab A', rv.data)
+        self.assertNotIn('http://b', rv.data)
+
+    def test_yearly(self):
+        rv = self.client.get('/stats/yearly?key=secret-key')
+        self.assert_200(rv)
+        self.assertIn('Lab A', rv.data)
+        self.assertIn('http://b', rv.data)
+
+    def test_iter_use_logs_chunks(self):
+        rows = list(iter_use_logs(chunk_days = 1))
+        self.assertEquals([ u'http://a', u'http://a', u'http://b' ], [ row.url for row in rows ])
+        rows = list(iter_use_logs(start = datetime.date(2018, 1, 2), end = datetime.date(2018, 1, 3), url = u'http://a'))
+        self.assertEquals(1, len(rows))
+
+    def test_export_csv(self):
+        rv = self.client.get('/stats/export.csv?key=secret-key&country=ES&start=2018-01-01&end=2018-01-02')
+        self.assert_200(rv)
+        lines = rv.data.strip().splitlines()
+        self.assertTrue(lines[0].startswith('id,datetime,'))
+        self.assertEquals(3, len(lines))
+        self.assertNotIn('127.0.0.0', rv.data)
+
+    def test_export_json(self):
+        rv = self.client.get('/stats/export.json?key=secret-key&url=http://b')
+        self.assert_200(rv)
+        records = [ json.loads(line) for line in rv.data.strip().splitlines() ]
+        self.assertEquals(1, len(records))
+        self.assertEquals(u'http://b', records[0]['url'])
+        self.assertEquals(u'2018-01-03T00:00:00', records[0]['datetime'])
+
+    def test_export_invalid(self):
+        self.assert_400(self.client.get('/stats/export.xls?key=secret-key'))
+        self.assert_400(self.client.get('/stats/export.csv?key=secret-key&start=yesterday'))
@@ -0,0 +1,60 @@
+import datetime
+
+from labmanager.db import db
+from labmanager.models import GoLabOAuthUser, EmbedApplication, EmbedApplicationTranslation
+from labmanager.sync import sync_embed_applications
+from labmanager.tests.util import G4lTestCase
+
+class SyncEmbedApplicationsTest(G4lTestCase):
+    def setUp(self):
+        super(SyncEmbedApplicationsTest, self).setUp()
+        owner = GoLabOAuthUser(email = u'old@example.com', display_name = u'Old')
+        existing = EmbedApplication(url = u'http://example.com/old', name = u'Old app', owner = owner, identifier = u'old-app',
+                                    creation = datetime.datetime(2015, 1, 1), last_update = datetime.datetime(2015, 1, 1))
+        db.session.add(EmbedApplicationTranslation(embed_application = existing, url = u'http://example.com/old/es', language = u'es'))
+        db.session.add(existing)
+        db.session.commit()
+
+    def _contents(self):
+        return {
+            'users' : [ { 'email' : u'old@example.com', 'display_name' : u'Old (renamed)' }, { 'email' : u'new@example.com', 'display_name' : u'New' } ],
+            'apps' : [
+                { 'identifier' : u'old-app', 'url' : u'http://example.com/old', 'name' : u'Old app', 'height' : None, 'scale' : None,
+                  'creation' : '2015-01-01T00:00:00', 'last_update' : '2015-01-01T00:00:00', 'owner_mail' : u'old@example.com',
+                  'translations' : [ { 'language' : u'es', 'url' : u'http://example.com/old/es-ES' }, { 'language' : u'fr', 'url' : u'http://example.com/old/fr' } ] },
+                { 'identifier' : u'new-app', 'url' : u'http://example.com/new', 'name' : u'New app', 'height' : 500, 'scale' : 9000,
+                  'creation' : '2016-01-01T00:00:00', 'last_update' : '2016-02-01T00:00:00', 'owner_mail' : u'new@example.com',
+                  'translations' : [ { 'language' : u'es', 'url' : u'http://example.com/new/es' }, { 'language' : u'fr', 'url' : u'http://example.com/new/fr' } ] },
+            ]
+        }
+
+    def test_dry_run(self):
+        report = sync_embed_applications(self._contents(), dry_run = True)
+        self.assertEquals({ 'inserted' : 1, 'updated' : 1, 'unchanged' : 0 }, report['users'])
+        self.assertEquals({ 'inserted' : 1, 'updated' : 0, 'unchanged' : 1 }, report['apps'])
+        self.assertEquals({ 'inserted' : 3, 'updated' : 1, 'unchanged' : 0 }, report['translations'])
+
+        self.assertEquals(1, db.session.query(GoLabOAuthUser).filter(GoLabOAuthUser.email.like(u'%@example.com')).count())
+        self.assertEquals(u'Old', db.session.query(GoLabOAuthUser).filter_by(email = u'old@example.com').one().display_name)
+        self.assertEquals(1, db.session.query(EmbedApplication).count())
+
+    def test_sync(self):
+        report = sync_embed_applications(self._contents(), batch_size = 1)
+        self.assertEquals({ 'inserted' : 3, 'updated' : 1, 'unchanged' : 0 }, report['translations'])
+
+        new_app = db.session.query(EmbedApplication).filter_by(identifier = u'new-app').one()
+        self.assertEquals(u'New', new_app.owner.display_name)
+        self.assertEquals(9000, new_app.scale)
+        self.assertEquals(datetime.datetime(2016, 2, 1), new_app.last_update)
+        self.assertEquals([], new_app.domains)
+        self.assertEquals(u'[4, 20]', new_app.age_ranges_range)
+        self.assertEquals({ u'es' : u'http://example.com/new/es', u'fr' : u'http://example.com/new/fr' }, dict((t.language, t.url) for t in new_app.translations))
+
+        old_app = db.session.query(EmbedApplication).filter_by(identifier = u'old-app').one()
+        self.assertEquals(u'Old (renamed)', old_app.owner.display_name)
+        self.assertEquals(u'http://example.com/old/es-ES', [ t.url for t in old_app.translations if t.language == u'es' ][0])
+
+        # Nothing left to do
+        report = sync_embed_applications(self._contents())
+        for name in ('users', 'apps', 'translations'):
+            self.assertEquals(0, report[name]['inserted'] + report[name]['updated'])
@@ -0,0 +1,52 @@
+import pickle
+import unittest
+
+from labmanager.translation_bundles import TranslationBundle, read_only
+
+class TranslationBundleTest(unittest.TestCase):
+    def setUp(self):
+        self.shared = {
+            'translations' : {
+                'en' : { 'lab_title' : { 'value' : 'Lab' }, 'g4l_system' : { 'value' : 'Overridden' } },
+                'es' : { 'lab_title' : { 'value' : 'Laboratorio' } },
+            },
+            'mails' : [ 'admin@example.com' ],
+        }
+        self.defaults = {
+            'en' : { 'g4l_system' : { 'value' : 'System' } },
+            'fr' : { 'g4l_system' : { 'value' : 'Systeme' } },
+        }
+
+    def test_overlay(self):
+        bundle = TranslationBundle(self.shared, self.defaults)
+        self.assertEquals([ 'en', 'es' ], sorted(bundle['translations']))
+        english = bundle['translations']['en']
+        self.assertEquals('System', english['g4l_system']['value'])
+        self.assertEquals('Lab', english['lab_title']['value'])
+        self.assertEquals(2, len(english))
+        self.assertEquals([ 'lab_title' ], list(bundle['translations']['es']))
+        self.assertEquals(('admin@example.com',), bundle['mails'])
+
+        # The shared object is not modified nor copied
+        self.assertEquals('Overridden', self.shared['translations']['en']['g4l_system']['value'])
+        self.shared['translations']['es']['lab_title']['value'] = 'Otro'
+        self.assertEquals('Otro', bundle['translations']['es']['lab_title']['value'])
+
+    def test_read_only(self):
+        bundle = TranslationBundle(self.shared, self.defaults)
+        def assign(mapping, key, value):
+            mapping[key] = value
+        self.assertRaises(TypeError, assign, bundle['translations']['en'], 'key', {})
+        self.assertRaises(TypeError, assign, bundle['translations']['es']['lab_title'], 'value', 'new')
+        self.assertFalse(hasattr(bundle['translations'], 'update'))
+
+    def test_empty(self):
+        bundle = TranslationBundle(None, self.defaults)
+        self.assertEquals(0, len(bundle['translations']))
+        self.assertEquals((), bundle['mails'])
+
+    def test_pickle(self):
+        snapshot = read_only({ 'translations' : TranslationBundle(self.shared), 'check_urls' : [ 'http://example.com/' ] })
+        restored = pickle.loads(pickle.dumps(snapshot))
+        self.assertEquals('Lab', restored['translations']['translations']['en']['lab_title']['value'])
+        self.assertEquals(('http://example.com/',), restored['check_urls'])
@@ -0,0 +1,120 @@
+# -*-*- encoding: utf-8 -*-*-
+#
+# gateway4labs is free software: you can redistribute it and/or modify
+# it under the terms of the BSD 2-Clause License
+# gateway4labs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+
+"""
+  Read-only views of the translations returned by the plug-ins. The
+  plug-ins usually return the object kept in their cache (shared by every
+  thread), so instead of copying it before adding the gateway4labs default
+  messages, it is wrapped in a TranslationBundle:
+
+    bundle = TranslationBundle(rlms.get_translations(laboratory_id), DEFAULT_TRANSLATIONS)
+    bundle['translations']['en']['g4l_system']['value'] # from DEFAULT_TRANSLATIONS
+    bundle['translations']['en']['lab_title']['value']  # from the plug-in
+
+  Nothing is copied: every nested dict is wrapped (on access) in a
+  ReadOnlyMapping, and lists are returned as tuples, so the shared object
+  can not be modified through the bundle.
+"""
+
+from collections import Mapping
+
+def read_only(value):
+    """Read-only view of value (dicts and lists are wrapped, anything else is returned as it is)."""
+    if isinstance(value, (ReadOnlyMapping, OverlayMapping)):
+        return value
+    if isinstance(value, dict):
+        return ReadOnlyMapping(value)
+    if isinstance(value, list):
+        return tuple( read_only(element) for element in value )
+    return value
+
+class ReadOnlyMapping(Mapping):
+    """Read-only view of a dict. Nested values are also read-only."""
+
+    def __init__(self, data):
+        self._data = data
+
+    def __getitem__(self, key):
+        return read_only(self._data[key])
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __repr__(self):
+        return 'ReadOnlyMapping(%r)' % (self._data,)
+
+class OverlayMapping(Mapping):
+    """Read-only view of base with the keys of overlay on top."""
+
+    def __init__(self, base, overlay):
+        self._base = base
+        self._overlay = overlay
+
+    def __getitem__(self, key):
+        if key in self._overlay:
+            return read_only(self._overlay[key])
+        return read_only(self._base[key])
+
+    def __iter__(self):
+        for key in self._base:
+            yield key
+        for key in self._overlay:
+            if key not in self._base:
+                yield key
+
+    def __len__(self):
+        return len(self._base) + len([ key for key in self._overlay if key not in self._base ])
+
+    def __contains__(self, key):
+        return key in self._overlay or key in self._base
+
+    def __repr__(self):
+        return 'OverlayMapping(%r, %r)' % (self._base, self._overlay)
+
+class _Languages(ReadOnlyMapping):
+    """Messages per language, with the default messages on top of those languages already provided."""
+
+    def __init__(self, data, defaults):
+        super(_Languages, self).__init__(data)
+        self._defaults = defaults
+
+    def __getitem__(self, language):
+        messages = self._data[language]
+        # don't add empty translations
+        if language in self._defaults:
+            return OverlayMapping(messages, self._defaults[language])
+        return read_only(messages)
+
+class TranslationBundle(Mapping):
+    """
+    Read-only {'translations' : {language : messages}, 'mails' : (...)}
+    built on top of what get_translations returns, plus the defaults
+    ({language : messages}) of the languages it provides.
+    """
+
+    def __init__(self, translations = None, defaults = None):
+        translations = translations or {}
+        self._items = {
+            'translations' : _Languages(translations.get('translations') or {}, defaults or {}),
+            'mails' : read_only(translations.get('mails') or []),
+        }
+
+    def __getitem__(self, key):
+        return self._items[key]
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
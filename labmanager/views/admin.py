@@ -1,14 +1,13 @@
 # -*-*- encoding: utf-8 -*-*-
 
 import json
-import urlparse
 import threading
 import traceback
 
 from hashlib import new as new_hash
 from yaml import load as yload
 from wtforms.fields import PasswordField, TextField
-from flask import request, redirect, url_for, session, Markup, abort, Response, flash
+from flask import request, redirect, url_for, session, Markup, abort, flash
 from flask.ext import wtf
 from flask.ext.wtf import Form
 from flask.ext.login import current_user
@@ -21,9 +20,10 @@ from labmanager.babel import gettext, lazy_gettext
 from labmanager.models import LabManagerUser, LtUser
 from labmanager.models import PermissionToCourse, RLMS, Laboratory, PermissionToLt, RequestPermissionLT
 from labmanager.models import BasicHttpCredentials, LearningTool, Course, PermissionToLtUser, ShindigCredentials, EmbedApplication, EmbedApplicationTranslation, GoLabOAuthUser
-from labmanager.rlms import get_form_class, get_supported_types, get_supported_versions, get_manager_class, Capabilities
+from labmanager.rlms import get_form_class, get_supported_types, get_supported_versions, get_manager_class, Capabilities, get_capabilities, refresh_capabilities
+from labmanager.rlms.snapshots import invalidate_widget_snapshots
 from labmanager.views import RedirectView
-from labmanager.scorm import get_scorm_object, get_authentication_scorm
+from labmanager.scorm import get_scorm_response, get_scorm_bundle_response, get_authentication_scorm
 from labmanager.db import db
 import labmanager.forms as forms
 from labmanager.utils import data_filename, remote_addr
@@ -268,11 +268,17 @@ def download(v, c, lt, p):
             return Markup('<a href="%s"> Download </a>' % (url_for('.scorm_authentication', id = lt.id)))
     return gettext('N/A')
 
+def download_packages(v, c, lt, p):
+    # lab_permissions is not checked: it would be one more query per row
+    if len(lt.basic_http_authentications) > 0:
+            return Markup('<a href="%s"> Download </a>' % (url_for('.scorm_packages', id = lt.id)))
+    return gettext('N/A')
+
 class LTPanel(L4lModelView):
     inline_models = (BasicHttpCredentialsForm(BasicHttpCredentials), ShindigCredentials)
-    column_list = ['full_name', 'name', 'url', 'download']
-    column_labels = dict(full_name=lazy_gettext('full_name'), name=lazy_gettext('name'), url=lazy_gettext('url'), download=lazy_gettext('download'))
-    column_formatters = dict( download = download )
+    column_list = ['full_name', 'name', 'url', 'download', 'scorm_packages']
+    column_labels = dict(full_name=lazy_gettext('full_name'), name=lazy_gettext('name'), url=lazy_gettext('url'), download=lazy_gettext('download'), scorm_packages=lazy_gettext('SCORM packages'))
+    column_formatters = dict( download = download, scorm_packages = download_packages )
     column_descriptions = dict( name = lazy_gettext("Institution short name (lower case, all letters, dots and numbers)"), full_name = lazy_gettext("Name of the institution."))
 
     def __init__(self, session, **kwargs):
@@ -301,6 +307,16 @@ class LTPanel(L4lModelView):
         else:
             url = ''
         return get_authentication_scorm(url)
+
+    @expose('/<id>/scorm_packages.zip')
+    def scorm_packages(self, id):
+        lt = self.session.query(LearningTool).filter_by(id = id).one()
+        if lt.basic_http_authentications:
+            url = lt.basic_http_authentications[0].lt_url or ''
+        else:
+            url = ''
+        local_identifiers = [ local_identifier for local_identifier, in self.session.query(PermissionToLt.local_identifier).filter_by(lt_id = lt.id).order_by(PermissionToLt.local_identifier) ]
+        return get_scorm_bundle_response('scorm_packages_%s.zip' % lt.name, local_identifiers, url)
  
 class CoursePanel(L4lModelView):
     def __init__(self, session, **kwargs):
@@ -407,10 +423,10 @@ class RLMSPanel(L4lModelView):
                 error_messages.append(gettext("Invalid public identifier"))
 
             elif form.publicly_available.data: # If publicly available, retrieve existing RLMS with that public identifier
-                existing_objects = self.session.query(RLMS).filter_by(public_identifier = form.public_identifier.data).all()
+                query = self.session.query(RLMS.id).filter(RLMS.public_identifier == form.public_identifier.data)
                 if not add_or_edit: # If editing, don't count the one being edited
-                    existing_objects = [ existing_obj for existing_obj in existing_objects if unicode(existing_obj.id) != unicode(edit_id)]
-                if existing_objects:
+                    query = query.filter(RLMS.id != edit_id)
+                if query.first() is not None:
                     form.public_identifier.errors = [gettext("That identifier is already taken")]
                     error_messages.append(gettext("Use other identifier or don't make the RLMS public"))
 
@@ -445,6 +461,9 @@ class RLMSPanel(L4lModelView):
                     rlms_id = rlms_obj.id
                 else:
                     rlms_id = edit_id
+                    # The capabilities and widgets may have changed with the new configuration
+                    refresh_capabilities(rlms_id)
+                    invalidate_widget_snapshots(rlms_id)
     
                 labs_url = url_for('.labs', id = rlms_id, _external = True)
                 if rlms == http_plugin.PLUGIN_NAME:
@@ -539,7 +558,7 @@ class RLMSPanel(L4lModelView):
         else:
             query_results = {}
             labs = rlms.get_laboratories()
-            capabilities = rlms.get_capabilities()
+            capabilities = get_capabilities(rlms_db, rlms)
             force_search = Capabilities.FORCE_SEARCH in capabilities
             pages = []
 
@@ -787,8 +806,7 @@ class LaboratoryPanel(L4lModelView):
                 if not activate and len(public_id) == 0:
                     flash(gettext("Invalid public identifier (empty)"))
                     return redirect(url_for('.index_view'))
-                existing_labs = self.session.query(Laboratory).filter_by(public_identifier=public_id).all()
-                if len(existing_labs) > 0 and lab not in existing_labs:
+                if self.session.query(Laboratory.id).filter(Laboratory.public_identifier == public_id, Laboratory.id != lab.id).first() is not None:
                     flash(gettext(u"Public identifier '%(publicidentifier)s' already exists", publicidentifier=public_id))
                     return redirect(url_for('.index_view'))
                 lab.publicly_available = not activate
@@ -841,13 +859,7 @@ class PermissionToLtPanel(L4lModelView):
             url = db_lt.basic_http_authentications[0].lt_url or ''
         else:
             url = ''
-        lt_path = urlparse.urlparse(url).path or '/'
-        extension = '/'
-        if 'gateway4labs/' in lt_path:
-            extension = lt_path[lt_path.rfind('gateway4labs/lms/list') + len('gateway4labs/lms/list'):]
-            lt_path  = lt_path[:lt_path.rfind('gateway4labs/')]
-        contents = get_scorm_object(False, local_id, lt_path, extension)
-        return Response(contents, headers = {'Content-Type' : 'application/zip', 'Content-Disposition' : 'attachment; filename=scorm_%s.zip' % local_id})
+        return get_scorm_response('scorm_%s.zip' % local_id, False, local_id, url)
    
 class PermissionPanel(L4lModelView):
     def __init__(self, session, **kwargs):
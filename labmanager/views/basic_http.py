@@ -1,9 +1,14 @@
+import os
 import json
 import cgi
+import hmac
+import time
 import traceback
 import hashlib
+import threading
  
 from flask import Response, render_template, request, g, Blueprint
+from sqlalchemy import event
 from labmanager import ALGORITHM
 from labmanager.db import db
 from labmanager.models import BasicHttpCredentials
@@ -22,6 +27,57 @@ from labmanager.utils import remote_addr
 
 basic_http_blueprint = Blueprint('basic_auth', __name__)
 
+# 
+# Every SCORM request comes with the credentials of the LT. Once verified,
+# they are kept for LMS_CREDENTIALS_TTL seconds (only a hash, keyed with a
+# random key of this process) with a detached copy of the LT, which is
+# merged into the session of each request without querying it again. They
+# are forgotten whenever a credential or LT is changed in this process.
+# 
+
+LMS_CREDENTIALS_TTL = app.config.get('LMS_CREDENTIALS_TTL', 60)
+
+_CREDENTIALS_KEY = os.urandom(32)
+_VERIFIED_CREDENTIALS = {
+    # keyed hash: (timestamp, detached LearningTool)
+}
+_VERIFIED_CREDENTIALS_LOCK = threading.Lock()
+
+def clear_verified_credentials(*args, **kwargs):
+    with _VERIFIED_CREDENTIALS_LOCK:
+        _VERIFIED_CREDENTIALS.clear()
+
+for _model in (BasicHttpCredentials, LearningTool):
+    for _event_name in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(_model, _event_name, clear_verified_credentials)
+
+def _credentials_key(username, password):
+    return hmac.new(_CREDENTIALS_KEY, repr((username, password)), hashlib.sha256).hexdigest()
+
+def verify_lms_credentials(username, password):
+    """The LearningTool with those Basic HTTP credentials, or None."""
+    key = _credentials_key(username, password)
+    with _VERIFIED_CREDENTIALS_LOCK:
+        cached = _VERIFIED_CREDENTIALS.get(key)
+
+    if cached is not None and time.time() - cached[0] < LMS_CREDENTIALS_TTL:
+        return db.session.merge(cached[1], load = False)
+
+    hash_password = hashlib.new(ALGORITHM, password.encode('utf8')).hexdigest()
+    # TODO: check if there could be a conflict between two LTs with same key??
+    db_lt = db.session.query(LearningTool).join(BasicHttpCredentials, BasicHttpCredentials.lt_id == LearningTool.id).filter(BasicHttpCredentials.lt_login == username, BasicHttpCredentials.lt_password == hash_password).first()
+    if db_lt is None:
+        with _VERIFIED_CREDENTIALS_LOCK:
+            _VERIFIED_CREDENTIALS.pop(key, None)
+        return None
+
+    # The cached copy is never attached to a session again: every request
+    # gets its own copy through merge
+    db.session.expunge(db_lt)
+    with _VERIFIED_CREDENTIALS_LOCK:
+        _VERIFIED_CREDENTIALS[key] = (time.time(), db_lt)
+    return db.session.merge(db_lt, load = False)
+
 @basic_http_blueprint.before_request
 def requires_lms_auth():
 
@@ -37,20 +93,18 @@ def requires_lms_auth():
     else:
         username = auth.username
         password = auth.password
-    password = unicode(password)
-    hash_password = hashlib.new(ALGORITHM, password.encode('utf8')).hexdigest()
-    # TODO: check if there could be a conflict between two LTs with same key??
-    credential = db.session.query(BasicHttpCredentials).filter_by(lt_login = username, lt_password = hash_password).first()
-    if credential is None:
+    db_lt = verify_lms_credentials(username, unicode(password))
+    if db_lt is None:
         return UNAUTHORIZED
-    g.lt = credential.lt.name
+    g.db_lt = db_lt
+    g.lt = db_lt.name
 
 @basic_http_blueprint.route("/requests/", methods = ['GET', 'POST'])
 def requests():
     """SCORM packages will perform requests to this method, which will
     interact with the permitted laboratories"""
     
-    db_lt = db.session.query(LearningTool).filter_by(name = g.lt).first()
+    db_lt = g.db_lt
     if request.method == 'GET':
         local_identifiers = [ permission.local_identifier for permission in  db_lt.lab_permissions ]
         return render_template("http/requests.html", local_identifiers = local_identifiers, remote_addr = remote_addr(), courses = db_lt.courses)
@@ -82,7 +136,7 @@ def requests():
         traceback.print_exc()
         return messages_codes["ERROR_invalid"]
     # reserving...
-    permission_to_lt = db.session.query(PermissionToLt).filter_by(lt = db_lt, local_identifier = experiment_identifier).first()
+    permission_to_lt = PermissionToLt.find_for_reservation(db_lt, experiment_identifier)
     good_msg  = messages_codes["ERROR_no_good"]
     error_msg = None
     reservation_url = ""
@@ -5,7 +5,7 @@ from flask import Blueprint, request, url_for, redirect, render_template, sessio
 from labmanager.db import db
 from labmanager.models import RLMS, Laboratory, EmbedApplication
 from labmanager.babel import gettext
-from labmanager.rlms import find_smartgateway_link, Capabilities
+from labmanager.rlms import find_smartgateway_link, Capabilities, get_capabilities, get_widgets
 from labmanager.views.embed import ApplicationForm, SimplifiedApplicationForm, list_of_languages
 from labmanager.views.repository import extract_labs, create_lab_id
 from labmanager.views.authn import requires_golab_login, current_golab_user
@@ -75,12 +75,6 @@ def _return_lab(db_rlms, lab, identifier_links, langs, public_rlms):
 
     return render_template("embed/create.html", user = current_golab_user(), form=form, identifier_links=identifier_links, header_message=gettext("View resource"), languages=[], existing_languages=[], all_languages=[], disabled=True, langs = sorted(new_langs), bookmarklet_from=bookmarklet_from, domains_provided=lab.domains is not None, age_ranges_provided=lab.age_ranges is not None)
 
-def _get_widgets(rlms, laboratory_id):
-    if Capabilities.WIDGET in rlms.get_capabilities():
-        return rlms.list_widgets(laboratory_id)
-
-    return [ { 'name' : 'lab', 'description' : 'Main view of the laboratory' } ]
-
 @bookmarklet_blueprint.route('/pub/rlms/<rlms_id>/<everything:lab_name>', methods=['GET','POST'])
 @requires_golab_login
 def public_rlms(rlms_id, lab_name):
@@ -91,14 +85,14 @@ def public_rlms(rlms_id, lab_name):
     rlms = db_rlms.get_rlms()
     for lab in rlms.get_laboratories():
         if lab.laboratory_id == lab_name:
-            widgets = _get_widgets(rlms, lab.laboratory_id)
+            widgets = get_widgets(db_rlms, rlms, lab.laboratory_id)
 
             links = [] 
             for widget in widgets:
                 link = url_for('opensocial.public_rlms_widget_html', rlms_identifier = rlms_id, lab_name = lab_name, widget_name = widget['name'], _external = True)
                 links.append(link)
 
-            if Capabilities.TRANSLATION_LIST in rlms.get_capabilities():
+            if Capabilities.TRANSLATION_LIST in get_capabilities(db_rlms, rlms):
                 langs = (rlms.get_translation_list(lab.laboratory_id) or {}).get('supported_languages') or []
             else:
                 langs = []
@@ -116,13 +110,13 @@ def public_lab(public_identifier):
     rlms = db_laboratory.rlms.get_rlms()
     for lab in rlms.get_laboratories():
         if lab.laboratory_id == db_laboratory.laboratory_id:
-            widgets = _get_widgets(rlms, lab.laboratory_id)
+            widgets = get_widgets(db_laboratory.rlms, rlms, lab.laboratory_id)
             links = []
             for widget in widgets:
                 link = url_for('opensocial.public_widget_html', lab_name = public_identifier, widget_name = widget['name'], _external = True)
                 links.append(link)
 
-            if Capabilities.TRANSLATION_LIST in rlms.get_capabilities():
+            if Capabilities.TRANSLATION_LIST in get_capabilities(db_laboratory.rlms, rlms):
                 langs = (rlms.get_translation_list(lab.laboratory_id) or {}).get('supported_languages') or []
             else:
                 langs = []
@@ -1,16 +1,18 @@
+import time
 import urlparse
+import threading
 import traceback
-import datetime
-import certifi
+from collections import OrderedDict
 import requests
 from bs4 import BeautifulSoup
 from flask import Blueprint, render_template, make_response, redirect, url_for, request, session, jsonify, current_app, Response
 from labmanager.views.authn import requires_golab_login, current_golab_user
 
-from labmanager.application import SSL_DOMAIN_WHITELIST
+from labmanager.application import app as flask_app, SSL_DOMAIN_WHITELIST
 from labmanager.db import db
+from labmanager.golabz import golabz_labs
 from labmanager.babel import gettext, lazy_gettext
-from labmanager.models import EmbedApplication, EmbedApplicationTranslation, GoLabOAuthUser, UseLog
+from labmanager.models import EmbedApplication, EmbedApplicationTranslation, UseLog, add_with_unique_identifier
 from labmanager.models import HttpsUnsupportedUrl
 from labmanager.rlms import find_smartgateway_link, find_smartgateway_opensocial_link
 from labmanager.translator.languages import obtain_languages
@@ -78,31 +80,6 @@ class MultiCheckboxField(SelectMultipleField):
     option_widget = CheckboxInput()
 
 
-CERTIFICATES_CHECKED = False
-
-def check_certificates():
-    """Some comodo certificates are wrong."""
-    global CERTIFICATES_CHECKED
-    
-    if CERTIFICATES_CHECKED:
-        return
-
-    ca_file = certifi.where()
-    with open('utils/comodo_domain_server_ca.crt', 'rb') as infile:
-        comodo_ca = infile.read()
-
-    with open(ca_file, 'rb') as infile:
-        ca_file_contents = infile.read()
-
-    if comodo_ca not in ca_file_contents:
-        try:
-            requests.get("https://cosci.tw/run/", timeout=(10, 10)).close()
-        except:
-            with open(ca_file, 'ab') as outfile:
-                outfile.write(comodo_ca)
-
-    CERTIFICATES_CHECKED = True
-
 #
 # App Composer checker
 #
@@ -296,7 +273,39 @@ def _get_scale_value(form):
             return scale
     return None
 
-def get_url_metadata(url, timeout = 3):
+#
+# Probing the URLs of the apps (name, description, whether they can be
+# embedded). The results are kept in memory for a while, since the same URL
+# is checked again and again (e.g., while the user types it), and at most
+# URL_METADATA_CONCURRENCY URLs are probed at the same time by each process.
+#
+
+URL_METADATA_TTL = flask_app.config.get('URL_METADATA_TTL', 600)
+URL_METADATA_ERROR_TTL = flask_app.config.get('URL_METADATA_ERROR_TTL', 30)
+URL_METADATA_MAX_ENTRIES = flask_app.config.get('URL_METADATA_MAX_ENTRIES', 2000)
+URL_METADATA_CONCURRENCY = flask_app.config.get('URL_METADATA_CONCURRENCY', 8)
+
+# Only the <head> is parsed, and never more than this
+URL_METADATA_MAX_BYTES = 1024 * 1024
+URL_METADATA_CHUNK_SIZE = 16 * 1024
+
+_URL_METADATA = OrderedDict()
+_URL_METADATA_LOCK = threading.Lock()
+_URL_METADATA_SLOTS = threading.BoundedSemaphore(URL_METADATA_CONCURRENCY)
+
+def _read_head(req):
+    """Read the response until the end of the <head> (or the beginning of the <body>)."""
+    content = ''
+    for chunk in req.iter_content(URL_METADATA_CHUNK_SIZE):
+        # Tags split between chunks are found in the next one
+        position = max(0, len(content) - len('</head>'))
+        content += chunk
+        lower_content = content[position:].lower()
+        if '</head>' in lower_content or '<body' in lower_content or len(content) >= URL_METADATA_MAX_BYTES:
+            break
+    return content[:URL_METADATA_MAX_BYTES]
+
+def _probe_url(url, timeout):
     name = ''
     description = ''
     code = None
@@ -320,21 +329,56 @@ def get_url_metadata(url, timeout = 3):
             x_frame_options = req.headers.get('X-Frame-Options', '').lower()
             content_type = req.headers.get('content-type', '').lower()
             if req.status_code == 200 and 'html' in req.headers.get('content-type', '').lower():
-                # First megabyte maximum
-                content = req.iter_content(1024 * 1024).next()
-                soup = BeautifulSoup(content, 'lxml')
-                name = (soup.find("title").text or '').strip()
+                soup = BeautifulSoup(_read_head(req), 'lxml')
+                title = soup.find("title")
+                if title is not None:
+                    name = (title.text or '').strip()
                 meta_description = soup.find("meta", attrs={'name': 'description'})
                 if meta_description is not None:
                     meta_description_text = meta_description.attrs.get('content')
                     if meta_description_text:
                         description = (meta_description_text or '').strip()
-            req.close()
         except:
             traceback.print_exc()
+        finally:
+            req.close()
 
     return { 'name' : name, 'description': description, 'code': code, 'x_frame_options' : x_frame_options, 'error_retrieving' : error_retrieving, 'content_type' : content_type }
 
+def clear_url_metadata():
+    with _URL_METADATA_LOCK:
+        _URL_METADATA.clear()
+
+def get_url_metadata(url, timeout = 3):
+    """
+    Name, description and headers of the URL. If too many URLs are being
+    probed, it does not wait: 'busy' is True and nothing else is provided.
+    """
+    with _URL_METADATA_LOCK:
+        entry = _URL_METADATA.pop(url, None)
+        if entry is not None:
+            timestamp, metadata = entry
+            ttl = URL_METADATA_ERROR_TTL if metadata['error_retrieving'] else URL_METADATA_TTL
+            if time.time() - timestamp <= ttl:
+                # Move it to the end (most recently used)
+                _URL_METADATA[url] = entry
+                return dict(metadata)
+
+    if not _URL_METADATA_SLOTS.acquire(False):
+        return { 'name' : '', 'description': '', 'code': None, 'x_frame_options' : '', 'error_retrieving' : False, 'content_type' : '', 'busy' : True }
+
+    try:
+        metadata = _probe_url(url, timeout)
+    finally:
+        _URL_METADATA_SLOTS.release()
+
+    metadata['busy'] = False
+    with _URL_METADATA_LOCK:
+        _URL_METADATA[url] = (time.time(), metadata)
+        while len(_URL_METADATA) > URL_METADATA_MAX_ENTRIES:
+            _URL_METADATA.popitem(last = False)
+    return dict(metadata)
+
 @embed_blueprint.route('/stats', methods = ['POST'])
 def stats():
     url = request.args.get('url')
@@ -348,104 +392,8 @@ def stats():
 
 @embed_blueprint.route('/sync', methods = ['GET'])
 def sync():
+    # Run sync_embed.py instead (see labmanager.sync)
     return "Not used anymore"
-    composer_contents = requests.get('http://composer.golabz.eu/export-embed.json').json()
-    current_users = { user.email: user for user in db.session.query(GoLabOAuthUser).all() }
-    users_modified = 0
-    users_added = 0
-    for user in composer_contents['users']:
-        if user['email'] in current_users:
-            if current_users[user['email']].display_name != user['display_name']:
-                current_users[user['email']].display_name = user['display_name']
-                users_modified += 1
-        else:
-            db.session.add(GoLabOAuthUser(email=user['email'], display_name=user['display_name']))
-            users_added += 1
-
-    db.session.commit()
-    # Users sync'ed
-
-    current_apps_by_public_id = { app.identifier: app for app in db.session.query(EmbedApplication).all() }
-    public_identifiers_by_db_id = { app.id : app.identifier for app in current_apps_by_public_id.values() }
-
-    current_translation_urls = {
-        # public_identifier: {
-        #     'es': obj
-        # }
-    }
-
-    for translation_db in db.session.query(EmbedApplicationTranslation).all():
-        public_identifier = public_identifiers_by_db_id[translation_db.embed_application_id]
-        if public_identifier not in current_translation_urls:
-            current_translation_urls[public_identifier] = {}
-
-        current_translation_urls[public_identifier][translation_db.language] = translation_db
-
-    current_users = { user.email: user for user in db.session.query(GoLabOAuthUser).all() }
-
-    # Now we have everything in memory. Let's process it
-    apps_added = 0
-    apps_modified = 0
-    FORMAT = '%Y-%m-%dT%H:%M:%S'
-    for app in composer_contents['apps']:
-        creation = datetime.datetime.strptime(app['creation'], FORMAT)
-        last_update = datetime.datetime.strptime(app['last_update'], FORMAT)
-        owner = current_users[app['owner_mail']]
-
-        if app['identifier'] in current_apps_by_public_id:
-            modified = False
-            current_app = current_apps_by_public_id[app['identifier']]
-
-            if current_app.url != app['url']:
-                modified = True
-                current_app.url = app['url']
-
-            if current_app.name != app['name']:
-                modified = True
-                current_app.name = app['name']
-
-            if current_app.height != app['height']:
-                modified = True
-                current_app.height = app['height']
-            
-            if current_app.scale != app['scale']:
-                modified = True
-                current_app.scale = app['scale']
-
-            if current_app.last_update != last_update:
-                modified = True
-                current_app.last_update = last_update
-
-            if current_app.creation != creation:
-                modified = True
-                current_app.creation = creation
-
-
-            current_translations = current_translation_urls.get(app['identifier'], {})
-            for translation in app['translations']:
-                if translation['language'] not in current_translations:
-                    new_translation = EmbedApplicationTranslation(embed_application = current_app, url = translation['url'], language = translation['language'])
-                    db.session.add(new_translation)
-                    modified = True
-                else:
-                    if current_translations[translation['language']].url != translation['url']:
-                        modified = True
-                        current_translations[translation['language']].url = translation['url']
-
-            if modified:
-                apps_modified += 1
-            
-        else:
-            new_app = EmbedApplication(url = app['url'], name = app['name'], owner = owner, height = app['height'], identifier = app['identifier'], creation = creation, last_update = last_update, scale = app['scale'])
-            db.session.add(new_app)
-            apps_added += 1
-            for translation in app['translations']:
-                new_translation = EmbedApplicationTranslation(embed_application = new_app, url = translation['url'], language = translation['language'])
-                db.session.add(new_translation)
-
-    db.session.commit()
-    
-    return "<html><body><p>Sync completed. Users modified: %s; Users added: %s; Apps modified: %s; Apps added: %s</p></body></html>" % (users_modified, users_added, apps_modified, apps_added)
 
 def find_replacement(app):
     sg_replacement = find_smartgateway_opensocial_link(app.url)
@@ -465,15 +413,11 @@ def appcomp2gw_graasp_migration():
 
 @embed_blueprint.route('/migrations/appcomp2gw/golabz.json', methods = ['GET'])
 def appcomp2gw_golabz_migration():
-    try:
-        labs = requests.get("http://www.golabz.eu/rest/labs/retrieve.json").json()
-    except:
+    catalog = golabz_labs.get()
+    if catalog is None:
         return "Couldn't connect to golabz"
 
-    lab_urls = set()
-    for lab in labs:
-        for lab_app in lab['lab_apps']:
-            lab_urls.add(lab_app['app_url'])
+    lab_urls = catalog['lab_per_url']
 
     replacements = {}
 
@@ -486,17 +430,12 @@ def appcomp2gw_golabz_migration():
     return jsonify(replacements=replacements, total=len(replacements))
 
 def obtain_golabz_manual_data():
-    try:
-        labs = requests.get("http://www.golabz.eu/rest/labs/retrieve.json").json()
-    except:
+    catalog = golabz_labs.get()
+    if catalog is None:
         return "Couldn't connect to golabz"
 
-    lab_urls = set()
-    labs_by_lab_url = {}
-    for lab in labs:
-        for lab_app in lab['lab_apps']:
-            lab_urls.add(lab_app['app_url'])
-            labs_by_lab_url[lab_app['app_url']] = lab
+    labs_by_lab_url = catalog['lab_per_url']
+    lab_urls = labs_by_lab_url
 
     replacements = []
 
@@ -539,8 +478,6 @@ def appcomp2gw_golabz_manual_migration_html():
 @embed_blueprint.route('/create', methods = ['GET', 'POST'])
 @requires_golab_login
 def create():
-    check_certificates()
-
     original_url = request.args.get('url')
     if original_url:
         bookmarklet_from = original_url
@@ -583,9 +520,8 @@ def create():
         form_scale = _get_scale_value(form)
         application = EmbedApplication(url = form.url.data, name = form.name.data, owner = current_golab_user(), height=form.height.data, scale=form_scale, description=form.description.data, age_ranges_range = form.age_ranges_range.data)
         application.domains_text = form.domains_text.data
-        db.session.add(application)
         try:
-            db.session.commit()
+            add_with_unique_identifier(application)
         except Exception as e:
             traceback.print_exc()
             return render_template("embed/error.html", message = gettext("There was an error creating an application"), user = current_golab_user()), 500
@@ -613,6 +549,9 @@ def check_json():
         return jsonify(error=False, sg_link=sg_link, url=url)
     
     metadata = get_url_metadata(url, timeout = 5)
+    if metadata['busy']:
+        return jsonify(error=True, message=gettext("Too many websites are being checked right now. Please try again in a few seconds"), url=url)
+
     if metadata['error_retrieving']:
         return jsonify(error=True, message=gettext("Error retrieving URL"), url=url)
 
@@ -107,7 +107,7 @@ def launch_experiment():
     consumer_key = session.get('consumer')
     if consumer_key is None:
         return gettext("consumer key not found")
-    permission_to_lt_user = PermissionToLtUser.find(key = consumer_key)
+    permission_to_lt_user = PermissionToLtUser.find_for_reservation(consumer_key)
     if permission_to_lt_user is None:
         return gettext("permission not found")
     p_to_lt = permission_to_lt_user.permission_to_lt
@@ -8,12 +8,11 @@
 
 import uuid
 import traceback
-import urlparse
 
 from hashlib import new as new_hash
 from yaml import load as yload
 from wtforms.fields import PasswordField
-from flask import request, redirect, url_for, session, Markup, Response
+from flask import request, redirect, url_for, session, Markup
 from flask.ext import wtf
 from flask.ext.admin import Admin, AdminIndexView, BaseView, expose
 from flask.ext.admin.contrib.sqlamodel import ModelView
@@ -21,7 +20,7 @@ from flask.ext.login import current_user
 
 from labmanager import ALGORITHM
 from labmanager.babel import gettext, lazy_gettext
-from labmanager.scorm import get_scorm_object
+from labmanager.scorm import get_scorm_response, get_scorm_bundle_response
 from labmanager.models import LtUser, Course, Laboratory, PermissionToLt, PermissionToLtUser, PermissionToCourse
 from labmanager.views import RedirectView, retrieve_courses
 import labmanager.forms as forms
@@ -222,7 +221,8 @@ class LmsInstructorLaboratoriesPanel(L4lLmsModelView):
                                     local_identifier = lazy_gettext('Local Identifier'),
                                     scorm =lazy_gettext('Scorm'))
     column_formatters = dict( SCORM = scorm_formatter, local_identifier = local_id_formatter )
-                                    
+    list_template = 'lms_admin/list_scorm.html'
+
     def __init__(self, session, **kwargs):
         super(LmsInstructorLaboratoriesPanel, self).__init__(Laboratory, session, **kwargs)
 
@@ -243,13 +243,17 @@ class LmsInstructorLaboratoriesPanel(L4lLmsModelView):
             url = db_lt.basic_http_authentications[0].lt_url or ''
         else:
             url = ''
-        lt_path = urlparse.urlparse(url).path or '/'
-        extension = '/'
-        if 'gateway4labs/' in lt_path:
-            extension = lt_path[lt_path.rfind('gateway4labs/lms/list') + len('gateway4labs/lms/list'):]
-            lt_path  = lt_path[:lt_path.rfind('gateway4labs/')]
-        contents = get_scorm_object(False, local_id, lt_path, extension)
-        return Response(contents, headers = {'Content-Type' : 'application/zip', 'Content-Disposition' : 'attachment; filename=scorm_%s.zip' % local_id})
+        return get_scorm_response('scorm_%s.zip' % local_id, False, local_id, url)
+
+    @expose('/scorm_packages.zip')
+    def get_scorm_packages(self):
+        db_lt = current_user.lt
+        if db_lt.basic_http_authentications:
+            url = db_lt.basic_http_authentications[0].lt_url or ''
+        else:
+            url = ''
+        local_identifiers = [ local_identifier for local_identifier, in self.session.query(PermissionToLt.local_identifier).filter_by(lt = db_lt).order_by(PermissionToLt.local_identifier) ]
+        return get_scorm_bundle_response('scorm_packages.zip', local_identifiers, url)
 
 #################################################
 # 
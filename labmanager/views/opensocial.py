@@ -11,7 +11,7 @@ import threading
 
 
 from functools import wraps
-import xml.etree.ElementTree as ET
+from collections import OrderedDict
 
 import requests
 
@@ -21,11 +21,16 @@ from flask.ext.wtf import Form, validators, TextField, PasswordField
 from labmanager import ALGORITHM
 from labmanager.db import db
 from labmanager.models import LearningTool, PermissionToLt, LtUser, ShindigCredentials, Laboratory, RLMS
-from labmanager.rlms import get_manager_class, Capabilities
+from labmanager.rlms import get_manager_class, Capabilities, get_capabilities
+from labmanager.rlms.snapshots import get_widget_snapshot
+from labmanager.response_cache import cached_response, rlms_cache_version
+from labmanager.resolver import resolve_lab
+from labmanager.golabz import get_current_bookings
 import labmanager.forms as forms
 from labmanager.babel import gettext, lazy_gettext
 from labmanager.utils import remote_addr
 from labmanager.views.translations import DEFAULT_TRANSLATIONS
+from labmanager.translation_bundles import TranslationBundle
 from labmanager import app
 
 SHINDIG = threading.local()
@@ -89,65 +94,24 @@ def _extract_widget_config(rlms_db, laboratory_identifier, widget_name, lab_foun
     if autoload is None and rlms_db.default_autoload is not None:
         autoload = rlms_db.default_autoload
 
-    RLMS_CLASS = get_manager_class(rlms_db.kind, rlms_db.version, rlms_db.id)
-    rlms = RLMS_CLASS(rlms_db.configuration)
+    snapshot = get_widget_snapshot(rlms_db, laboratory_identifier, widget_name)
 
-    try:
-        capabilities = rlms.get_capabilities()
-    except Exception as e:
-        traceback.print_exc()
-        raise Exception("Error retrieving capabilities: %s" % e)
-
-    if Capabilities.FORCE_SEARCH in capabilities:
+    if snapshot['force_search']:
         if autoload is None:
             autoload = True # By default in those cases where a search is mandatory
-    else:
-        # labs = [ lab for lab in rlms.get_laboratories() if lab.laboratory_id == laboratory_identifier ]
-        # if not labs:
-        #     # The laboratory has changed
-        #     return None
-        # 
-        # if autoload is None:
-        #     autoload = labs[0].autoload
-        pass
-
-    default_height = rlms.get_default_height()
-    if default_height and not base_data.get('height'):
-        base_data['height'] = '{}px'.format(default_height)
+
+    if snapshot['default_height'] and not base_data.get('height'):
+        base_data['height'] = snapshot['default_height']
         height = base_data['height']
 
-    default_scale = rlms.get_default_scale()
-    if default_scale and not base_data.get('scale'):
-        base_data['scale'] = int(default_scale)
+    if snapshot['default_scale'] and not base_data.get('scale'):
+        base_data['scale'] = snapshot['default_scale']
         scale = base_data['scale']
-   
-    if Capabilities.TRANSLATIONS in capabilities:
-        translations = rlms.get_translations(laboratory_identifier)
-        if 'translations' not in translations:
-            translations['translations'] = {}
-        if 'mails' not in translations:
-            translations['mails'] = []
-    else:
-        translations = {'translations' : {}, 'mails' : []}
-
-    # Only if no translation is regularly provided and translation_list is supoprted
-    if Capabilities.TRANSLATION_LIST in capabilities:
-        translation_list = list((rlms.get_translation_list(laboratory_identifier) or {}).get('supported_languages', []))
-        for lang in translations['translations']:
-            if lang not in translation_list:
-                translation_list.append(lang)
-    else:
-        translation_list = []
-
-    if Capabilities.CHECK_URLS in capabilities:
-        check_urls = rlms.get_check_urls(laboratory_identifier)
-    else:
-        check_urls = []
 
-    if Capabilities.DOWNLOAD_LIST in capabilities:
-        download_list = rlms.get_downloads(laboratory_identifier)
-    else:
-        download_list = {}
+    translations = snapshot['translations']
+    translation_list = snapshot['translation_list']
+    check_urls = snapshot['check_urls']
+    download_list = snapshot['downloads']
 
     if autoload and len(translations['translations']) == 0:
         show_languages = False
@@ -156,28 +120,26 @@ def _extract_widget_config(rlms_db, laboratory_identifier, widget_name, lab_foun
 
     show_empty_languages = len(translation_list) > 0
 
-    if Capabilities.WIDGET in capabilities:
-        widgets = rlms.list_widgets(laboratory_identifier)
-
-        for widget in widgets:
-            if widget['name'] == widget_name:
-                widget['autoload'] = autoload
-                widget['translations'] = translations
-                widget['translation_list'] = translation_list
-                widget['show_languages'] = show_languages
-                widget['show_empty_languages'] = show_empty_languages
-                if check_urls:
-                    widget['check_urls'] = check_urls
-                if download_list:
-                    widget['downloads'] = download_list
+    if snapshot['widget'] is not None:
+        # The snapshot is shared (and read-only): work on a copy
+        widget = dict(snapshot['widget'])
+        widget['autoload'] = autoload
+        widget['translations'] = translations
+        widget['translation_list'] = translation_list
+        widget['show_languages'] = show_languages
+        widget['show_empty_languages'] = show_empty_languages
+        if check_urls:
+            widget['check_urls'] = check_urls
+        if download_list:
+            widget['downloads'] = download_list
 
-                if height is not None:
-                    widget['height'] = height
+        if height is not None:
+            widget['height'] = height
 
-                if scale is not None:
-                    widget['scale'] = scale
+        if scale is not None:
+            widget['scale'] = scale
 
-                return widget
+        return widget
 
     base_data['autoload'] = autoload
     base_data['translations'] = translations
@@ -206,42 +168,35 @@ def xml_error_management(func):
 @opensocial_blueprint.route("/w/<institution_id>/<lab_name>/w_<widget_name>.xml")
 @xml_error_management
 def widget_xml(institution_id, lab_name, widget_name):
-    public_lab = db.session.query(Laboratory).filter_by(public_identifier = lab_name, publicly_available = True).first()
-    laboratory = public_lab
-    if public_lab:
-        widget_config = _extract_widget_config(public_lab.rlms, public_lab.laboratory_id, widget_name, True) 
-    else:
-        widget_config = {} # Default value
-        institution = db.session.query(LearningTool).filter_by(name = institution_id).first()
-        if institution:
-            permission = db.session.query(PermissionToLt).filter_by(lt = institution, local_identifier = lab_name).first()
-            if permission:
-                widget_config = _extract_widget_config(permission.laboratory.rlms, permission.laboratory.laboratory_id, widget_name, False)
-                laboratory = permission.laboratory 
+    resolution = resolve_lab(lab_name, institution_id)
+    public_lab = resolution.public_laboratory
+    laboratory = resolution.laboratory
 
-    if widget_config is None:
-        return "Error: widget does not exist anymore" # TODO
     if not laboratory:
         contents = render_template('opensocial/widget-error.xml',message="Lab %s not found or not public" % lab_name)
         return Response(contents, mimetype="application/xml")
-    contents = render_template('/opensocial/widget.xml', institution_id = institution_id, lab_name = lab_name, widget_name = widget_name, widget_config = widget_config, autoload = widget_config['autoload'], rlms = public_lab.rlms, go_lab_booking = laboratory.go_lab_reservation)
-    return Response(contents, mimetype="application/xml")
+
+    def render():
+        widget_config = _extract_widget_config(laboratory.rlms, laboratory.laboratory_id, widget_name, public_lab is not None)
+        if widget_config is None:
+            return "Error: widget does not exist anymore" # TODO
+        contents = render_template('/opensocial/widget.xml', institution_id = institution_id, lab_name = lab_name, widget_name = widget_name, widget_config = widget_config, autoload = widget_config['autoload'], rlms = public_lab.rlms, go_lab_booking = laboratory.go_lab_reservation)
+        return Response(contents, mimetype="application/xml")
+
+    return cached_response(laboratory.rlms, (laboratory.id, laboratory.go_lab_reservation, laboratory.rlms.default_autoload), render)
 
 @opensocial_blueprint.route("/widgets/<institution_id>/<lab_name>/widget_<widget_name>.html")
 @opensocial_blueprint.route("/w/<institution_id>/<lab_name>/w_<widget_name>.html")
 def widget_html(institution_id, lab_name, widget_name):
-    public_lab = db.session.query(Laboratory).filter_by(public_identifier = lab_name, publicly_available = True).first()
-    laboratory = public_lab
+    resolution = resolve_lab(lab_name, institution_id)
+    public_lab = resolution.public_laboratory
+    laboratory = resolution.laboratory
     if public_lab:
         widget_config = _extract_widget_config(public_lab.rlms, public_lab.laboratory_id, widget_name, True) 
+    elif laboratory:
+        widget_config = _extract_widget_config(laboratory.rlms, laboratory.laboratory_id, widget_name, False)
     else:
         widget_config = {} # Default value
-        institution = db.session.query(LearningTool).filter_by(name = institution_id).first()
-        if institution:
-            permission = db.session.query(PermissionToLt).filter_by(lt = institution, local_identifier = lab_name).first()
-            if permission:
-                widget_config = _extract_widget_config(permission.laboratory.rlms, permission.laboratory.laboratory_id, widget_name, False)
-                laboratory = permission.laboratory 
 
     if widget_config is None:
         return "Error: widget does not exist anymore" # TODO
@@ -257,12 +212,16 @@ def public_widget_xml(lab_name, widget_name):
     if not laboratory:
         contents = render_template('opensocial/widget-error.xml',message="Lab %s not found or not public" % lab_name)
         return Response(contents, mimetype="application/xml")
-    widget_config = _extract_widget_config(laboratory.rlms, laboratory.laboratory_id, widget_name, True)     
-    if widget_config is None:
-        return "Error: widget does not exist anymore" # TODO  
 
-    contents = render_template('/opensocial/widget.xml', public_lab = True, lab_name = lab_name, widget_name = widget_name, widget_config = widget_config, autoload = widget_config['autoload'], rlms = laboratory.rlms, go_lab_booking = laboratory.go_lab_reservation)
-    return Response(contents, mimetype="application/xml")
+    def render():
+        widget_config = _extract_widget_config(laboratory.rlms, laboratory.laboratory_id, widget_name, True)     
+        if widget_config is None:
+            return "Error: widget does not exist anymore" # TODO  
+
+        contents = render_template('/opensocial/widget.xml', public_lab = True, lab_name = lab_name, widget_name = widget_name, widget_config = widget_config, autoload = widget_config['autoload'], rlms = laboratory.rlms, go_lab_booking = laboratory.go_lab_reservation)
+        return Response(contents, mimetype="application/xml")
+
+    return cached_response(laboratory.rlms, (laboratory.id, laboratory.go_lab_reservation, laboratory.rlms.default_autoload), render)
 
 @opensocial_blueprint.route("/public/widgets/<lab_name>/widget_<widget_name>.html",methods=[ 'GET'])
 @opensocial_blueprint.route("/pub/<lab_name>/w_<widget_name>.html",methods=[ 'GET'])
@@ -284,22 +243,24 @@ def public_rlms_widget_xml(rlms_identifier, lab_name, widget_name):
         contents = render_template('opensocial/widget-error.xml',message="RLMS %s not found or not public" % rlms_identifier)
         return Response(contents, mimetype="application/xml")
 
-    try:
-        widget_config = _extract_widget_config(rlms, lab_name, widget_name, True)
-    except Exception as err:
-        traceback.print_exc()
-        if 'remlabnet.eu' in str(err):
-            return "Error: the widget is not available at this moment"
-        else:
-            raise
+    def render():
+        try:
+            widget_config = _extract_widget_config(rlms, lab_name, widget_name, True)
+        except Exception as err:
+            traceback.print_exc()
+            if 'remlabnet.eu' in str(err):
+                return "Error: the widget is not available at this moment"
+            else:
+                raise
 
-    if widget_config is None:
-        return "Error: widget does not exist anymore" # TODO  
+        if widget_config is None:
+            return "Error: widget does not exist anymore" # TODO  
 
-#   XXX We do not support booking on the public labs yet
-    print widget_config
-    contents = render_template('/opensocial/widget.xml', rlms_identifier = rlms_identifier, public_rlms = True, lab_name = lab_name, widget_name = widget_name, widget_config = widget_config, autoload = widget_config['autoload'], rlms = rlms, go_lab_booking = False, go_lab_booking_url = "")
-    return Response(contents, mimetype="application/xml")
+        # XXX We do not support booking on the public labs yet
+        contents = render_template('/opensocial/widget.xml', rlms_identifier = rlms_identifier, public_rlms = True, lab_name = lab_name, widget_name = widget_name, widget_config = widget_config, autoload = widget_config['autoload'], rlms = rlms, go_lab_booking = False, go_lab_booking_url = "")
+        return Response(contents, mimetype="application/xml")
+
+    return cached_response(rlms, (rlms.default_autoload,), render)
 
 @opensocial_blueprint.route("/pub/<rlms_identifier>/<quoted_url:lab_name>/w_<widget_name>.html",methods=[ 'GET'])
 def public_rlms_widget_html(rlms_identifier, lab_name, widget_name):
@@ -323,12 +284,14 @@ def public_rlms_widget_html(rlms_identifier, lab_name, widget_name):
     return render_template('/opensocial/widget.html', rlms_identifier = rlms_identifier, public_rlms = True, lab_name = lab_name, widget_name = widget_name, widget_config = widget_config, autoload = widget_config['autoload'], rlms = rlms, go_lab_booking = False, go_lab_booking_url = "")
 
 
+BOOKING_VERIFY_TIMEOUT = (5, 10)
+
 def booking_system(laboratory):
     if laboratory.go_lab_reservation:
         token = request.args.get('token')
         url = 'https://www.weblab.deusto.es/golab/booking/verify/verify_token?token=%s' % token
         try:
-            r =requests.get(url)
+            r = requests.get(url, timeout = BOOKING_VERIFY_TIMEOUT)
             response = r.json()
             if not response:
                 return False
@@ -336,86 +299,116 @@ def booking_system(laboratory):
             raise ValueError('Error in request with url',url)
     return True
 
-def _indent(elem, level=0):
-    i = "\n" + level*"  "
-    if len(elem):
-        if not elem.text or not elem.text.strip():
-            elem.text = i + "  "
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-        for elem in elem:
-            _indent(elem, level+1)
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-    else:
-        if level and (not elem.tail or not elem.tail.strip()):
-            elem.tail = i
+def _escape_text(value):
+    return value.replace(u"&", u"&amp;").replace(u"<", u"&lt;").replace(u">", u"&gt;")
+
+def _escape_attribute(value):
+    return _escape_text(value).replace(u"\"", u"&quot;").replace(u"\n", u"&#10;")
+
+def _to_unicode(value):
+    if not isinstance(value, unicode):
+        return value.decode('utf-8')
+    return value
 
-def _translations_to_xml(translations_response, language):
-    xml_bundle = ET.Element("messagebundle")
-    xml_bundle.attrib['automatic'] = "false"
+_TRANSLATIONS_XML = OrderedDict()
+_TRANSLATIONS_XML_LOCK = threading.Lock()
+_TRANSLATIONS_XML_MAX = 500
+
+def _translations_to_xml(translations_response, language, version = None):
+    """
+    Serialize the messages of that language as an OpenSocial message bundle
+    (same output as the former ElementTree-based serializer). If version is
+    provided (anything identifying the contents of translations_response),
+    the result is memoized per (version, language).
+    """
+    if version is not None:
+        with _TRANSLATIONS_XML_LOCK:
+            xml_string = _TRANSLATIONS_XML.pop((version, language), None)
+            if xml_string is not None:
+                _TRANSLATIONS_XML[version, language] = xml_string
+                return xml_string
 
     translations = translations_response.get('translations', {})
     mails = translations_response.get('mails', [])
-    language = translations.get(language, {})
+    messages = translations.get(language, {})
+
+    # Attributes are sorted by name, as ElementTree did
+    bundle_header = u'<messagebundle automatic="false"'
     if mails:
-        xml_bundle.attrib['mails'] = ','.join(mails)
+        bundle_header += u' mails="%s"' % _escape_attribute(_to_unicode(','.join(mails)))
+
+    buf = []
+    write = buf.append
+    write(u"<?xml version='1.0' encoding='UTF-8'?>\n")
+    write(bundle_header)
 
     # Sorting is important for the App Composer
-    for key, pack in sorted(language.items(), lambda (k1, v1), (k2, v2): cmp(k1, k2)):
+    first = True
+    for key in sorted(messages):
+        pack = messages[key]
         if 'value' not in pack:
             continue
 
-        value = pack.get('value', '')
-        namespace = pack.get('namespace')
+        if first:
+            write(u'>')
+            first = False
+        write(u'\n  <msg')
+
         category = pack.get('category')
+        if category:
+            write(u' category="%s"' % _escape_attribute(_to_unicode(category)))
+        write(u' name="%s"' % _escape_attribute(_to_unicode(key)))
+        namespace = pack.get('namespace')
+        if namespace:
+            write(u' namespace="%s"' % _escape_attribute(_to_unicode(namespace)))
 
-        xml_msg = ET.SubElement(xml_bundle, 'msg')
-        xml_msg.attrib['name'] = key
+        value = pack.get('value', '')
+        if value:
+            write(u'>%s</msg>' % _escape_text(_to_unicode(value)))
+        else:
+            write(u' />')
 
-        if namespace:
-            xml_msg.attrib['namespace'] = namespace
+    if first:
+        write(u' />')
+    else:
+        write(u'\n</messagebundle>\n')
+
+    xml_string = u''.join(buf).encode('utf-8')
+
+    if version is not None:
+        with _TRANSLATIONS_XML_LOCK:
+            _TRANSLATIONS_XML[version, language] = xml_string
+            while len(_TRANSLATIONS_XML) > _TRANSLATIONS_XML_MAX:
+                _TRANSLATIONS_XML.popitem(last = False)
 
-        if category:
-            xml_msg.attrib['category'] = category
-        
-        if not isinstance(value, unicode):
-            value = value.decode('utf-8')
-        xml_msg.text = value
-    _indent(xml_bundle)
-    xml_string = ET.tostring(xml_bundle, encoding = 'UTF-8')
     return xml_string
 
 def _rlms_to_translations(rlms_db, laboratory_id, language):
-    translations = {}
-    if rlms_db is not None:
-        RLMS_CLASS = get_manager_class(rlms_db.kind, rlms_db.version, rlms_db.id)
-        rlms = RLMS_CLASS(rlms_db.configuration)
-        capabilities = rlms.get_capabilities()
-        if Capabilities.TRANSLATIONS in capabilities:
-            translations = rlms.get_translations(laboratory_id)
-
-    if 'translations' not in translations:
-        translations['translations'] = {}
-
-    for lang in DEFAULT_TRANSLATIONS:
-        # don't add empty translations
-        if lang in translations['translations']:
-            translations['translations'][lang].update(DEFAULT_TRANSLATIONS[lang])
-    
-    translations_xml = _translations_to_xml(translations, language)
-    return Response(translations_xml, mimetype='application/xml')
+    def render():
+        translations = {}
+        if rlms_db is not None:
+            RLMS_CLASS = get_manager_class(rlms_db.kind, rlms_db.version, rlms_db.id)
+            rlms = RLMS_CLASS(rlms_db.configuration)
+            capabilities = get_capabilities(rlms_db, rlms)
+            if Capabilities.TRANSLATIONS in capabilities:
+                translations = rlms.get_translations(laboratory_id)
+
+        # The translations returned by the plug-in are usually shared (they
+        # come from its cache): the default messages are only put on top
+        bundle = TranslationBundle(translations, DEFAULT_TRANSLATIONS)
+
+        if rlms_db is not None:
+            version = (rlms_db.id, laboratory_id, rlms_cache_version(rlms_db.id))
+        else:
+            version = None
+        translations_xml = _translations_to_xml(bundle, language, version)
+        return Response(translations_xml, mimetype='application/xml')
+
+    return cached_response(rlms_db, (laboratory_id,), render)
 
 @opensocial_blueprint.route("/w/<institution_id>/<lab_name>/languages/<lang>_ALL.xml")
 def translations(institution_id, lab_name, lang):
-    public_lab = db.session.query(Laboratory).filter_by(public_identifier = lab_name, publicly_available = True).first()
-    laboratory = public_lab
-    if not public_lab:
-        institution = db.session.query(LearningTool).filter_by(name = institution_id).first()
-        if institution:
-            permission = db.session.query(PermissionToLt).filter_by(lt = institution, local_identifier = lab_name).first()
-            if permission:
-                laboratory = permission.laboratory
+    laboratory = resolve_lab(lab_name, institution_id).laboratory
 
     if not laboratory:
         return _rlms_to_translations(None, None, lang)
@@ -477,7 +470,7 @@ def _reserve_impl(lab_name, public_rlms = False, public_lab = False, institution
         booking_required = False
     else:
         if public_lab:
-            db_laboratory = db.session.query(Laboratory).filter_by(publicly_available = True, public_identifier = lab_name).first()
+            db_laboratory = resolve_lab(lab_name).public_laboratory
             if db_laboratory is None:
                 return render_template("opensocial/errors.html", message = gettext("That lab does not exist or it is not publicly available."))
             
@@ -485,7 +478,8 @@ def _reserve_impl(lab_name, public_rlms = False, public_lab = False, institution
             institution_name  = 'public-labs' # TODO: make sure that this name is unique
             courses_configurations = []
         else:
-            institution = db.session.query(LearningTool).filter_by(name = institution_id).first()
+            resolution = resolve_lab(lab_name, institution_id)
+            institution = resolution.institution
             if institution is None or len(institution.shindig_credentials) < 1:
                 return render_template("opensocial/errors.html", message = gettext("This is not a valid PLE. Make sure that the institution id is fine and that there are Shindig Credentials configured"))
 
@@ -505,13 +499,13 @@ def _reserve_impl(lab_name, public_rlms = False, public_lab = False, institution
             # First, check if the lab is public (e.g. the lab can be accessed by anyone)
             # Second, check accesibility permissions (e.g. the lab is accessible for everyone from that institution without specifying any Graasp space). 
             # After that, in the case that there are not accesibility permissions, check for that institution if there is a permission identified by that lab_name, and check which courses (spaces in OpenSocial) have that permission.
-            public_lab_db = db.session.query(Laboratory).filter_by(public_identifier = lab_name, publicly_available = True).first()
+            public_lab_db = resolution.public_laboratory
             courses_configurations = []
             if public_lab_db is None:
                 # No public access is granted for the lab, check accesibility permissions
-                accessible_permission = db.session.query(PermissionToLt).filter_by(lt = institution, local_identifier = lab_name, accessible = True).first()
-                if accessible_permission is None:
-                    permission = db.session.query(PermissionToLt).filter_by(lt = institution, local_identifier = lab_name).first()
+                # (the resolver returns an accessible permission if there is any)
+                permission = resolution.permission
+                if permission is None or not permission.accessible:
                     if permission is None:
                         return render_template("opensocial/errors.html", message = gettext("Your PLE is valid, but don't have permissions for the requested laboratory."))
                     for course_permission in permission.course_permissions:
@@ -520,9 +514,7 @@ def _reserve_impl(lab_name, public_rlms = False, public_lab = False, institution
                             courses_configurations.append(course_permission.configuration)
                     if len(courses_configurations) == 0:
                         return render_template("opensocial/errors.html", message = gettext("Your PLE is valid and your lab too, but you're not in one of the spaces that have permissions (you are in %(space)r)", space=spaces))
-                else:
-                    # There is a accesibility permission for that lab and institution
-                    permission = accessible_permission
+                # Otherwise, there is a accesibility permission for that lab and institution
 
                 ple_configuration = permission.configuration
                 db_laboratory     = permission.laboratory
@@ -605,7 +597,7 @@ def _reserve_impl(lab_name, public_rlms = False, public_lab = False, institution
         # Don't translate, just in case there are issues with the problem itself
         return render_template("opensocial/errors.html", message = "There was an error performing the reservation to the final laboratory.")
     else:
-        if Capabilities.WIDGET in remote_laboratory.get_capabilities():
+        if Capabilities.WIDGET in get_capabilities(db_rlms, remote_laboratory):
             reservation_id = response['reservation_id']
         else:
             reservation_id = response['load_url']
@@ -647,7 +639,7 @@ def _reserve_json(lab_name, public_rlms = False, public_lab = False, institution
         booking_required = False
     else:
         if public_lab:
-            db_laboratory = db.session.query(Laboratory).filter_by(publicly_available = True, public_identifier = lab_name).first()
+            db_laboratory = resolve_lab(lab_name).public_laboratory
             if db_laboratory is None:
                 return jsonify(success=False, message = gettext("That lab does not exist or it is not publicly available."))
             
@@ -655,7 +647,8 @@ def _reserve_json(lab_name, public_rlms = False, public_lab = False, institution
             institution_name  = 'public-labs' # TODO: make sure that this name is unique
             courses_configurations = []
         else:
-            institution = db.session.query(LearningTool).filter_by(name = institution_id).first()
+            resolution = resolve_lab(lab_name, institution_id)
+            institution = resolution.institution
             if institution is None or len(institution.shindig_credentials) < 1:
                 return jsonify(success=False, message = gettext("This is not a valid PLE. Make sure that the institution id is fine and that there are Shindig Credentials configured"))
 
@@ -675,13 +668,13 @@ def _reserve_json(lab_name, public_rlms = False, public_lab = False, institution
             # First, check if the lab is public (e.g. the lab can be accessed by anyone)
             # Second, check accesibility permissions (e.g. the lab is accessible for everyone from that institution without specifying any Graasp space). 
             # After that, in the case that there are not accesibility permissions, check for that institution if there is a permission identified by that lab_name, and check which courses (spaces in OpenSocial) have that permission.
-            public_lab_db = db.session.query(Laboratory).filter_by(public_identifier = lab_name, publicly_available = True).first()
+            public_lab_db = resolution.public_laboratory
             courses_configurations = []
             if public_lab_db is None:
                 # No public access is granted for the lab, check accesibility permissions
-                accessible_permission = db.session.query(PermissionToLt).filter_by(lt = institution, local_identifier = lab_name, accessible = True).first()
-                if accessible_permission is None:
-                    permission = db.session.query(PermissionToLt).filter_by(lt = institution, local_identifier = lab_name).first()
+                # (the resolver returns an accessible permission if there is any)
+                permission = resolution.permission
+                if permission is None or not permission.accessible:
                     if permission is None:
                         return jsonify(success=False, message=gettext("Your PLE is valid, but don't have permissions for the requested laboratory."))
                     for course_permission in permission.course_permissions:
@@ -690,9 +683,7 @@ def _reserve_json(lab_name, public_rlms = False, public_lab = False, institution
                             courses_configurations.append(course_permission.configuration)
                     if len(courses_configurations) == 0:
                         return jsonify(success=False, message = gettext("Your PLE is valid and your lab too, but you're not in one of the spaces that have permissions (you are in %(space)r)", space=spaces))
-                else:
-                    # There is a accesibility permission for that lab and institution
-                    permission = accessible_permission
+                # Otherwise, there is a accesibility permission for that lab and institution
 
                 ple_configuration = permission.configuration
                 db_laboratory     = permission.laboratory
@@ -769,7 +760,7 @@ def _reserve_json(lab_name, public_rlms = False, public_lab = False, institution
         # Don't translate, just in case there are issues with the problem itself
         return jsonify(success=False, message = "There was an error performing the reservation to the final laboratory.")
 
-    if Capabilities.WIDGET in remote_laboratory.get_capabilities():
+    if Capabilities.WIDGET in get_capabilities(db_rlms, remote_laboratory):
         reservation_id = response['reservation_id']
     else:
         reservation_id = response['load_url']
@@ -819,51 +810,20 @@ def check_ils_booking(gadget_url_base):
     ils_student_id = extract_ils_id(request.args.get('ils_student_url'))
     ils_teacher_id = extract_ils_id(request.args.get('ils_teacher_url'))
 
-    # BOOKING_URL = url_for('.mock_golabz_booking_service', _external=True)
-    BOOKING_URL = 'http://www.golabz.eu/rest/lab-booking/retrieve.json'
-
-    try:
-        r = requests.get(BOOKING_URL, headers = {
-            'Cache-Control': 'no-cache',
-            'Pragma': 'no-cache',
-        })
-        r.raise_for_status()
-        booking_slots = r.json()
-    except Exception as e:
-        traceback.print_exc()
+    # The booking slots are downloaded periodically (see labmanager.golabz)
+    # To test it, use: golab_bookings.set_source(http_json_source(url_for('.mock_golabz_booking_service', _external=True)))
+    current_bookings = get_current_bookings(gadget_url_base)
+    if current_bookings is None:
         # We can not stop students using the labs if the service is temporarily down
         return None
 
     affected_ilss = []
     oldest_affected_endtime = datetime.datetime.utcnow()
-    for booking_slot in booking_slots:
-        is_current_lab = False
-        for lab_app in booking_slot.get('lab_apps', []):
-            lab_url = lab_app.get('app_url', '')
-            if lab_url.startswith(gadget_url_base):
-                is_current_lab = True
-                break
-
-        if not is_current_lab:
-            continue
-        
-        start_time_str = booking_slot.get('start_time', '2000-01-01T00:00:00')
-        end_time_str = booking_slot.get('end_time', '2000-01-01T00:00:00')
-        FORMAT = '%Y-%m-%dT%H:%M:%S'
-
-        try:
-            start_time = datetime.datetime.strptime(start_time_str, FORMAT)
-            end_time = datetime.datetime.strptime(end_time_str, FORMAT)
-        except ValueError:
-            traceback.print_exc()
-            continue
-
-        now = datetime.datetime.utcnow()
-        if end_time > now > start_time:
-            ils_id = extract_ils_id(booking_slot.get('ils_url')) or 'does.not.exist'
-            if end_time > oldest_affected_endtime:
-                oldest_affected_endtime = end_time
-            affected_ilss.append(ils_id)
+    for end_time, ils_url in current_bookings:
+        ils_id = extract_ils_id(ils_url) or 'does.not.exist'
+        if end_time > oldest_affected_endtime:
+            oldest_affected_endtime = end_time
+        affected_ilss.append(ils_id)
 
     if affected_ilss:
         for affected_ils_id in affected_ilss:
@@ -927,12 +887,13 @@ def _open_widget_impl(lab_name, widget_name, public_lab = False, public_rlms = F
             return gettext("RLMS not found")
     else:
         if public_lab:
-            db_laboratory = db.session.query(Laboratory).filter_by(publicly_available = True, public_identifier = lab_name).first()
+            db_laboratory = resolve_lab(lab_name).public_laboratory
         else:
-            institution = db.session.query(LearningTool).filter_by(name = institution_id).first()
+            resolution = resolve_lab(lab_name, institution_id)
+            institution = resolution.institution
             if institution is None or len(institution.shindig_credentials) == 0:
                 return gettext("Institution not found or it does not support Shindig")
-            permission = db.session.query(PermissionToLt).filter_by(lt = institution, local_identifier = lab_name).first()
+            permission = resolution.permission
             db_laboratory     = permission.laboratory if permission is not None else None
 
         if db_laboratory is None:
@@ -949,7 +910,7 @@ def _open_widget_impl(lab_name, widget_name, public_lab = False, public_rlms = F
     kwargs = {}
     if locale:
         kwargs['locale'] = locale
-    if Capabilities.WIDGET in remote_laboratory.get_capabilities():
+    if Capabilities.WIDGET in get_capabilities(db_rlms, remote_laboratory):
         response = remote_laboratory.load_widget(reservation_id, widget_name, back = url_for('.reload', _external = True), **kwargs)
     else:
         response = {'url' : reservation_id}
@@ -11,7 +11,7 @@ from flask.ext.admin import Admin, AdminIndexView, expose
 from flask.ext.admin.contrib.sqlamodel import ModelView
 from labmanager.models import Laboratory, RLMS
 from labmanager.views import RedirectView
-from labmanager.rlms import get_manager_class, Capabilities
+from labmanager.rlms import get_manager_class, Capabilities, get_capabilities, get_widgets
 from labmanager.babel import lazy_gettext, gettext
 from labmanager.utils import remote_addr
 from labmanager.db import db
@@ -112,10 +112,7 @@ class PublicLaboratoriesPanel(ModelView):
         rlms_db = laboratory.rlms
         RLMS_CLASS = get_manager_class(rlms_db.kind, rlms_db.version, rlms_db.id)
         rlms = RLMS_CLASS(rlms_db.configuration)
-        if Capabilities.WIDGET in rlms.get_capabilities():
-            widgets = rlms.list_widgets(laboratory.laboratory_id)
-        else:
-            widgets = [ { 'name' : 'lab', 'description' : 'Main view of the laboratory' } ]
+        widgets = get_widgets(rlms_db, rlms, laboratory.laboratory_id)
        
         autoload = rlms_db.default_autoload
 
@@ -194,7 +191,7 @@ class PublicSystemsPanel(ModelView):
         else:
             query_results = {}
             labs = rlms.get_laboratories()
-            capabilities = rlms.get_capabilities()
+            capabilities = get_capabilities(rlms_db, rlms)
             force_search = Capabilities.FORCE_SEARCH in capabilities
             pages = []
 
@@ -210,10 +207,7 @@ class PublicSystemsPanel(ModelView):
         RLMS_CLASS = get_manager_class(rlms_db.kind, rlms_db.version, rlms_db.id)
         rlms = RLMS_CLASS(rlms_db.configuration)
 
-        if Capabilities.WIDGET in rlms.get_capabilities():
-            widgets = rlms.list_widgets(lab_identifier)
-        else:
-            widgets = [ { 'name' : 'lab', 'description' : 'Main view of the laboratory' } ]
+        widgets = get_widgets(rlms_db, rlms, lab_identifier)
 
         autoload = rlms_db.default_autoload
 
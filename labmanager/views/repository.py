@@ -1,13 +1,20 @@
 import json
+import time
 import hashlib
-from flask import Blueprint, jsonify, url_for, request, current_app, Response, render_template_string, redirect
+import datetime
+import threading
+from flask import Blueprint, url_for, request, current_app, Response, render_template_string, redirect, stream_with_context
 
 from dict2xml import dict2xml
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
 
 from labmanager.db import db
-from labmanager.models import RLMS, Laboratory, EmbedApplication
-from labmanager.rlms import get_manager_class, Capabilities
-from labmanager.rlms.caches import force_cache
+from labmanager.models import RLMS, Laboratory, EmbedApplication, RepositoryMetadata
+from labmanager.application import app
+from labmanager.rlms import get_manager_class, Capabilities, get_capabilities, get_widgets
+from labmanager.rlms.caches import force_cache, dont_force_cache, is_forcing_cache
+from labmanager.rlms.queue import fan_out_iter, FanOutTimeout
 
 repository_blueprint = Blueprint('repository', __name__)
 
@@ -126,21 +133,23 @@ def app_to_xml(embed_app):
         }
 
 
-def extract_labs(rlms, single_lab = None, fmt='json', age_ranges = None, domains = None):
-    if fmt == 'xml':
-        lab_formatter = lab_to_xml
-    else:
-        lab_formatter = lab_to_json
+def _extract_lab_widgets(rlms, single_lab = None, public_identifier = None, external = True):
+    """
+    Returns [ (lab, widgets) ] of the public RLMS (or only single_lab,
+    published as public_identifier). If not external, the URLs are relative
+    to the host.
+    """
     RLMS_CLASS = get_manager_class(rlms.kind, rlms.version, rlms.id)
     rlms_inst = RLMS_CLASS(rlms.configuration)
     labs = rlms_inst.get_laboratories()
+    supports_widgets = Capabilities.WIDGET in get_capabilities(rlms, rlms_inst)
     public_laboratories = []
     for lab in labs:
         if single_lab is not None and lab.laboratory_id != single_lab:
             # If filtering, remove those labs
             continue
 
-        if Capabilities.WIDGET in rlms_inst.get_capabilities():
+        if supports_widgets:
             widgets = rlms_inst.list_widgets(lab.laboratory_id)
         else:
             widgets = [ { 'name' : lab.name or 'default', 'description' : lab.description } ]
@@ -148,15 +157,15 @@ def extract_labs(rlms, single_lab = None, fmt='json', age_ranges = None, domains
         lab_widgets = []
         for widget in widgets:
             if single_lab is None:
-                link = url_for('opensocial.public_rlms_widget_xml', rlms_identifier=rlms.public_identifier, lab_name=lab.laboratory_id, widget_name = widget['name'], _external=True)
+                link = url_for('opensocial.public_rlms_widget_xml', rlms_identifier=rlms.public_identifier, lab_name=lab.laboratory_id, widget_name = widget['name'], _external=external)
                 if link.startswith('https://'):
                     link = link.replace('https://', 'http://', 1)
-                external_url = url_for('repository.preview_public_rlms', rlms_id=rlms.public_identifier, widget_name=widget['name'], lab_name=lab.laboratory_id, _external=True)
+                external_url = url_for('repository.preview_public_rlms', rlms_id=rlms.public_identifier, widget_name=widget['name'], lab_name=lab.laboratory_id, _external=external)
             else:
-                link = url_for('opensocial.public_widget_xml', lab_name=lab.public_identifier, widget_name = widget['name'], _external=True)
+                link = url_for('opensocial.public_widget_xml', lab_name=public_identifier, widget_name = widget['name'], _external=external)
                 if link.startswith('https://'):
                     link = link.replace('https://', 'http://', 1)
-                external_url = url_for('repository.preview_public_lab', widget_name=widget['name'], public_identifier=lab.public_identifier, _external=True)
+                external_url = url_for('repository.preview_public_lab', widget_name=widget['name'], public_identifier=public_identifier, _external=external)
 
             lab_widgets.append({
                 'name': widget['name'],
@@ -165,20 +174,296 @@ def extract_labs(rlms, single_lab = None, fmt='json', age_ranges = None, domains
                 'external': external_url,
             })
 
-        public_laboratories.append(lab_formatter(lab, lab_widgets, rlms, single_lab is not None, age_ranges, domains))
+        public_laboratories.append((lab, lab_widgets))
     return public_laboratories
 
-def _get_resources(fmt = 'json'):
-    if request.args.get('nocache', '') not in ('1','True', 'true'):
-        force_cache()
+def extract_labs(rlms, single_lab = None, fmt='json', age_ranges = None, domains = None, public_identifier = None):
+    if fmt == 'xml':
+        lab_formatter = lab_to_xml
+    else:
+        lab_formatter = lab_to_json
+
     public_laboratories = []
-    for lab in db.session.query(Laboratory).filter_by(publicly_available = True):
-        for public_lab in extract_labs(lab.rlms, lab.laboratory_id, fmt=fmt):
-            public_laboratories.append(public_lab)
-   
-    for rlms in db.session.query(RLMS).filter_by(publicly_available = True):
-        for public_lab in extract_labs(rlms, fmt=fmt):
-            public_laboratories.append(public_lab)
+    for lab, lab_widgets in _extract_lab_widgets(rlms, single_lab, public_identifier):
+        public_laboratories.append(lab_formatter(lab, lab_widgets, rlms, single_lab is not None, age_ranges, domains))
+    return public_laboratories
+
+#
+# The metadata of each public laboratory and each public RLMS (a "source")
+# is stored in the RepositoryMetadata table, and only rebuilt when the
+# source changes in the database or when it is older than
+# REPOSITORY_METADATA_MAX_AGE (since the RLMS may add or change labs).
+# Each source knows when its contents last changed, which is used for the
+# Last-Modified header and for the ?since= queries. The URLs are stored
+# relative to the host, and made absolute when they are sent.
+#
+
+REPOSITORY_METADATA_MAX_AGE = datetime.timedelta(seconds = app.config.get('REPOSITORY_METADATA_MAX_AGE', 3600))
+REPOSITORY_DELETED_IDS_MAX_AGE = datetime.timedelta(seconds = app.config.get('REPOSITORY_DELETED_IDS_MAX_AGE', 30 * 24 * 3600))
+REPOSITORY_THREADS = app.config.get('REPOSITORY_THREADS', 8)
+REPOSITORY_RLMS_TIMEOUT = app.config.get('REPOSITORY_RLMS_TIMEOUT', 30)
+REPOSITORY_RETRY_AFTER = app.config.get('REPOSITORY_RETRY_AFTER', 300)
+
+# When a source fails, it is not asked again (in this process) for
+# REPOSITORY_RETRY_AFTER seconds: its stored metadata is served meanwhile
+_FAILED_SOURCES = {
+    # source: (time.time(), 'timeout' or 'error')
+}
+_FAILED_SOURCES_LOCK = threading.Lock()
+
+def _source_failed(source, error):
+    with _FAILED_SOURCES_LOCK:
+        _FAILED_SOURCES[source] = (time.time(), error)
+
+def _source_succeeded(source):
+    with _FAILED_SOURCES_LOCK:
+        _FAILED_SOURCES.pop(source, None)
+
+def _recent_failure(source):
+    """'timeout' or 'error' if the source failed less than REPOSITORY_RETRY_AFTER seconds ago, None otherwise."""
+    with _FAILED_SOURCES_LOCK:
+        failure = _FAILED_SOURCES.get(source)
+    if failure is not None and time.time() - failure[0] < REPOSITORY_RETRY_AFTER:
+        return failure[1]
+    return None
+
+def clear_failed_sources():
+    with _FAILED_SOURCES_LOCK:
+        _FAILED_SOURCES.clear()
+
+SINCE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+def _metadata_sources():
+    """[ (source, rlms, db_laboratory) ] in the order of the repository (public labs first, then public RLMSs)."""
+    sources = []
+    for lab in db.session.query(Laboratory).filter_by(publicly_available = True).order_by(Laboratory.id):
+        sources.append((u'lab:%s' % lab.id, lab.rlms, lab))
+
+    for rlms in db.session.query(RLMS).filter_by(publicly_available = True).order_by(RLMS.id):
+        sources.append((u'rlms:%s' % rlms.id, rlms, None))
+    return sources
+
+def _source_fingerprint(rlms, db_laboratory):
+    values = [ rlms.kind, rlms.version, rlms.configuration, rlms.public_identifier ]
+    if db_laboratory is not None:
+        values.extend([ db_laboratory.laboratory_id, db_laboratory.public_identifier ])
+    return unicode(hashlib.sha1(json.dumps(values)).hexdigest())
+
+class _SourceRLMS(object):
+    """Copy of the RLMS columns needed to build its metadata, so it can be used from other threads."""
+    def __init__(self, rlms):
+        self.id = rlms.id
+        self.name = rlms.name
+        self.kind = rlms.kind
+        self.version = rlms.version
+        self.configuration = rlms.configuration
+        self.public_identifier = rlms.public_identifier
+
+def _build_source(rlms, laboratory_id = None, public_identifier = None):
+    """Returns the (json_resources, xml_resources) of the source, asking the RLMS only once."""
+    lab_widgets = _extract_lab_widgets(rlms, laboratory_id, public_identifier, external = False)
+    single = laboratory_id is not None
+    json_resources = [ lab_to_json(lab, widgets, rlms, single, None, None) for lab, widgets in lab_widgets ]
+    xml_resources = [ lab_to_xml(lab, widgets, rlms, single, None, None) for lab, widgets in lab_widgets ]
+    return json_resources, xml_resources
+
+def _source_builder(rlms, db_laboratory):
+    """Returns a function which builds the source in its own request context (see fan_out)."""
+    environ = dict(request.environ)
+    forcing_cache = is_forcing_cache()
+    rlms = _SourceRLMS(rlms)
+    if db_laboratory is None:
+        laboratory_id = public_identifier = None
+    else:
+        laboratory_id = db_laboratory.laboratory_id
+        public_identifier = db_laboratory.public_identifier
+
+    def build():
+        with app.request_context(environ):
+            if forcing_cache:
+                force_cache()
+            else:
+                dont_force_cache()
+            return _build_source(rlms, laboratory_id, public_identifier)
+    return build
+
+def _load_deleted_ids(entry):
+    """[ (resource id, when it was deleted) ] of the stored source."""
+    return [ (resource_id, datetime.datetime.strptime(deleted, SINCE_FORMAT)) for resource_id, deleted in json.loads(entry.deleted_ids) ]
+
+def _deleted_since(entry, since):
+    return [ resource_id for resource_id, deleted in _load_deleted_ids(entry) if deleted > since ]
+
+def _store_source(entry, source, fingerprint, json_resources, xml_resources, now):
+    json_data = json.dumps(json_resources)
+    xml_data = json.dumps(xml_resources)
+    content_hash = unicode(hashlib.sha1(json_data + xml_data).hexdigest())
+
+    if entry is None:
+        entry = RepositoryMetadata(source, built = now, modified = now)
+        db.session.add(entry)
+
+    entry.fingerprint = fingerprint
+    entry.built = now
+
+    # Older deletions are not reported anymore (see _metadata_response)
+    horizon = now - REPOSITORY_DELETED_IDS_MAX_AGE
+    deleted_ids = [ (resource_id, deleted) for resource_id, deleted in _load_deleted_ids(entry) if deleted >= horizon ]
+    if entry.content_hash != content_hash:
+        resource_ids = [ resource['id'] for resource in json_resources ]
+        deleted_ids = [ (resource_id, deleted) for resource_id, deleted in deleted_ids if resource_id not in resource_ids ]
+        deleted_ids.extend([ (resource_id, now) for resource_id in json.loads(entry.resource_ids) if resource_id not in resource_ids ])
+        entry.resource_ids = json.dumps(resource_ids)
+        entry.json_resources = json_data
+        entry.xml_resources = xml_data
+        entry.content_hash = content_hash
+        entry.modified = now
+    entry.deleted_ids = json.dumps([ (resource_id, deleted.strftime(SINCE_FORMAT)) for resource_id, deleted in deleted_ids ])
+    return entry
+
+def _plan_metadata(force = False):
+    """
+    Find out which sources must be rebuilt (those which changed, or all of
+    them if force, except those which failed recently). Returns a dictionary with:
+
+      sources:    [ (source, name, stored RepositoryMetadata or None, recent failure or None) ] in order
+      pending:    [ (position in sources, fingerprint, builder) ]
+      not_public: stored RepositoryMetadata of sources which are not public anymore
+                  and still have resources (or deleted ids to forget)
+    """
+    now = datetime.datetime.utcnow()
+    oldest = now - REPOSITORY_METADATA_MAX_AGE
+    horizon = now - REPOSITORY_DELETED_IDS_MAX_AGE
+    stored = dict( (entry.source, entry) for entry in db.session.query(RepositoryMetadata).all() )
+
+    sources = []
+    pending = []
+    for source, rlms, db_laboratory in _metadata_sources():
+        entry = stored.pop(source, None)
+        failure = _recent_failure(source)
+        fingerprint = _source_fingerprint(rlms, db_laboratory)
+        if failure is None and (force or entry is None or entry.fingerprint != fingerprint or entry.built < oldest):
+            pending.append((len(sources), fingerprint, _source_builder(rlms, db_laboratory)))
+        sources.append((source, rlms.get_name(), entry, failure))
+
+    not_public = [ entry for entry in stored.values() if entry.resource_ids != u'[]' or any( deleted < horizon for _, deleted in _load_deleted_ids(entry) ) ]
+    return dict(sources = sources, pending = pending, not_public = not_public)
+
+def _commit_source(source, entry):
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Another process stored the same source meanwhile; use theirs
+        db.session.rollback()
+        return db.session.query(RepositoryMetadata).filter_by(source = source).first()
+    except:
+        db.session.rollback()
+        raise
+    return entry
+
+def iter_metadata(plan):
+    """
+    Yields (RepositoryMetadata or None, error) for each source of the plan
+    (see _plan_metadata) in order, rebuilding and storing those pending as
+    they are retrieved. The RLMSs are asked in parallel (REPOSITORY_THREADS),
+    and each of them has up to REPOSITORY_RLMS_TIMEOUT seconds. If a source
+    fails (now or in the last REPOSITORY_RETRY_AFTER seconds), its previous
+    metadata (if any) is kept, along with the error.
+    """
+    sources = plan['sources']
+    pending = plan['pending']
+    results = fan_out_iter([ builder for _, _, builder in pending ], threads = REPOSITORY_THREADS, timeout = REPOSITORY_RLMS_TIMEOUT)
+
+    fingerprints = dict( (position, fingerprint) for position, fingerprint, _ in pending )
+    for position, (source, name, entry, failure) in enumerate(sources):
+        error = None
+        if failure is not None:
+            error = { 'source' : source, 'name' : name, 'error' : failure }
+        elif position in fingerprints:
+            fingerprint = fingerprints[position]
+            # Both are in the same order
+            result, build_error = next(results)
+            if build_error is None:
+                json_resources, xml_resources = result
+                entry = _store_source(entry, source, fingerprint, json_resources, xml_resources, datetime.datetime.utcnow())
+                entry = _commit_source(source, entry)
+                _source_succeeded(source)
+            else:
+                if isinstance(build_error, FanOutTimeout):
+                    error = { 'source' : source, 'name' : name, 'error' : 'timeout' }
+                else:
+                    error = { 'source' : source, 'name' : name, 'error' : 'error' }
+                _source_failed(source, error['error'])
+        yield entry, error
+
+    # Sources which are not public anymore: all their resources are deleted
+    if plan['not_public']:
+        now = datetime.datetime.utcnow()
+        for entry in plan['not_public']:
+            _store_source(entry, entry.source, None, [], [], now)
+            if entry.deleted_ids == u'[]':
+                # Nothing left to report
+                db.session.delete(entry)
+        _commit_source(None, None)
+
+def update_metadata(force = False):
+    """Rebuild the stored metadata of the sources which changed. Returns (entries, errors)."""
+    entries = []
+    errors = []
+    for entry, error in iter_metadata(_plan_metadata(force)):
+        if entry is not None:
+            entries.append(entry)
+        if error is not None:
+            errors.append(error)
+    return entries, errors
+
+def _parse_since(since):
+    return datetime.datetime.strptime(since.rstrip('Z'), SINCE_FORMAT)
+
+def _absolute_urls(resources, fmt = 'json'):
+    """The stored URLs are relative to the host: make them absolute for this request."""
+    host_url = request.host_url.rstrip('/')
+    # The widgets are always linked through http (see _extract_lab_widgets)
+    widget_host_url = host_url.replace('https://', 'http://', 1)
+    for resource in resources:
+        if fmt == 'xml':
+            lab_apps = [ lab_app['labApp'] for lab_app in resource.get('labApps', []) ]
+            keys = ('appUrl', 'externalUrl')
+        else:
+            lab_apps = resource.get('lab_apps', [])
+            keys = ('app_url', 'external_url')
+
+        for lab_app in lab_apps:
+            for key, base_url in zip(keys, (widget_host_url, host_url)):
+                if lab_app.get(key, '').startswith('/'):
+                    lab_app[key] = base_url + lab_app[key]
+    return resources
+
+def _iter_resources(results, fmt = 'json', since = None):
+    """
+    Yields (resources, deleted_ids, error) for each (entry, error) of
+    iter_metadata in order; only with the resources of the sources modified
+    after since (all of them if None). Nothing is changed in the database.
+    """
+    for entry, error in results:
+        resources = []
+        deleted_ids = []
+        if entry is not None and (since is None or entry.modified > since):
+            if fmt == 'xml':
+                resources = _absolute_urls(json.loads(entry.xml_resources), fmt)
+            else:
+                resources = _absolute_urls(json.loads(entry.json_resources), fmt)
+            if since is not None:
+                deleted_ids = _deleted_since(entry, since)
+        yield resources, deleted_ids, error
+
+    if since is not None:
+        # Sources which are not public anymore
+        deleted_ids = []
+        query = db.session.query(RepositoryMetadata).filter(RepositoryMetadata.modified > since, RepositoryMetadata.fingerprint == None)
+        for entry in query:
+            deleted_ids.extend(_deleted_since(entry, since))
+        yield [], deleted_ids, None
 
     if False:
         # DO NOT ADD EMBEDDED APPS TO THE REPOSITORY
@@ -187,45 +472,144 @@ def _get_resources(fmt = 'json'):
         else:
             app_formatter = app_to_json
 
-        for app in db.session.query(EmbedApplication).all():
-            public_laboratories.append(app_formatter(app))
+        yield [ app_formatter(app) for app in db.session.query(EmbedApplication).all() ], [], None
 
-    return public_laboratories
+def _prepare_resources():
+    force = request.args.get('nocache', '') in ('1','True', 'true')
+    if not force:
+        force_cache()
+    return _plan_metadata(force)
+
+def _get_resources(fmt = 'json', since = None):
+    """Returns (resources, deleted_ids, errors) of the sources modified after since (all of them if None)."""
+    public_laboratories = []
+    deleted_ids = []
+    errors = []
+    results = list(iter_metadata(_prepare_resources()))
+    for resources, source_deleted_ids, error in _iter_resources(results, fmt, since):
+        public_laboratories.extend(resources)
+        deleted_ids.extend(source_deleted_ids)
+        if error is not None:
+            errors.append(error)
+    return public_laboratories, deleted_ids, errors
+
+#
+# Streaming serializers: the document is sent source by source instead of
+# being built in memory first. Their output is the same as the one of
+# jsonify (but without indentation) and dict2xml.
+#
+
+def serialize_json(items, since = None):
+    yield '{"resources": ['
+    first = True
+    deleted_ids = []
+    errors = []
+    for resources, source_deleted_ids, error in items:
+        for resource in resources:
+            if first:
+                first = False
+                yield '\n'
+            else:
+                yield ',\n'
+            yield json.dumps(resource)
+        deleted_ids.extend(source_deleted_ids)
+        if error is not None:
+            errors.append(error)
+    yield '\n]'
+
+    if since is not None:
+        yield ', "deleted": %s' % json.dumps(deleted_ids)
+    if errors:
+        yield ', "errors": %s' % json.dumps(errors)
+    yield '}\n'
+
+def _xml_element(name, contents):
+    # dict2xml does not add the indentation of the parent element
+    return u''.join( u'  %s\n' % line for line in dict2xml(contents, wrap = name, indent = '  ').split(u'\n') )
+
+def serialize_xml(items, since = None):
+    yield '<resources>\n'
+    empty = True
+    deleted_ids = []
+    errors = []
+    for resources, source_deleted_ids, error in items:
+        for resource in resources:
+            empty = False
+            yield _xml_element('resource', resource).encode('utf8')
+        deleted_ids.extend(source_deleted_ids)
+        if error is not None:
+            errors.append(error)
+
+    if empty:
+        yield '  <resource></resource>\n'
+    if since is not None:
+        yield _xml_element('deleted', { 'id' : deleted_ids }).encode('utf8')
+    if errors:
+        yield _xml_element('errors', { 'error' : errors }).encode('utf8')
+    yield '</resources>'
+
+SERIALIZERS = {
+    'json' : (serialize_json, 'application/json'),
+    'xml' : (serialize_xml, 'application/xml'),
+}
+
+def _metadata_response(fmt):
+    since = request.args.get('since')
+    if since:
+        try:
+            since = _parse_since(since)
+        except ValueError:
+            return Response("Invalid since argument. Use the format YYYY-MM-DDTHH:MM:SS (UTC)", status = 400)
+        if since < datetime.datetime.utcnow() - REPOSITORY_DELETED_IDS_MAX_AGE:
+            # The deleted ids are not known that far: send the complete list (without "deleted")
+            since = None
+    else:
+        since = None
+
+    # Every pending source is rebuilt and stored before the response starts,
+    # so an error can not leave a truncated document with a 200 status;
+    # only the serialization is streamed
+    results = list(iter_metadata(_prepare_resources()))
+
+    serializer, mimetype = SERIALIZERS[fmt]
+    response = Response(mimetype = mimetype)
+    entries = [ entry for entry, _ in results if entry is not None ]
+    failures = [ u'%s:%s' % (error['source'], error['error']) for _, error in results if error is not None ]
+    etag_contents = [ fmt, request.args.get('since', '') ] + [ entry.content_hash or u'' for entry in entries ] + failures
+    response.set_etag(hashlib.sha1(u'\n'.join(etag_contents)).hexdigest())
+    # Including the sources which are not public anymore
+    last_modified = db.session.query(func.max(RepositoryMetadata.modified)).scalar()
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.make_conditional(request)
+    if response.status_code == 304:
+        return response
+
+    response.response = stream_with_context(serializer(_iter_resources(results, fmt, since), since))
+    return response
 
 @repository_blueprint.route('/metadata.json')
 def resources():
-    public_laboratories = _get_resources(fmt='json')
-    return jsonify(resources=public_laboratories)
+    return _metadata_response('json')
 
 @repository_blueprint.route('/metadata.xml')
 def resources_xml():
-    public_laboratories = _get_resources(fmt='xml')
-    return Response(dict2xml({
-        "resources": {
-            "resource" : public_laboratories
-        }
-    }), mimetype='application/xml')
+    return _metadata_response('xml')
 
 @repository_blueprint.route('/metadata.html')
 def resources_html():
     fmt = request.args.get('format') or 'json'
     if fmt == 'xml':
-        public_laboratories = _get_resources(fmt='xml')
+        public_laboratories = _get_resources(fmt='xml')[0]
         contents = dict2xml({
             "resources": {
                 "resource" : public_laboratories
             }
         })
     else:
-        contents = json.dumps(_get_resources(fmt='json'))
+        contents = json.dumps(_get_resources(fmt='json')[0])
     return render_template_string("<html><body>Contents: <pre>{{ contents }}</pre></body></html>", contents=contents)
 
-def _get_widgets(rlms, laboratory_id):
-    if Capabilities.WIDGET in rlms.get_capabilities():
-        return rlms.list_widgets(laboratory_id)
-
-    return [ { 'name' : 'lab', 'description' : 'Main view of the laboratory' } ]
-
 @repository_blueprint.route('/preview/rlms/<rlms_id>/<widget_name>/<everything:lab_name>')
 def preview_public_rlms(rlms_id, widget_name, lab_name):
     db_rlms = db.session.query(RLMS).filter_by(publicly_available=True, public_identifier=rlms_id).first()
@@ -235,7 +619,7 @@ def preview_public_rlms(rlms_id, widget_name, lab_name):
     rlms = db_rlms.get_rlms()
     for lab in rlms.get_laboratories():
         if lab.laboratory_id == lab_name:
-            widgets = _get_widgets(rlms, lab.laboratory_id)
+            widgets = get_widgets(db_rlms, rlms, lab.laboratory_id)
 
             links = [] 
             for widget in widgets:
@@ -255,7 +639,7 @@ def preview_public_lab(widget_name, public_identifier):
     rlms = db_laboratory.rlms.get_rlms()
     for lab in rlms.get_laboratories():
         if lab.laboratory_id == db_laboratory.laboratory_id:
-            widgets = _get_widgets(rlms, lab.laboratory_id)
+            widgets = get_widgets(db_laboratory.rlms, rlms, lab.laboratory_id)
             links = []
             for widget in widgets:
                 if widget['name'] == widget_name:
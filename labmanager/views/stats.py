@@ -1,11 +1,17 @@
-import requests
-from flask import render_template, Blueprint, current_app, request, jsonify
+import csv
+import json
+import heapq
+import datetime
+import StringIO
+
+from flask import render_template, Blueprint, current_app, request, jsonify, Response, stream_with_context
 
 from sqlalchemy import sql
 from sqlalchemy import func
 
 from labmanager.db import db
 from labmanager.models import UseLog
+from labmanager.golabz import get_failure_data, get_lab_per_url
 
 stats_blueprint = Blueprint('stats', __name__)
 
@@ -30,6 +36,52 @@ def session_proxy(session):
                 ~sql.and_(UseLog.city == 'Enschede', UseLog.country == 'NL'),
                 ~sql.and_(UseLog.city == 'Mountain View', UseLog.country == 'US'))
 
+DEFAULT_TOP = 10
+
+def _get_top():
+    try:
+        top = int(request.args.get('n', DEFAULT_TOP))
+    except ValueError:
+        top = DEFAULT_TOP
+    return max(top, 0)
+
+def top_urls_per_period(rows, top, lab_per_url, url_filter = None):
+    """
+    Given an iterable of (count, year, month, url) rows (one per url and
+    period), return { (year, month): [ { 'count', 'url', 'data' } ] } with
+    only the top most used urls of each period, sorted from max to min.
+
+    It is a single pass over the rows keeping a bounded min-heap per
+    period, so it is O(n log top) instead of sorting every time.
+    """
+    heaps = {
+        # (year, month): [ (count, url) ] (min-heap of at most top elements)
+    }
+    for count, year, month, url in rows:
+        heap = heaps.get((year, month))
+        if heap is None:
+            heap = heaps[year, month] = []
+
+        if url_filter is not None and not url_filter(url, lab_per_url.get(url, {})):
+            continue
+
+        entry = (count, url)
+        if len(heap) < top:
+            heapq.heappush(heap, entry)
+        elif top and entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+
+    temporal_month_url = {
+        # (year, month): [ { 'count': count, 'url': url, 'data': lab_data } ]
+    }
+    for period, heap in heaps.iteritems():
+        temporal_month_url[period] = [ {
+                'count': count,
+                'url': url,
+                'data': lab_per_url.get(url, {})
+            } for count, url in sorted(heap, reverse=True) ]
+    return temporal_month_url
+
 @stats_blueprint.route('/monthly-summary.json')
 def monthy_summary_json():
     monthly_summary = [
@@ -45,22 +97,8 @@ def monthy_summary_json():
 
 @stats_blueprint.route("/monthly")
 def monthly():
-    try:
-        failure_data = requests.get("https://composer.golabz.eu/translator/stats/status.json").json()
-    except:
-        failure_data = {
-            'failing': [],
-            'flash': [],
-            'ssl': [],
-        }
-
-    lab_contents = requests.get('https://www.golabz.eu/rest/labs/retrieve.json').json()
-    lab_per_url = {
-        # url: lab_data
-    }
-    for lab in lab_contents:
-        for lab_app in lab['lab_apps']:
-            lab_per_url[lab_app['app_url']] = lab
+    failure_data = get_failure_data()
+    lab_per_url = get_lab_per_url()
 
     month_results = [
         # {
@@ -81,19 +119,8 @@ def monthly():
         monthly_summary[year, month] = count
     month_results.sort(lambda x, y: cmp(x['year'], y['year']) or cmp(x['month'], y['month']), reverse=True)
 
-    temporal_month_url = {
-        # (year, month): [ { 'count': count, 'url': url ]
-    }
-    for count, year, month, url in session_proxy(db.session.query(func.count("id"), UseLog.year, UseLog.month, UseLog.url).filter(~UseLog.web_browser.like('%bot%'))).group_by(UseLog.year, UseLog.month, UseLog.url).all():
-        if (year, month) not in temporal_month_url:
-            temporal_month_url[year, month] = []
-
-        temporal_month_url[year, month].append({
-            'count': count,
-            'url': url,
-            'data': lab_per_url.get(url, {})
-        })
-        temporal_month_url[year, month].sort(lambda x, y: cmp(x['count'], y['count']), reverse=True)
+    rows = session_proxy(db.session.query(func.count("id"), UseLog.year, UseLog.month, UseLog.url).filter(~UseLog.web_browser.like('%bot%'))).group_by(UseLog.year, UseLog.month, UseLog.url)
+    temporal_month_url = top_urls_per_period(rows, _get_top(), lab_per_url)
 
     month_url_results = [
         # {
@@ -120,22 +147,8 @@ def monthly():
 
 @stats_blueprint.route("/yearly")
 def yearly():
-    try:
-        failure_data = requests.get("http://composer.golabz.eu/translator/stats/status.json").json()
-    except:
-        failure_data = {
-            'failing': [],
-            'flash': [],
-            'ssl': [],
-        }
-
-    lab_contents = requests.get('http://www.golabz.eu/rest/labs/retrieve.json').json()
-    lab_per_url = {
-        # url: lab_data
-    }
-    for lab in lab_contents:
-        for lab_app in lab['lab_apps']:
-            lab_per_url[lab_app['app_url']] = lab
+    failure_data = get_failure_data()
+    lab_per_url = get_lab_per_url()
 
     month_results = [
         # {
@@ -157,23 +170,13 @@ def yearly():
         monthly_summary[year, month] = count
     month_results.sort(lambda x, y: cmp(x['year'], y['year']) or cmp(x['month'], y['month']), reverse=True)
 
-    temporal_month_url = {
-        # (year, month): [ { 'count': count, 'url': url ]
-    }
-    for count, year, url in session_proxy(db.session.query(func.count("id"), UseLog.year, UseLog.url)).group_by(UseLog.year, UseLog.url).all():
-        if (year, 12) not in temporal_month_url:
-            temporal_month_url[year, 12] = []
-
-        lab_data = lab_per_url.get(url, {})
-        if request.args.get('https') in ['1', 'true'] and lab_data.get('lab_golabz_page') not in failure_data['ssl']:
-            continue
+    if request.args.get('https') in ['1', 'true']:
+        url_filter = lambda url, lab_data: lab_data.get('lab_golabz_page') in failure_data['ssl']
+    else:
+        url_filter = None
 
-        temporal_month_url[year, 12].append({
-            'count': count,
-            'url': url,
-            'data': lab_per_url.get(url, {})
-        })
-        temporal_month_url[year, 12].sort(lambda x, y: cmp(x['count'], y['count']), reverse=True)
+    rows = ( (count, year, 12, url) for count, year, url in session_proxy(db.session.query(func.count("id"), UseLog.year, UseLog.url)).group_by(UseLog.year, UseLog.url) )
+    temporal_month_url = top_urls_per_period(rows, _get_top(), lab_per_url, url_filter)
 
     month_url_results = [
         # {
@@ -198,4 +201,98 @@ def yearly():
     month_url_results.sort(lambda x, y: cmp(x['year'], y['year']) or cmp(x['month'], y['month']), reverse=True)
     return render_template("stats/monthly.html", month_results=month_results, month_url_results=month_url_results, failure_data=failure_data, monthly=False)
 
+#
+# Raw export of the UseLogs
+#
+
+EXPORT_COLUMNS = ['id', 'datetime', 'local_datetime', 'local_timezone', 'url', 'country', 'city',
+                  'browser_name', 'browser_version', 'browser_platform', 'browser_language',
+                  'first_language', 'second_language', 'third_language']
+
+EXPORT_FORMATS = {
+    # format: mimetype
+    'csv': 'text/csv',
+    'json': 'application/x-ndjson',
+}
+
+DATE_FORMAT = '%Y-%m-%d'
+
+def iter_use_logs(start = None, end = None, url = None, country = None, chunk_days = 7, rows_per_fetch = 1000):
+    """
+    Yield the EXPORT_COLUMNS of the UseLogs between start and end (both
+    datetime.date, inclusive), ordered by date. Only plain rows are
+    retrieved (no ORM objects), one date range of chunk_days at a time and
+    rows_per_fetch rows per fetch (streamed with a server-side cursor when
+    the driver supports it), so memory does not depend on the table size.
+    """
+    if start is None or end is None:
+        min_date, max_date = db.session.query(func.min(UseLog.date), func.max(UseLog.date)).first()
+        if min_date is None:
+            return
+        start = start or min_date
+        end = end or max_date
+
+    columns = [ getattr(UseLog, column) for column in EXPORT_COLUMNS ]
+    step = datetime.timedelta(days = chunk_days)
+    last = end + datetime.timedelta(days = 1)
+    current = start
+    while current < last:
+        chunk_end = min(current + step, last)
+        query = db.session.query(*columns).filter(UseLog.date >= current, UseLog.date < chunk_end)
+        if url:
+            query = query.filter(UseLog.url == url)
+        if country:
+            query = query.filter(UseLog.country == country)
+
+        query = query.order_by(UseLog.date, UseLog.id).execution_options(stream_results = True)
+        for row in query.yield_per(rows_per_fetch):
+            yield row
+
+        current = chunk_end
+
+def _export_value(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return value
+
+def serialize_use_logs(rows, fmt = 'csv'):
+    """Yield the rows serialized in CSV (with header) or newline-delimited JSON, one line at a time."""
+    if fmt == 'json':
+        for row in rows:
+            yield json.dumps(dict(zip(EXPORT_COLUMNS, [ _export_value(value) for value in row ]))) + '\n'
+        return
+
+    buf = StringIO.StringIO()
+    writer = csv.writer(buf)
+
+    def writerow(values):
+        writer.writerow([ value.encode('utf-8') if isinstance(value, unicode) else value for value in values ])
+        line = buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+        return line
+
+    yield writerow(EXPORT_COLUMNS)
+    for row in rows:
+        yield writerow([ _export_value(value) for value in row ])
+
+def parse_date(value):
+    if not value:
+        return None
+    return datetime.datetime.strptime(value, DATE_FORMAT).date()
+
+@stats_blueprint.route("/export.<fmt>")
+def export(fmt):
+    if fmt not in EXPORT_FORMATS:
+        return "Invalid format. Use one of: %s" % ', '.join(EXPORT_FORMATS), 400
+
+    try:
+        start = parse_date(request.args.get('start'))
+        end = parse_date(request.args.get('end'))
+    except ValueError:
+        return "Invalid date. Use the format YYYY-MM-DD", 400
 
+    rows = iter_use_logs(start, end, url = request.args.get('url'), country = request.args.get('country'))
+    return Response(stream_with_context(serialize_use_logs(rows, fmt)), mimetype = EXPORT_FORMATS[fmt], headers = {
+        'Content-Disposition': 'attachment; filename=uselogs.%s' % fmt,
+    })
@@ -0,0 +1,45 @@
+# -*-*- encoding: utf-8 -*-*-
+#
+# gateway4labs is free software: you can redistribute it and/or modify
+# it under the terms of the BSD 2-Clause License
+# gateway4labs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+
+"""
+Add or update the users, apps and translations of an App Composer export
+(see labmanager.sync):
+
+    python sync_embed.py --dry-run
+    python sync_embed.py --file export-embed.json --batch-size 1000
+"""
+
+import json
+from optparse import OptionParser
+
+import requests
+
+from labmanager import app
+from labmanager.sync import sync_embed_applications, format_report
+
+parser = OptionParser(usage = "Synchronize the embed applications with an App Composer export")
+parser.add_option('--url', dest = 'url', default = 'http://composer.golabz.eu/export-embed.json', help = "URL of the export")
+parser.add_option('--file', dest = 'file', default = None, help = "Local file with the export (instead of --url)")
+parser.add_option('--batch-size', dest = 'batch_size', type = 'int', default = None, help = "Rows per INSERT or UPDATE batch (default: SYNC_BATCH_SIZE)")
+parser.add_option('--dry-run', dest = 'dry_run', default = False, action = 'store_true', help = "Only report what would change")
+args, _ = parser.parse_args()
+
+if args.file:
+    contents = json.load(open(args.file))
+else:
+    response = requests.get(args.url, timeout = (10, 120))
+    response.raise_for_status()
+    contents = response.json()
+
+with app.app_context():
+    report = sync_embed_applications(contents, dry_run = args.dry_run, batch_size = args.batch_size)
+
+if args.dry_run:
+    print "Dry run (nothing changed):", format_report(report)
+else:
+    print "Sync completed:", format_report(report)